@@ -0,0 +1,318 @@
+#!/usr/bin/python
+r"""Offline benchmarks of the merge and serialization paths.
+
+Generates synthetic profiler and oplog intermediate files, in both the
+"bson" and the "pickle" formats, then measures the ops/sec and the peak
+memory of:
+
+* read_pickle: `utils.unpickle_iterator` over the pickle files;
+* read_bson: `spool.iter_docs` over the bson files;
+* merge: `merge.merge_to_final_output` of the files;
+* dump_op: `merge.dump_op` of docs that are already in memory;
+* encode_json_util, encode_extjson: encoding the fields `dump_op` keeps of
+  those docs, with `bson.json_util.dumps` and with `extjson.dumps`.
+
+No MongoDB is needed. Each benchmark runs in its own process, so that its
+peak memory is its own. The results are saved as json, and can be compared
+to the results of another version:
+
+    python benchmark.py -o before.json
+    git checkout ...
+    python benchmark.py -o after.json --compare before.json
+"""
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+import extjson
+import merge
+import spool
+import timeindex
+import utils
+
+DEFAULT_OP_MIX = "query=4,update=2,remove=1,command=1"
+BENCHMARKS = ("read_pickle", "read_bson", "merge", "dump_op",
+              "encode_json_util", "encode_extjson")
+
+
+def parse_op_mix(op_mix):
+    """Parse "query=4,update=2" into [("query", 4.0), ("update", 2.0)]"""
+    weights = []
+    for item in op_mix.split(","):
+        op, weight = item.split("=")
+        weights.append((op.strip(), float(weight)))
+    return weights
+
+
+def generate(directory, files=4, ops=100000, insert_ratio=0.2, doc_size=200,
+             op_mix=DEFAULT_OP_MIX, file_format="bson", seed=1):
+    """Write synthetic intermediate files to `directory`.
+    @param ops: profiler ops in total, spread over `files` profiler files.
+    @param insert_ratio: fraction of inserts, each gets an oplog doc too.
+    @param doc_size: approximate size of the payload of each doc.
+    @param op_mix: relative weights of the non-insert op types.
+    @return: the oplog file name and the profiler file names."""
+    rnd = random.Random(seed)
+    weights = parse_op_mix(op_mix)
+    total_weight = sum(weight for _, weight in weights)
+    payload = "x" * doc_size
+    ts = datetime.datetime(2015, 1, 1)
+    oplog_file = os.path.join(directory, "oplog")
+    profiler_files = [os.path.join(directory, "profiler%d" % index)
+                      for index in xrange(files)]
+    oplog = spool.open_writer(oplog_file, file_format)
+    writers = [spool.open_writer(name, file_format)
+               for name in profiler_files]
+    inserts = 0
+    for index in xrange(ops):
+        ts += datetime.timedelta(microseconds=rnd.randrange(1, 2000) * 1000)
+        ns = "db.coll%d" % rnd.randrange(8)
+        if rnd.random() < insert_ratio:
+            _id = ObjectId()
+            doc = {"ts": ts, "ns": ns, "op": "insert",
+                   "query": {"_id": _id, "payload": payload},
+                   "ninserted": 1, "millis": 0}
+            oplog.write({"ts": Timestamp(ts, inserts % 100), "ns": ns,
+                         "op": "i", "o": {"_id": _id, "payload": payload}})
+            inserts += 1
+        else:
+            pick = rnd.random() * total_weight
+            for op, weight in weights:
+                pick -= weight
+                if pick < 0:
+                    break
+            doc = {"ts": ts, "ns": ns, "op": op,
+                   "query": {"_id": index, "payload": payload},
+                   "ntoreturn": 0, "ntoskip": 0, "millis": 1}
+            if op == "update":
+                doc["updateobj"] = {"$set": {"payload": payload}}
+            elif op == "command":
+                doc["command"] = {"count": ns.split(".")[1],
+                                  "query": {"payload": payload}}
+        writers[rnd.randrange(files)].write(doc)
+    for writer in writers + [oplog]:
+        writer.close()
+    return oplog_file, profiler_files
+
+
+class _NullFile(object):
+
+    """Swallows whatever is written to it"""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _run_read_pickle(data):
+    ops = 0
+    for name in [data["pickle"]["oplog"]] + data["pickle"]["profilers"]:
+        for _ in utils.unpickle_iterator(name):
+            ops += 1
+    return ops
+
+
+def _run_read_bson(data):
+    ops = 0
+    for name in [data["bson"]["oplog"]] + data["bson"]["profilers"]:
+        for doc in spool.iter_docs(name):
+            # what the merge reads of every doc
+            doc["ts"]
+            ops += 1
+    return ops
+
+
+def _run_merge(data):
+    files = data[data["format"]]
+    output_file = os.path.join(data["directory"], "output")
+    merge.merge_to_final_output(files["oplog"], files["profilers"],
+                                output_file)
+    return sum(1 for _ in open(output_file))
+
+
+def _run_dump_op(data, docs):
+    output = timeindex.IndexedWriter(_NullFile())
+    for doc in docs:
+        merge.dump_op(output, doc)
+    return len(docs)
+
+
+def _run_encode_json_util(data, docs):
+    for doc in docs:
+        json_util.dumps(doc)
+    return len(docs)
+
+
+def _run_encode_extjson(data, docs):
+    for doc in docs:
+        extjson.dumps(doc)
+    return len(docs)
+
+
+def _load_dump_op_docs(data):
+    """The ops as the merge would hand them to `dump_op`"""
+    docs = []
+    for name in data["pickle"]["profilers"]:
+        docs.extend(utils.unpickle_iterator(name))
+    return docs
+
+
+def _load_encode_docs(data):
+    """The fields `dump_op` encodes"""
+    return [merge.select_fields(doc) for doc in _load_dump_op_docs(data)]
+
+
+def _peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _measure(name, data, results):
+    """Run one benchmark, in a child process"""
+    utils.LOG.setLevel("WARNING")
+    args = ()
+    if name == "dump_op":
+        args = (_load_dump_op_docs(data),)
+    elif name.startswith("encode_"):
+        args = (_load_encode_docs(data),)
+    rss_before = _peak_rss_mb()
+    start = time.time()
+    ops = globals()["_run_" + name](data, *args)
+    secs = time.time() - start
+    results.put({"ops": ops, "secs": secs, "ops_per_sec": ops / secs,
+                 "peak_rss_mb": _peak_rss_mb(),
+                 "rss_growth_mb": _peak_rss_mb() - rss_before})
+
+
+def run_benchmark(name, data, repeat=1):
+    """Run a benchmark `repeat` times, each in a fresh process.
+    @return: the fastest run's measures."""
+    best = None
+    for _ in xrange(repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure,
+                                          args=(name, data, results))
+        process.start()
+        result = results.get()
+        process.join()
+        if best is None or result["secs"] < best["secs"]:
+            best = result
+    return best
+
+
+def compare(results, baseline, max_regression):
+    """Print the ops/sec of `results` relative to `baseline`.
+    @return: the names of the benchmarks that regressed by more than
+        `max_regression`."""
+    regressed = []
+    print "%-16s %14s %14s %8s" % ("benchmark", "baseline op/s", "op/s",
+                                   "ratio")
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        ratio = result["ops_per_sec"] / baseline[name]["ops_per_sec"]
+        print "%-16s %14.0f %14.0f %8.2f" % (
+            name, baseline[name]["ops_per_sec"], result["ops_per_sec"], ratio)
+        if ratio < 1 - max_regression:
+            regressed.append(name)
+    return regressed
+
+
+def get_args():
+    parser = ArgumentParser(
+        description='Benchmark the merge and serialization paths on '
+        'synthetic data, no MongoDB needed')
+    parser.add_argument('-n', '--ops', dest='ops', type=int, default=100000,
+                        help='Profiler ops to generate - default 100000')
+    parser.add_argument('-f', '--files', dest='files', type=int, default=4,
+                        help='Profiler files to spread them over - default 4')
+    parser.add_argument('-i', '--insert_ratio', dest='insert_ratio',
+                        type=float, default=0.2,
+                        help='Fraction of inserts - default 0.2')
+    parser.add_argument('-s', '--doc_size', dest='doc_size', type=int,
+                        default=200,
+                        help='Approximate payload bytes per doc - default 200')
+    parser.add_argument('-m', '--op_mix', dest='op_mix',
+                        default=DEFAULT_OP_MIX,
+                        help='Weights of the other op types - default %s' %
+                        DEFAULT_OP_MIX)
+    parser.add_argument('--format', dest='file_format', default='bson',
+                        choices=['bson', 'pickle'],
+                        help='Format of the files to merge - default bson')
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks',
+                        default=",".join(BENCHMARKS),
+                        help='Comma separated benchmarks to run, out of %s' %
+                        ", ".join(BENCHMARKS))
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                        help='Keep the best of that many runs - default 3')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Save the results to this json file')
+    parser.add_argument('-c', '--compare', dest='compare',
+                        help='Compare to the results saved in this json file')
+    parser.add_argument('--max_regression', dest='max_regression',
+                        type=float, default=0.1,
+                        help='With --compare, exit with an error if a '
+                        'benchmark is that much slower - default 0.1')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    params = dict((key, getattr(args, key)) for key in
+                  ("ops", "files", "insert_ratio", "doc_size", "op_mix",
+                   "file_format"))
+    directory = tempfile.mkdtemp(prefix="flashback-benchmark-")
+    try:
+        data = {"directory": directory, "format": args.file_format}
+        for file_format in ("bson", "pickle"):
+            path = os.path.join(directory, file_format)
+            os.mkdir(path)
+            oplog, profilers = generate(
+                path, args.files, args.ops, args.insert_ratio, args.doc_size,
+                args.op_mix, file_format)
+            data[file_format] = {"oplog": oplog, "profilers": profilers}
+
+        results = {}
+        for name in args.benchmarks.split(","):
+            if name not in BENCHMARKS:
+                sys.exit("Unknown benchmark %s" % name)
+            results[name] = run_benchmark(name, data, args.repeat)
+            print "%-16s %10d ops %8.3fs %10.0f op/s %8.1f MB peak" % (
+                name, results[name]["ops"], results[name]["secs"],
+                results[name]["ops_per_sec"], results[name]["peak_rss_mb"])
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        f = open(args.output, "w")
+        json.dump({"params": params, "python": sys.version,
+                   "created_at": time.time(), "results": results}, f,
+                  indent=2, sort_keys=True)
+        f.close()
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        if baseline["params"] != params:
+            print "WARN: %s was run with different parameters: %s" % (
+                args.compare, baseline["params"])
+        regressed = compare(results, baseline["results"],
+                            args.max_regression)
+        if regressed:
+            sys.exit("Regressed: %s" % ", ".join(regressed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+r"""A line oriented file compressed in independent blocks.
+
+Layout:
+
+    MAGIC
+    codec name, "\n"
+    block 0 ... block N-1       each compressed on its own
+    index                       json, see `BlockWriter.close`
+    index offset                8 bytes, little endian
+    END_MAGIC
+
+Blocks only ever end on a line boundary, so every block decompresses to
+whole lines. With the index, a reader can jump to any block, or hand
+different blocks to different processes, without touching the rest of the
+file. Run this script to stream the plain lines back out for the consumers
+that only understand the uncompressed format, e.g. the replayer:
+
+    python blockfile.py OUTPUT > OUTPUT.json
+"""
+import bz2
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+from argparse import ArgumentParser
+
+MAGIC = "FLASHBACK-BLOCKS-1\n"
+END_MAGIC = "FBBLKEND"
+_OFFSET = struct.Struct("<Q")
+
+CODECS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+try:
+    import lzma
+    CODECS["lzma"] = (lzma.compress, lzma.decompress)
+except ImportError:
+    # not part of the python 2 stdlib
+    pass
+
+
+def is_block_file(filename):
+    """Whether `filename` is in the block compressed format"""
+    f = open(filename, "rb")
+    header = f.read(len(MAGIC))
+    f.close()
+    return header == MAGIC
+
+
+class BlockWriter(object):
+
+    """File-like object that compresses whatever is written to it in blocks
+    of about `block_size` uncompressed bytes"""
+
+    def __init__(self, f, codec="zlib", block_size=4 << 20):
+        if codec not in CODECS:
+            raise ValueError("Unknown codec %s, available: %s" %
+                             (codec, ", ".join(sorted(CODECS))))
+        self.f = f
+        self.codec = codec
+        self.compress = CODECS[codec][0]
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+        # the (offset, size, raw_offset, raw_size, first_line, lines) of
+        # every block written so far
+        self.blocks = []
+        self.raw_offset = 0
+        self.lines = 0
+        f.write(MAGIC)
+        f.write(codec + "\n")
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.block_size:
+            data = "".join(self.pending)
+            # keep the partial last line for the next block
+            cut = data.rfind("\n") + 1
+            self.pending = [data[cut:]]
+            self.pending_size = len(data) - cut
+            self._write_block(data[:cut])
+
+    def _write_block(self, data):
+        if not data:
+            return
+        compressed = self.compress(data)
+        lines = data.count("\n")
+        self.blocks.append((self.f.tell(), len(compressed), self.raw_offset,
+                            len(data), self.lines, lines))
+        self.f.write(compressed)
+        self.raw_offset += len(data)
+        self.lines += lines
+
+    def tell(self):
+        """Position in the uncompressed stream"""
+        return self.raw_offset + self.pending_size
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        """Write the pending data and the index"""
+        self._write_block("".join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+        index_offset = self.f.tell()
+        self.f.write(json.dumps({"codec": self.codec, "blocks": self.blocks}))
+        self.f.write(_OFFSET.pack(index_offset))
+        self.f.write(END_MAGIC)
+        self.f.close()
+
+
+class BlockReader(object):
+
+    """Random access to the blocks of a block compressed file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a block compressed file" % filename)
+        trailer_size = _OFFSET.size + len(END_MAGIC)
+        self.f.seek(-trailer_size, os.SEEK_END)
+        trailer = self.f.read(trailer_size)
+        if trailer[_OFFSET.size:] != END_MAGIC:
+            raise ValueError("%s is truncated, its block index is missing" %
+                             filename)
+        index_offset = _OFFSET.unpack(trailer[:_OFFSET.size])[0]
+        index_end = os.fstat(self.f.fileno()).st_size - trailer_size
+        self.f.seek(index_offset)
+        index = json.loads(self.f.read(index_end - index_offset))
+        self.codec = str(index["codec"])
+        self.decompress = CODECS[self.codec][1]
+        self.blocks = index["blocks"]
+
+    def read_block(self, index):
+        """Return the uncompressed content of the `index`-th block"""
+        offset, size = self.blocks[index][:2]
+        self.f.seek(offset)
+        return self.decompress(self.f.read(size))
+
+    def find_block(self, raw_offset):
+        """Return the index of the block holding `raw_offset` of the
+        uncompressed stream, or None past the end"""
+        low, high = 0, len(self.blocks)
+        while low < high:
+            mid = (low + high) // 2
+            block = self.blocks[mid]
+            if raw_offset >= block[2] + block[3]:
+                low = mid + 1
+            else:
+                high = mid
+        return low if low < len(self.blocks) else None
+
+    def iter_blocks(self, start=0, workers=1):
+        """Yield the uncompressed blocks in order, starting from `start`.
+        With several `workers`, blocks are decompressed in parallel."""
+        indexes = xrange(start, len(self.blocks))
+        if workers == 1:
+            for index in indexes:
+                yield self.read_block(index)
+            return
+        pool = multiprocessing.Pool(workers)
+        try:
+            tasks = ((self.filename, self.codec, self.blocks[index][:2])
+                     for index in indexes)
+            for data in pool.imap(_read_block, tasks):
+                yield data
+        finally:
+            pool.close()
+            pool.join()
+
+    def iter_lines(self, start=0, workers=1):
+        """Yield the lines, starting from the `start`-th block"""
+        for data in self.iter_blocks(start, workers):
+            for line in data.splitlines(True):
+                yield line
+
+    def close(self):
+        self.f.close()
+
+
+def _read_block(task):
+    """Decompress one block in a worker process"""
+    filename, codec, (offset, size) = task
+    f = open(filename, "rb")
+    f.seek(offset)
+    data = f.read(size)
+    f.close()
+    return CODECS[codec][1](data)
+
+
+def open_lines(filename):
+    """Return the lines of a recorded output file, compressed or not"""
+    if is_block_file(filename):
+        return BlockReader(filename).iter_lines()
+    return open(filename, "rb")
+
+
+def get_args():
+    parser = ArgumentParser(
+        description='Write the plain lines of a block compressed file to '
+        'stdout')
+    parser.add_argument('filename', help='The block compressed file',
+                        metavar='FILE')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Decompress with this many worker processes - '
+                        'default 1', metavar='JOBS')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    reader = BlockReader(args.filename)
+    for data in reader.iter_blocks(workers=args.jobs):
+        sys.stdout.write(data)
+    reader.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Detect the docs a capped source lost before its tailer read them.
+
+`system.profile` and the oplog are capped collections: a tailer that falls
+behind finds its next docs overwritten. The server kills its cursor
+("CappedPositionLost") and `failover.ResumableTailer` reopens it after the
+last doc received, which skips whatever was overwritten in between, and
+the recording carries on showing less load than the server saw.
+
+A `LossTracker` compares where its tailer is with the oldest doc the source
+still holds: right after the cursor is reopened, and every few seconds from
+the recorder. If the source is full, and so drops its oldest docs as new
+ones come, the docs in between are lost; how many is estimated from the
+rate the tailer was receiving them at. The totals end up in
+OUTPUT_FILE.meta.json.
+"""
+import threading
+from datetime import timedelta
+import pymongo
+import utils
+
+# the error of a tailable cursor whose next doc was overwritten
+CAPPED_POSITION_LOST = 136
+# a capped collection this full drops docs
+FULL_RATIO = 0.9
+
+
+def oldest_ts(collection):
+    """The ts of the oldest doc of a capped collection, as a naive UTC
+    datetime, None if it is empty"""
+    for doc in collection.find({}, {"ts": 1}).sort("$natural", 1).limit(1):
+        return utils.ts_to_datetime(doc["ts"])
+    return None
+
+
+def is_full(collection):
+    """Whether a capped collection is full, and so drops its oldest docs as
+    new ones come. Assumed so if that cannot be told."""
+    try:
+        stats = collection.database.command("collstats", collection.name)
+    except pymongo.errors.PyMongoError:
+        return True
+    if stats.get("max") and stats.get("count", 0) >= stats["max"]:
+        return True
+    max_size = stats.get("maxSize")
+    return not max_size or stats.get("size", 0) >= FULL_RATIO * max_size
+
+
+def is_position_lost(error):
+    """Whether a cursor died of falling behind its capped collection"""
+    return isinstance(error, pymongo.errors.OperationFailure) and \
+        (error.code == CAPPED_POSITION_LOST or
+         "CappedPositionLost" in str(error))
+
+
+class LossTracker(object):
+
+    """What the source of a `failover.ResumableTailer` lost so far"""
+
+    def __init__(self, name, start, margin_secs=5):
+        """
+        @param start: the time the tailer starts reading from (utc): the
+            docs since then are to be recorded.
+        @param margin_secs: a tailer that found its cursor drained is
+            assumed to have read everything older than this many seconds
+            before.
+        """
+        self.name = name
+        self.margin = timedelta(seconds=margin_secs)
+        self.lock = threading.Lock()
+        # the losses are counted up to there
+        self.counted_until = start
+        # the host of the source at the last check
+        self.host = None
+        self.lost_secs = 0.0
+        # estimated
+        self.lost_ops = 0
+        # times the source was found overwritten past the tailer
+        self.wraps = 0
+        # cursors killed for falling behind
+        self.invalidated_cursors = 0
+
+    def position(self, tailer):
+        """The time up to which `tailer` has read its source"""
+        position = self.counted_until
+        if tailer.resume_after is not None:
+            position = max(position,
+                           utils.ts_to_datetime(tailer.resume_after))
+        if tailer.drained_at is not None:
+            position = max(position, tailer.drained_at - self.margin)
+        return position
+
+    @staticmethod
+    def rate(tailer):
+        """The docs per second `tailer` received, over the time they span"""
+        if tailer.first_ts is None or tailer.resume_after is None:
+            return 0.0
+        span = (utils.ts_to_datetime(tailer.resume_after) -
+                utils.ts_to_datetime(tailer.first_ts)).total_seconds()
+        return tailer.received / span if span > 0 else 0.0
+
+    def check(self, tailer):
+        """Count what the source of `tailer` lost since the last check.
+        @return: the seconds of docs found lost."""
+        collection = tailer.collection
+        if collection is None:
+            # checked once it is reopened
+            return 0.0
+        try:
+            oldest = oldest_ts(collection)
+        except pymongo.errors.PyMongoError, e:
+            utils.LOG.debug("source %s: cannot check for lost docs: %s",
+                            self.name, e)
+            return 0.0
+        if oldest is None:
+            return 0.0
+        with self.lock:
+            host = tailer.route.host
+            moved, self.host = \
+                self.host is not None and host != self.host, host
+            position = self.position(tailer)
+            if moved:
+                # another server: its capped collection has another history,
+                # only what it loses from now on counts
+                self.counted_until = max(position, oldest)
+                return 0.0
+            if oldest <= position or not is_full(collection):
+                # nothing the tailer did not read was overwritten
+                return 0.0
+            lost_secs = (oldest - position).total_seconds()
+            lost_ops = int(round(lost_secs * self.rate(tailer)))
+            self.counted_until = oldest
+            self.lost_secs += lost_secs
+            self.lost_ops += lost_ops
+            self.wraps += 1
+        utils.LOG.error("source %s: %s was overwritten past what was read, "
+                        "~%d ops over %.1fs are lost", self.name,
+                        getattr(collection, "full_name", collection),
+                        lost_ops, lost_secs)
+        return lost_secs
+
+    def summary(self):
+        """The losses, for the metadata"""
+        return {"lost_secs": round(self.lost_secs, 3),
+                "estimated_lost_ops": self.lost_ops,
+                "wraps": self.wraps,
+                "invalidated_cursors": self.invalidated_cursors}
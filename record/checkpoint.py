@@ -0,0 +1,106 @@
+"""Periodic checkpoints of a recording, to resume it after a crash.
+
+A checkpoint is a json file holding what is needed to carry on a recording
+that died: its time range, where its files are, and for every source the
+size its file had once flushed, the ts of the last doc written there and
+how many docs had that ts. Resuming truncates each file to its last
+complete record and restarts each tailer right after the last doc it
+wrote.
+"""
+import os
+import time
+from bson import json_util
+from datetime import datetime
+import segments
+import spool
+import timing
+import utils
+
+SUFFIX = ".checkpoint"
+
+
+def checkpoint_filename(output_file):
+    return output_file + SUFFIX
+
+
+class Checkpointer(object):
+
+    """Saves the checkpoints of a recording"""
+
+    def __init__(self, filename, recording, interval_secs=10):
+        """
+        @param recording: json-able dict describing the recording, saved
+            along with the state of its files.
+        """
+        self.filename = filename
+        self.recording = recording
+        self.interval_secs = interval_secs
+        self.last_saved = time.time()
+
+    def maybe_save(self, files):
+        """Save a checkpoint of `files` if the last one is old enough"""
+        if time.time() - self.last_saved >= self.interval_secs:
+            self.save(files)
+
+    def save(self, files):
+        """Save a checkpoint of `files`, a `spool.WriterGroup` or alike"""
+        timer = timing.stage("record.checkpoint")
+        if timer:
+            start = timing.clock()
+        checkpoint = dict(self.recording)
+        checkpoint["sources"] = files.checkpoint()
+        checkpoint["saved_at"] = utils.now_in_utc_secs()
+        # never leave a half written checkpoint behind
+        tmp_filename = self.filename + ".tmp"
+        f = open(tmp_filename, "w")
+        f.write(json_util.dumps(checkpoint, indent=2))
+        f.close()
+        os.rename(tmp_filename, self.filename)
+        self.last_saved = time.time()
+        if timer:
+            timer.add(timing.clock() - start)
+
+    def remove(self):
+        """The recording is complete, there is nothing left to resume"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def load(filename):
+    return json_util.loads(open(filename).read())
+
+
+def recover_files(checkpoint):
+    """Truncate the files of a checkpointed recording to their last complete
+    record. A rotated file is recovered from its checkpointed segment on,
+    the segments started since then included (see `segments`).
+    @return: maps the source names to the ts their tailer should resume
+        after and how many docs it wrote at that ts, for the sources that
+        wrote anything."""
+    resume_ts = {}
+    for name, filename in checkpoint["filenames"].iteritems():
+        source = checkpoint["sources"].get(name, {})
+        first = source.get("segment", 0)
+        last = (None, 0)
+        for index in xrange(first, max(first + 1,
+                                       len(segments.segment_files(filename)))):
+            segment = segments.segment_filename(filename, index)
+            offset = source.get("offset", 0) if index == first else 0
+            # a file shorter than checkpointed lost flushed data, rescan it
+            # all
+            intact = os.path.exists(segment) and \
+                os.path.getsize(segment) >= offset
+            if index == first and intact and offset:
+                ts = source.get("ts")
+                if isinstance(ts, datetime):
+                    # json loads the datetimes time zone aware, the docs
+                    # have naive ones
+                    ts = utils.ts_to_datetime(ts)
+                # the checkpoints of older recorders have no count
+                last = (ts, source.get("ts_docs", 1))
+            last = spool.recover(segment, offset if intact else 0, *last)
+        if last[0] is not None:
+            resume_ts[name] = last
+        utils.LOG.info("source %s: resuming %s after %s, %d docs at that ts",
+                       name, filename, last[0], last[1])
+    return resume_ts
@@ -5,3 +5,9 @@ LOCAL_DB = "local"
 OPLOG_COLLECTION = "oplog.rs"
 PROFILER_COLLECTION = "system.profile"
 INDEX_COLLECTION = "system.indexes"
+
+# The fields `merge.dump_op` may keep from a profiler or oplog entry, the
+# tailers fetch nothing else.
+PROFILER_FIELDS = ["ts", "ns", "op", "query", "ntoskip", "ntoreturn",
+                   "updateobj", "command"]
+OPLOG_FIELDS = ["ts", "ns", "op", "o", "o2"]
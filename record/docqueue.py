@@ -0,0 +1,113 @@
+"""The queue between the tailers and the writer of the recorder"""
+import threading
+import time
+from collections import deque
+
+# how often a producer blocked on a full queue checks whether to give up
+STOP_CHECK_SECS = 1
+
+
+class Stopped(Exception):
+
+    """The queue takes no more items: its consumer is gone, or the recording
+    is stopping while the queue is full"""
+
+
+class DocQueue(object):
+
+    """A fifo queue bounded both in items and in (estimated) bytes.
+
+    Producers block in `put` while the queue is full, which is how a slow
+    disk pushes back on the tailers instead of growing the recorder's memory
+    without limit. The consumer takes items in batches, paying for the lock
+    once per batch rather than once per item.
+
+    Documents do not know their encoded size, so the byte bound is enforced
+    with a running average of the sizes the writer reports through
+    `record_written`.
+    """
+
+    def __init__(self, max_items=100000, max_bytes=256 << 20,
+                 avg_item_bytes=1024, stop=None):
+        """
+        @param stop: returns True when the producers blocked on a full
+            queue should give up, e.g. once the recording is over.
+        """
+        self.stop = stop
+        # set by the consumer once it is done with the queue
+        self.closed = False
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.avg_item_bytes = avg_item_bytes
+        self.items = deque()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.not_empty = threading.Condition(self.lock)
+        # accumulated time producers spent blocked on a full queue
+        self.stall_secs = 0.0
+        self.stalls = 0
+
+    def _full(self):
+        return len(self.items) >= self.max_items or \
+            self.bytes >= self.max_bytes
+
+    def put(self, item):
+        """Add `item`, waiting for room if the queue is full.
+        @return: the seconds spent waiting.
+        @raise Stopped: if the consumer is gone, or `stop` says to give up
+            while the queue is full."""
+        stalled = 0.0
+        with self.not_full:
+            if self.closed:
+                raise Stopped()
+            if self._full():
+                start = time.time()
+                try:
+                    while self._full():
+                        self.not_full.wait(STOP_CHECK_SECS)
+                        if self.closed or (self._full() and
+                                           self.stop is not None and
+                                           self.stop()):
+                            raise Stopped()
+                finally:
+                    stalled = time.time() - start
+                    self.stall_secs += stalled
+                    self.stalls += 1
+            size = self.avg_item_bytes
+            self.items.append((item, size))
+            self.bytes += size
+            self.not_empty.notify()
+        return stalled
+
+    def get_batch(self, max_items, timeout=None):
+        """Remove and return up to `max_items` items, waiting up to `timeout`
+        seconds for the first one. Returns an empty list on timeout."""
+        with self.not_empty:
+            if not self.items and timeout != 0:
+                self.not_empty.wait(timeout)
+            batch = []
+            while self.items and len(batch) < max_items:
+                item, size = self.items.popleft()
+                self.bytes -= size
+                batch.append(item)
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def close(self):
+        """The consumer takes no more items: the producers waiting for room
+        give up"""
+        with self.lock:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def record_written(self, items, nbytes):
+        """The writer encoded `items` items into `nbytes` bytes"""
+        if items:
+            # weigh the history more, a single batch is a noisy sample
+            self.avg_item_bytes = \
+                (3 * self.avg_item_bytes + nbytes / items) / 4 or 1
+
+    def qsize(self):
+        return len(self.items)
@@ -0,0 +1,90 @@
+"""A faster `bson.json_util.dumps`, for the ops written to the merged output.
+
+`json_util.dumps` first copies the whole doc in python, calling
+`json_util.default` on every value, before handing it to `json.dumps`. The
+ops `merge.dump_op` writes are mostly made of plain dicts, lists, strings
+and numbers, plus an ObjectId or a datetime here and there. For those, the
+json C encoder can walk the doc itself and only call `json_util.default` on
+the ObjectIds and datetimes, which gives the same bytes, keys in the same
+order.
+
+Naive datetimes, by far the most common non-json value since every op has a
+`ts`, are converted without going through `json_util.default`.
+
+A doc holding anything else (a Binary or a Code would be encoded as a plain
+string by the C encoder, SON or Int64 subclasses, Timestamps, regexes...)
+goes through `json_util.dumps` as before.
+"""
+import datetime
+import json
+import json.encoder as json_encoder
+from bson import json_util
+from bson.objectid import ObjectId
+
+# the values the C encoder and `json_util.default` encode like
+# `json_util.dumps`, anything else is left to `json_util.dumps`
+_LEAF_TYPES = frozenset([str, unicode, int, long, float, bool, type(None),
+                         ObjectId, datetime.datetime])
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _default(value):
+    """`json_util.default`, faster for naive datetimes"""
+    if type(value) is datetime.datetime and value.tzinfo is None:
+        delta = value - _EPOCH
+        return {"$date": (delta.days * 86400 + delta.seconds) * 1000 +
+                delta.microseconds // 1000}
+    return json_util.default(value)
+
+
+if json_encoder.c_make_encoder is not None:
+    # what `json.JSONEncoder.encode` sets up on every call, done once
+    _c_encode = json_encoder.c_make_encoder(
+        None, _default, json_encoder.encode_basestring_ascii, None, ": ",
+        ", ", False, False, True)
+
+    def _encode(doc):
+        return "".join(_c_encode(doc, 0))
+else:
+    _encode = json.JSONEncoder(default=_default).encode
+
+
+def _is_plain_dict(doc):
+    for value in doc.itervalues():
+        value_type = type(value)
+        if value_type in _LEAF_TYPES:
+            continue
+        if value_type is dict:
+            if not _is_plain_dict(value):
+                return False
+        elif value_type is list:
+            if not _is_plain_list(value):
+                return False
+        else:
+            return False
+    return True
+
+
+def _is_plain_list(values):
+    for value in values:
+        value_type = type(value)
+        if value_type in _LEAF_TYPES:
+            continue
+        if value_type is dict:
+            if not _is_plain_dict(value):
+                return False
+        elif value_type is list:
+            if not _is_plain_list(value):
+                return False
+        else:
+            return False
+    return True
+
+
+def dumps(doc):
+    """The same string as `json_util.dumps(doc)`, for a dict `doc`"""
+    if type(doc) is dict and _is_plain_dict(doc):
+        return _encode(doc)
+    return json_util.dumps(doc)
+
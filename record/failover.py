@@ -0,0 +1,341 @@
+"""Tailers that survive a replica set election.
+
+A tailing cursor dies when its server steps down, restarts or drops the
+connection, and the recording of its source used to stop there, along with
+every other source's. A `ResumableTailer` instead reopens its cursor right
+after the last doc it returned, backing off while that fails, until the
+recording ends.
+
+Where a cursor is reopened is up to its route:
+
+* `FixedRoute` reopens it with the same client, for the servers the
+  recorder was given explicitly: a client connected to a replica set follows
+  its primary by itself.
+* `PrimaryRoute` follows the primary of a shard, as found by a `Topology`
+  that asks the mongos again whenever a cursor dies, and every few seconds
+  since a primary that steps down may keep its cursors open. When the
+  primary moved, a profiler route first reads what is left in the old
+  primary's `system.profile` after the last doc received, then carries on
+  with the new primary. The oplog needs no such catch up: the new primary's
+  oplog has the old one's writes.
+"""
+import threading
+import time
+from datetime import datetime
+import pymongo
+import captureloss
+import utils
+
+
+class SourceDown(Exception):
+
+    """The cursor of a `ResumableTailer` is gone, it is being reopened"""
+
+    def __init__(self, error=None):
+        super(SourceDown, self).__init__(error)
+        # the pymongo error that took the cursor down, if any
+        self.error = error
+
+
+class Topology(object):
+
+    """The members of every shard, as last discovered"""
+
+    def __init__(self, discover, shards, min_refresh_secs=1):
+        """
+        @param discover: returns {shard: {"primary": host, "secondaries":
+            [host, ...]}}, or None if the topology cannot be found.
+        @param shards: the topology found at startup, in the same form.
+        @param min_refresh_secs: the mongos is asked at most that often.
+        """
+        self.discover = discover
+        self.shards = shards
+        self.min_refresh_secs = min_refresh_secs
+        self.refreshed_at = time.time()
+        self.lock = threading.Lock()
+
+    def primary(self, shard):
+        return self.shards.get(shard, {}).get("primary")
+
+    def refresh(self, force=False):
+        """Discover the topology again, unless it just was"""
+        with self.lock:
+            now = time.time()
+            if not force and now - self.refreshed_at < self.min_refresh_secs:
+                return
+            self.refreshed_at = now
+            try:
+                shards = self.discover()
+            except Exception, e:
+                utils.LOG.warning("Cannot rediscover the topology: %s", e)
+                return
+            if not shards:
+                return
+            for shard in sorted(shards):
+                old = self.primary(shard)
+                new = shards[shard].get("primary")
+                if old != new:
+                    utils.LOG.warning("shard %s: the primary moved from %s "
+                                      "to %s", shard, old, new)
+            self.shards = shards
+
+
+class FixedRoute(object):
+
+    """Reopens a cursor with the same client"""
+
+    def __init__(self, client, host, open_cursor):
+        """
+        @param open_cursor: opens the cursor of the source, called with the
+            client and the ts to resume after, None to start afresh.
+        """
+        self.client = client
+        self.host = host
+        self.open_cursor = open_cursor
+
+    def open(self, resume_after, died):
+        return self.open_cursor(self.client, resume_after)
+
+    def moved(self):
+        return False
+
+
+class PrimaryRoute(object):
+
+    """Reopens a cursor on the current primary of a shard"""
+
+    def __init__(self, topology, shard, client, host, connect, open_cursor,
+                 catch_up=False):
+        """
+        @param client: the client of `host`, the primary at startup.
+        @param connect: returns the client of a host, called with the host
+            and whether to connect to it directly rather than to the
+            replica set.
+        @param open_cursor: see `FixedRoute`.
+        @param catch_up: read what is left on the old primary when the
+            cursor died there, before moving to the new one.
+        """
+        self.topology = topology
+        self.shard = shard
+        self.client = client
+        self.host = host
+        self.connect = connect
+        self.open_cursor = open_cursor
+        self.catch_up = catch_up
+        self.catching_up = False
+
+    def open(self, resume_after, died):
+        if died:
+            self.topology.refresh()
+        primary = self.topology.primary(self.shard)
+        if primary is None:
+            raise pymongo.errors.AutoReconnect(
+                "shard %s has no primary" % self.shard)
+        if primary != self.host and died and self.catch_up and \
+                not self.catching_up and resume_after is not None:
+            # `moved` stays true, the cursor is reopened on the new primary
+            # once it has read everything
+            self.catching_up = True
+            try:
+                cursor = self.open_cursor(self.connect(self.host, True),
+                                          resume_after)
+                utils.LOG.info("shard %s: catching up with %s, the old "
+                               "primary", self.shard, self.host)
+                return cursor
+            except pymongo.errors.PyMongoError, e:
+                utils.LOG.error("shard %s: cannot catch up with %s, the "
+                                "ops it profiled after %s are lost: %s",
+                                self.shard, self.host, resume_after, e)
+        self.catching_up = False
+        if primary != self.host:
+            self.client = self.connect(primary, False)
+            self.host = primary
+        return self.open_cursor(self.client, resume_after)
+
+    def moved(self):
+        primary = self.topology.primary(self.shard)
+        return primary is not None and primary != self.host
+
+
+class ResumableTailer(object):
+
+    """A tailing cursor that is reopened after the last doc it returned
+    whenever it dies, or its route moved to another host.
+
+    `next` raises `SourceDown` while the cursor is being reopened, and
+    `StopIteration` only when the cursor has nothing more to offer. A
+    tailable cursor whose query matches nothing is killed by the server at
+    once: it has run dry rather than failed, it is reopened on the next
+    call without backing off.
+    """
+
+    def __init__(self, name, route, resume_after=None, reconnect=True,
+                 min_retry_secs=1, max_retry_secs=30, loss=None,
+                 resume_docs=0):
+        """
+        @param resume_after: the ts to resume after, None to start afresh.
+        @param resume_docs: how many docs at `resume_after` were read
+            already. The profiler ts are not unique, its cursors are
+            reopened at `resume_after` (see `utils.get_profiler_tailer`) and
+            skip those docs again.
+        @param reconnect: if false, the tailer is done once its first
+            cursor is.
+        @param max_retry_secs: the longest wait between two attempts to
+            reopen the cursor.
+        @param loss: a `captureloss.LossTracker`, checked whenever the
+            cursor is reopened.
+        """
+        self.name = name
+        self.route = route
+        self.resume_after = resume_after
+        self.resume_docs = resume_docs
+        # the docs at `resume_after` the cursor still has to skip
+        self.skip = resume_docs
+        self.reconnect = reconnect
+        self.min_retry_secs = min_retry_secs
+        self.max_retry_secs = max_retry_secs
+        # how many times the cursor was reopened
+        self.reopens = 0
+        # failed attempts since the cursor last returned a doc
+        self.failures = 0
+        self.retry_at = 0
+        self.died = False
+        # the cursor died once it ran dry
+        self.drained = False
+        self.closed = False
+        self.loss = loss
+        # the docs returned, the ts of the first, and the last time (utc) a
+        # live cursor had nothing more
+        self.received = 0
+        self.first_ts = None
+        self.drained_at = None
+        self.cursor = None
+        try:
+            self.cursor = route.open(resume_after, False)
+        except pymongo.errors.PyMongoError, e:
+            # `next` reopens it, backing off as after any failed attempt
+            self._back_off(time.time())
+            utils.LOG.warning("source %s: cannot open the cursor, %s: %s",
+                              name, "next attempt in %.0fs" % min_retry_secs
+                              if reconnect else "giving up", e)
+
+    @property
+    def alive(self):
+        """Whether docs may still come"""
+        return not self.closed and \
+            (self.reconnect or self.cursor is not None)
+
+    @property
+    def collection(self):
+        return getattr(self.cursor, "collection", None)
+
+    def next(self):
+        cursor = self.cursor
+        if cursor is None or not cursor.alive:
+            cursor = self._reopen()
+        try:
+            doc = cursor.next()
+            while self.skip and doc["ts"] == self.resume_after:
+                self.skip -= 1
+                doc = cursor.next()
+        except StopIteration:
+            if not cursor.alive and not self.reconnect:
+                self._drop("its cursor died on %s" % self.route.host, True)
+                raise SourceDown()
+            if not cursor.alive:
+                # nothing left to read, not a failure
+                self._close_cursor()
+                self.drained = True
+            elif self.route.moved():
+                # drained, what comes next is on another host
+                self._drop("%s is no longer the primary" % self.route.host,
+                           False)
+                raise SourceDown()
+            self.drained_at = datetime.utcnow()
+            # the server answered
+            self.failures = 0
+            raise
+        except pymongo.errors.PyMongoError, e:
+            if self.loss is not None and captureloss.is_position_lost(e):
+                self.loss.invalidated_cursors += 1
+            self._drop("%s: %s" % (self.route.host, e), True)
+            raise SourceDown(e)
+        self.skip = 0
+        if doc["ts"] == self.resume_after:
+            self.resume_docs += 1
+        else:
+            self.resume_after = doc["ts"]
+            self.resume_docs = 1
+        if self.first_ts is None:
+            self.first_ts = doc["ts"]
+        self.received += 1
+        self.failures = 0
+        return doc
+
+    __next__ = next
+
+    def _drop(self, reason, died):
+        utils.LOG.warning("source %s: %s, %s", self.name, reason,
+                          "reopening it after %s" % self.resume_after
+                          if self.reconnect else "giving up")
+        self._close_cursor()
+        self.died = died
+        if not died:
+            # a move is no failure, no need to wait
+            self.retry_at = 0
+
+    def _reopen(self):
+        """Open a new cursor and return it, or raise `SourceDown` if it is
+        not time yet or that failed"""
+        if self.closed or not self.reconnect:
+            raise SourceDown()
+        now = time.time()
+        if now < self.retry_at:
+            raise SourceDown()
+        self._close_cursor()
+        drained, self.drained = self.drained, False
+        if not drained:
+            # backs off while the attempts fail or the cursors die at once
+            self._back_off(now)
+        try:
+            self.cursor = self.route.open(self.resume_after, self.died)
+        except pymongo.errors.PyMongoError, e:
+            if drained:
+                self._back_off(now)
+            utils.LOG.warning("source %s: cannot reopen the cursor, next "
+                              "attempt in %.0fs: %s", self.name,
+                              self.retry_at - now, e)
+            raise SourceDown(e)
+        self.skip = self.resume_docs
+        if drained:
+            # as if the same cursor was polled again
+            utils.LOG.debug("source %s: reopened the drained cursor on %s",
+                            self.name, self.route.host)
+            return self.cursor
+        self.died = False
+        self.reopens += 1
+        utils.LOG.info("source %s: reopened on %s after %s", self.name,
+                       self.route.host, self.resume_after)
+        if self.loss is not None:
+            # before reading on, past what may have been overwritten
+            self.loss.check(self)
+        return self.cursor
+
+    def _back_off(self, now):
+        """Wait longer before the next attempt, while they fail"""
+        self.retry_at = now + min(self.max_retry_secs,
+                                  self.min_retry_secs * 2 ** self.failures)
+        self.failures += 1
+
+    def _close_cursor(self):
+        cursor, self.cursor = self.cursor, None
+        if cursor is not None:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """Stop for good"""
+        self.closed = True
+        self._close_cursor()
@@ -0,0 +1,531 @@
+"""An in-process stand-in for a sharded MongoDB cluster, to load test the
+recorder without one.
+
+Only the part of the pymongo surface the recorder uses is there: clients
+indexed by database and collection, tailable `find` cursors on
+`system.profile` and `local.oplog.rs` with the few query operators the
+recorder's criteria use, and `connPoolStats` on the mongos for
+`MongoQueryRecorder.get_topology`. Every shard is a replica set whose
+primary, "shardN-a:27017" at first, gets the ops; its secondaries only share
+its oplog. `FakeCluster.step_down` hands the primary over to the next member,
+like an election.
+
+The collections are capped: a cursor that falls more than `capacity` docs
+behind loses the docs that were overwritten, and they are counted in
+`FakeCluster.lost`. The cursor carries on from the oldest doc left, or is
+killed with a "CappedPositionLost" error as by a real server if the cluster
+is made with `kill_lost_cursors`.
+
+A `LoadGenerator` thread inserts the ops at a given, possibly bursty, rate.
+It runs in the recorder's process, so it competes with the recorder for the
+interpreter: the rates measured against it are a lower bound.
+"""
+import datetime
+import itertools
+import random
+import re
+import threading
+import time
+import pymongo
+from bson.objectid import ObjectId
+from bson.timestamp import Timestamp
+import constants
+import utils
+
+# how long a drained cursor waits for new docs with `await_data`
+AWAIT_DATA_SECS = 0.1
+
+
+class CappedCollection(object):
+
+    """The `capacity` most recent docs inserted, in a ring buffer"""
+
+    def __init__(self, cluster, name, capacity):
+        self.cluster = cluster
+        self.name = name
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        # number of docs ever inserted
+        self.end = 0
+        self.cond = threading.Condition()
+
+    def insert(self, doc):
+        with self.cond:
+            self.ring[self.end % self.capacity] = doc
+            self.end += 1
+            self.cond.notify_all()
+
+    def find(self, spec=None, fields=None, tailable=False, await_data=False,
+             **kwargs):
+        return FakeCursor(self, spec or {}, fields, tailable, await_data)
+
+    @property
+    def database(self):
+        return _StatsDatabase(self)
+
+    def __str__(self):
+        return self.name
+
+
+class _StatsDatabase(object):
+
+    """The database of a `CappedCollection`, as far as `collstats` on it
+    goes"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def command(self, name, *args, **kwargs):
+        if name != "collstats":
+            raise ValueError("Unsupported command %s" % name)
+        collection = self.collection
+        with collection.cond:
+            count = min(collection.end, collection.capacity)
+        return {"capped": True, "count": count, "max": collection.capacity}
+
+
+class _CollectionView(object):
+
+    """A `CappedCollection` as read through the client of `host`"""
+
+    def __init__(self, collection, host):
+        self.collection = collection
+        self.host = host
+
+    def find(self, spec=None, fields=None, tailable=False, await_data=False,
+             **kwargs):
+        return FakeCursor(self.collection, spec or {}, fields, tailable,
+                          await_data, self.host)
+
+    def __str__(self):
+        return self.collection.name
+
+
+class FakeCursor(object):
+
+    """A cursor on a `CappedCollection`, tailable or not. A cursor opened
+    through a host dies when the host drops its connections. As on a real
+    server, a tailable cursor whose first batch is empty dies too."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, collection, spec, fields, tailable, await_data,
+                 host=None):
+        self.collection = collection
+        self.host = host
+        self.connection = collection.cluster.connections.get(host)
+        self.matcher = _compile(spec)
+        self.fields = None
+        if fields:
+            self.fields = [name for name, wanted in fields.iteritems()
+                           if wanted]
+        self.tailable = tailable
+        self.await_data = await_data
+        self.alive = True
+        # nothing was returned yet
+        self.first_batch = True
+        # docs left to return, see `limit`
+        self.remaining = None
+        self.cursor_id = next(self._ids)
+        with collection.cond:
+            self.position = max(0, collection.end - collection.capacity)
+
+    def add_option(self, option):
+        return self
+
+    def sort(self, key, direction=1):
+        if key != "$natural" or direction != 1:
+            raise ValueError("Only the natural order is supported")
+        return self
+
+    def limit(self, count):
+        self.remaining = count
+        return self
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        collection = self.collection
+        waited = False
+        while self.alive and self.remaining != 0:
+            if self.host is not None and \
+                    collection.cluster.connections[self.host] != \
+                    self.connection:
+                self.alive = False
+                raise pymongo.errors.AutoReconnect(
+                    "connection to %s closed" % self.host)
+            with collection.cond:
+                oldest = max(0, collection.end - collection.capacity)
+                if self.position < oldest:
+                    collection.cluster.lose(oldest - self.position)
+                    self.position = oldest
+                    if collection.cluster.kill_lost_cursors:
+                        self.alive = False
+                        raise pymongo.errors.OperationFailure(
+                            "CappedPositionLost: %s was overwritten past "
+                            "cursor %d" % (collection, self.cursor_id), 136)
+                if self.position == collection.end:
+                    if not self.tailable or self.first_batch:
+                        self.alive = False
+                        break
+                    if not self.await_data or waited:
+                        break
+                    collection.cond.wait(AWAIT_DATA_SECS)
+                    waited = True
+                    continue
+                doc = collection.ring[self.position % collection.capacity]
+                self.position += 1
+            if self.matcher(doc):
+                self.first_batch = False
+                if self.remaining is not None:
+                    self.remaining -= 1
+                if self.fields is None:
+                    return doc
+                return dict((name, doc[name]) for name in self.fields
+                            if name in doc)
+        raise StopIteration
+
+    __next__ = next
+
+    def close(self):
+        self.alive = False
+
+
+def _compile(spec):
+    """Return a predicate for the docs matching the query `spec`. Only the
+    operators the recorder uses are supported."""
+    checks = [(field, _compile_condition(condition))
+              for field, condition in spec.iteritems() if field != "$or"]
+    alternatives = [_compile(alternative)
+                    for alternative in spec.get("$or", [])]
+
+    def matches(doc):
+        for field, check in checks:
+            if not check(doc.get(field)):
+                return False
+        return not alternatives or \
+            any(alternative(doc) for alternative in alternatives)
+    return matches
+
+
+def _comparable(value):
+    if isinstance(value, datetime.datetime):
+        return utils.ts_to_datetime(value)
+    return value
+
+
+def _compile_condition(condition):
+    if not (isinstance(condition, dict) and condition and
+            all(key.startswith("$") for key in condition)):
+        return lambda value: value == condition
+
+    checks = []
+    for operator, argument in condition.iteritems():
+        if operator == "$in":
+            checks.append(lambda value, arg=argument: value in arg)
+        elif operator == "$nin":
+            checks.append(lambda value, arg=argument: value not in arg)
+        elif operator == "$regex":
+            pattern = re.compile(argument)
+            checks.append(lambda value, pattern=pattern:
+                          value is not None and
+                          pattern.search(value) is not None)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            compare = {
+                "$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b,
+                "$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b,
+            }[operator]
+            checks.append(
+                lambda value, arg=_comparable(argument), compare=compare:
+                value is not None and compare(_comparable(value), arg))
+        else:
+            raise ValueError("Unsupported query operator %s" % operator)
+    return lambda value: all(check(value) for check in checks)
+
+
+class _FakeDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __getitem__(self, collection_name):
+        return _CollectionView(
+            self.client.cluster.collection(self.client.host, self.name,
+                                           collection_name),
+            self.client.host)
+
+    def command(self, name, *args, **kwargs):
+        if name == "connPoolStats":
+            return self.client.cluster.conn_pool_stats()
+        raise ValueError("Unsupported command %s" % name)
+
+    def authenticate(self, user, password):
+        return True
+
+
+class FakeClient(object):
+
+    """The `MongoClient` of one host of a `FakeCluster`"""
+
+    def __init__(self, cluster, host):
+        self.cluster = cluster
+        self.host = host
+        self.admin = _FakeDatabase(self, "admin")
+
+    def __getitem__(self, name):
+        return _FakeDatabase(self, name)
+
+    def kill_cursors(self, cursor_ids):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCluster(object):
+
+    """Shards, each a replica set of `members` hosts, holding `databases`"""
+
+    MONGOS = "mongos:27017"
+
+    def __init__(self, shards=2, databases=("db0",), members=2,
+                 profile_capacity=10000, oplog_capacity=1000000,
+                 kill_lost_cursors=False):
+        """
+        @param profile_capacity: docs a `system.profile` collection holds,
+            about 1MB worth by default in MongoDB.
+        @param kill_lost_cursors: kill the cursors that fall behind, see
+            above.
+        """
+        self.kill_lost_cursors = kill_lost_cursors
+        self.databases = list(databases)
+        self.profile_capacity = profile_capacity
+        self.shards = ["shard%d" % index for index in xrange(shards)]
+        self.hosts = dict(
+            (shard, ["%s-%s:27017" % (shard, chr(ord("a") + member))
+                     for member in xrange(members)])
+            for shard in self.shards)
+        self.oplogs = dict(
+            (shard, CappedCollection(self, "%s.local.oplog.rs" % shard,
+                                     oplog_capacity))
+            for shard in self.shards)
+        self.profiles = {}
+        # the index of the primary among the hosts of every shard, None
+        # during an election
+        self.primaries = dict.fromkeys(self.shards, 0)
+        # bumped when a host drops its connections
+        self.connections = dict((host, 0) for hosts in self.hosts.values()
+                                for host in hosts)
+        self.lock = threading.Lock()
+        # docs overwritten before a cursor got to them
+        self.lost = 0
+
+    def lose(self, count):
+        with self.lock:
+            self.lost += count
+
+    def client(self, mongodb_uri):
+        """The client of the first host of `mongodb_uri`"""
+        host = mongodb_uri.split("://", 1)[-1].split("/")[0].split(",")[0]
+        return FakeClient(self, host)
+
+    def shard_of(self, host):
+        for shard, hosts in self.hosts.iteritems():
+            if host in hosts:
+                return shard
+        return None
+
+    def collection(self, host, database, name):
+        if database == constants.LOCAL_DB and \
+                name == constants.OPLOG_COLLECTION:
+            return self.oplogs[self.shard_of(host)]
+        key = (host, database, name)
+        with self.lock:
+            if key not in self.profiles:
+                self.profiles[key] = CappedCollection(
+                    self, "%s.%s.%s" % key, self.profile_capacity)
+            return self.profiles[key]
+
+    def primary(self, shard):
+        """The primary host of `shard`, None during an election"""
+        index = self.primaries[shard]
+        return None if index is None else self.hosts[shard][index]
+
+    def step_down(self, shard, election_secs=0, close_connections=True):
+        """Hand the primary of `shard` over to its next member, after
+        `election_secs` without a primary, blocking meanwhile.
+        @param close_connections: whether the old primary drops its
+            connections, killing the cursors opened through it."""
+        with self.lock:
+            old = self.primaries[shard]
+            if old is None:
+                return
+            self.primaries[shard] = None
+            if close_connections:
+                self.connections[self.hosts[shard][old]] += 1
+        if election_secs:
+            time.sleep(election_secs)
+        with self.lock:
+            self.primaries[shard] = (old + 1) % len(self.hosts[shard])
+
+    def conn_pool_stats(self):
+        with self.lock:
+            primaries = dict(self.primaries)
+        return {"replicaSets": dict(
+            (shard, {"hosts": [{"addr": host,
+                                "ismaster": index == primaries[shard],
+                                "secondary": index != primaries[shard]}
+                               for index, host in enumerate(hosts)]})
+            for shard, hosts in self.hosts.iteritems())}
+
+    def recorder_config(self):
+        """The recorder settings to record the whole cluster"""
+        return {
+            "auto_config": True,
+            "auto_config_options": {
+                "mongodb_uri": "mongodb://%s" % self.MONGOS,
+                "auth_db": None, "user": None, "password": None,
+                "use_secondaries": False,
+            },
+            "target_databases": self.databases,
+            "target_collections": None,
+        }
+
+
+class LoadGenerator(object):
+
+    """Inserts ops into a `FakeCluster` from a background thread.
+
+    The rate is `rate` ops/sec, times `burst_factor` during the first
+    `burst_secs` of every `burst_every` seconds.
+    """
+
+    def __init__(self, cluster, rate, burst_factor=1.0, burst_secs=0,
+                 burst_every=10, insert_ratio=0.2,
+                 op_mix=(("query", 4), ("update", 2), ("remove", 1),
+                         ("command", 1)), doc_size=100, seed=1, log_writes=False,
+                 hot_share=None):
+        """
+        @param log_writes: log the updates and removes to the oplog too, as
+            a real server does, for the recordings of the oplog alone. Only
+            the inserts are logged otherwise.
+        @param hot_share: the share of the ops that go to the first
+            database, the others share the rest evenly. None spreads all the
+            ops evenly.
+        """
+        self.cluster = cluster
+        self.rate = rate
+        self.burst_factor = burst_factor
+        self.burst_secs = burst_secs
+        self.burst_every = burst_every
+        self.insert_ratio = insert_ratio
+        self.op_mix = list(op_mix)
+        self.payload = "x" * doc_size
+        self.random = random.Random(seed)
+        self.generated = 0
+        self.log_writes = log_writes
+        self.hot_share = hot_share
+        # ops logged to the oplog
+        self.writes = 0
+        # ops due, including those that found no primary to run on
+        self.attempted = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        # the last oplog (seconds, increment) of every shard
+        self.oplog_clock = dict((shard, (0, 0)) for shard in cluster.shards)
+
+    def rate_at(self, elapsed):
+        if self.burst_secs and elapsed % self.burst_every < self.burst_secs:
+            return self.rate * self.burst_factor
+        return self.rate
+
+    def start(self, duration_secs):
+        self.thread = threading.Thread(target=self._run,
+                                       args=(duration_secs,),
+                                       name="load-generator")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self, duration_secs):
+        start = time.time()
+        due = 0.0
+        last = start
+        while not self.stopped.is_set():
+            now = time.time()
+            if now - start >= duration_secs:
+                break
+            due += (now - last) * self.rate_at(now - start)
+            last = now
+            while self.attempted < int(due):
+                self.attempted += 1
+                self._insert_op()
+            time.sleep(0.005)
+
+    def _insert_op(self):
+        rnd = self.random
+        cluster = self.cluster
+        shard = rnd.choice(cluster.shards)
+        primary = cluster.primary(shard)
+        if primary is None:
+            # the op fails during an election
+            return
+        if self.hot_share is not None and \
+                (len(cluster.databases) == 1 or rnd.random() < self.hot_share):
+            database = cluster.databases[0]
+        elif self.hot_share is not None:
+            database = rnd.choice(cluster.databases[1:])
+        else:
+            database = rnd.choice(cluster.databases)
+        ns = "%s.coll%d" % (database, rnd.randrange(4))
+        now = datetime.datetime.utcnow()
+        # the profiler keeps milliseconds
+        ts = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        if rnd.random() < self.insert_ratio:
+            _id = ObjectId()
+            doc = {"ts": ts, "ns": ns, "op": "insert",
+                   "query": {"_id": _id, "payload": self.payload},
+                   "ninserted": 1, "millis": 0}
+            self._log(shard, {"op": "i", "ns": ns,
+                              "o": {"_id": _id, "payload": self.payload}})
+        else:
+            pick = rnd.random() * sum(weight for _, weight in self.op_mix)
+            for op, weight in self.op_mix:
+                pick -= weight
+                if pick < 0:
+                    break
+            doc = {"ts": ts, "ns": ns, "op": op,
+                   "query": {"_id": self.generated}, "ntoreturn": 0,
+                   "ntoskip": 0, "millis": 1}
+            if op == "update":
+                doc["updateobj"] = {"$set": {"payload": self.payload}}
+                if self.log_writes:
+                    self._log(shard, {"op": "u", "ns": ns,
+                                      "o2": {"_id": self.generated},
+                                      "o": {"$v": 1, "$set": {
+                                          "payload": self.payload}}})
+            elif op == "remove" and self.log_writes:
+                self._log(shard, {"op": "d", "ns": ns,
+                                  "o": {"_id": self.generated}})
+            elif op == "command":
+                doc["command"] = {"count": ns.split(".", 1)[1]}
+        cluster.collection(primary, database,
+                           constants.PROFILER_COLLECTION).insert(doc)
+        self.generated += 1
+
+    def _log(self, shard, entry):
+        """Append `entry` to the oplog of `shard`, with the next ts"""
+        seconds = int(time.time())
+        last_seconds, increment = self.oplog_clock[shard]
+        increment = increment + 1 if seconds == last_seconds else 1
+        self.oplog_clock[shard] = (seconds, increment)
+        entry.update({"ts": Timestamp(seconds, increment), "h": 0, "v": 2})
+        self.cluster.oplogs[shard].insert(entry)
+        self.writes += 1
@@ -0,0 +1,236 @@
+"""Pair the profiler inserts with the oplog docs holding what they inserted.
+
+The profiler leaves out the docs an insert inserted, or truncates them, so
+the merge takes them from the oplog doc of the same insert, found by shard,
+ns and `_id`, see `InsertMatcher`.
+"""
+import utils
+from collections import deque
+from datetime import timedelta
+
+# how far apart in time the oplog and profiler entries of an insert may be
+INSERT_MATCH_WINDOW_SECS = 3
+# the most oplog docs waiting for their insert to be merged, per shard
+INSERT_INDEX_MAX_DOCS = 100000
+
+
+def _hashable(value):
+    """A hashable stand-in for an `_id` that is a document or an array"""
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, _hashable(item))
+                                   for key, item in value.iteritems())))
+    if isinstance(value, list):
+        return (list, tuple(_hashable(item) for item in value))
+    return value
+
+
+def _insert_key(doc, field):
+    """The (ns, _id) of the doc inserted by the op `doc`, found in `field`,
+    or None if it has no `_id`"""
+    inserted = doc.get(field)
+    if not isinstance(inserted, dict) or "_id" not in inserted:
+        return None
+    _id = inserted["_id"]
+    if isinstance(_id, (dict, list)):
+        _id = _hashable(_id)
+    return doc["ns"], _id
+
+
+class _OplogIndex(object):
+
+    """The oplog docs of one shard waiting for their profiler insert"""
+
+    def __init__(self):
+        self.docs = {}
+        # more docs with the key of one in `docs`: removed, then inserted
+        # again
+        self.more_docs = {}
+        # (ts, key, doc) in arrival order, claimed docs included
+        self.order = deque()
+        # the (ts, doc) coming next from `reader`, if the docs are pulled
+        self.reader = None
+        self.next_doc = None
+        # docs added so far
+        self.count = 0
+        # docs in `docs` and `more_docs`, kept up to date by the merging
+        # thread for the others to read, see `__len__`
+        self.waiting = 0
+
+    def add(self, doc, ts):
+        key = _insert_key(doc, "o") or (doc.get("ns"), object())
+        if key in self.docs:
+            self.more_docs.setdefault(key, deque()).append(doc)
+        else:
+            self.docs[key] = doc
+        self.order.append((ts, key, doc))
+        self.count += 1
+        self.waiting += 1
+
+    def set_reader(self, docs):
+        self.reader = iter(docs)
+        self._read_next()
+
+    def _read_next(self):
+        doc = next(self.reader, None)
+        self.next_doc = None if doc is None \
+            else (utils.ts_to_datetime(doc["ts"]), doc)
+
+    def read_until(self, until):
+        """Pull the docs up to `until` from the reader"""
+        while self.next_doc is not None and self.next_doc[0] <= until:
+            ts, doc = self.next_doc
+            self.add(doc, ts)
+            self._read_next()
+
+    def read_all(self):
+        """Count the docs left in the reader, without indexing them"""
+        if self.next_doc is not None:
+            self.count += 1 + sum(1 for _ in self.reader)
+            self.next_doc = None
+
+    def claim(self, key):
+        """Take the doc of `key` out of the index, None if there is none"""
+        doc = self.docs.pop(key, None)
+        if doc is not None:
+            self.waiting -= 1
+            more = self.more_docs.get(key)
+            if more:
+                self.docs[key] = more.popleft()
+                if not more:
+                    del self.more_docs[key]
+        return doc
+
+    def _remove(self, key, doc):
+        """Take `doc` out of the index, if it is still there"""
+        if self.docs.get(key) is doc:
+            self.claim(key)
+            return True
+        more = self.more_docs.get(key)
+        if more:
+            for position, other in enumerate(more):
+                if other is doc:
+                    del more[position]
+                    self.waiting -= 1
+                    if not more:
+                        del self.more_docs[key]
+                    return True
+        return False
+
+    def claim_oldest(self, ns):
+        """Take out the oldest doc inserted in `ns`, None if there is none"""
+        order = self.order
+        while order and not self._is_waiting(order[0][1], order[0][2]):
+            order.popleft()
+        for _, key, doc in order:
+            if key[0] == ns and self._remove(key, doc):
+                return doc
+        return None
+
+    def _is_waiting(self, key, doc):
+        if self.docs.get(key) is doc:
+            return True
+        return any(other is doc for other in self.more_docs.get(key, ()))
+
+    def expire(self, before, max_docs):
+        """Drop the docs older than `before`, if not None, then the oldest
+        ones until no more than `max_docs` are left.
+        @return: how many unclaimed docs were dropped."""
+        order = self.order
+        dropped = 0
+        while order and (len(order) > max_docs or
+                         before is not None and order[0][0] < before):
+            _, key, doc = order.popleft()
+            if self._remove(key, doc):
+                dropped += 1
+        return dropped
+
+    def __len__(self):
+        # not by walking the dicts: the metrics thread asks while the
+        # merging thread changes them
+        return self.waiting
+
+
+class InsertMatcher(object):
+
+    """Pairs the profiler inserts with the oplog docs of the same shard, ns
+    and `_id`.
+
+    Every shard's oplog docs wait in a hash index until their insert claims
+    them. An insert's oplog and profiler entries are written within seconds
+    of each other by the same server, so the docs more than `window_secs`
+    older than the insert being matched are dropped: the index only holds a
+    few seconds' worth of docs, and never more than `max_docs` per shard.
+    A profiler insert without an `_id` (the profiler leaves out the docs
+    that are too large) gets the oldest doc waiting in the same ns.
+
+    The oplog docs are either handed over as they come with `add`, or
+    pulled from the sources set with `add_source`, as far ahead of the
+    insert being matched as the window goes.
+    """
+
+    def __init__(self, oplog_sources, shards=None,
+                 window_secs=INSERT_MATCH_WINDOW_SECS,
+                 max_docs=INSERT_INDEX_MAX_DOCS):
+        """
+        @param oplog_sources: the names of the oplog sources, one per shard.
+        @param shards: maps the profiler source names to the oplog source of
+            their shard. The profiler sources missing from it go with the
+            only oplog source, if there is just one.
+        """
+        self.window = timedelta(seconds=window_secs)
+        self.max_docs = max_docs
+        self.shards = shards or {}
+        self.indexes = dict((name, _OplogIndex()) for name in oplog_sources)
+        self.default_shard = \
+            oplog_sources[0] if len(oplog_sources) == 1 else None
+        # unclaimed oplog docs dropped from the indexes
+        self.dropped = 0
+
+    def shard_of(self, profiler_source):
+        """The oplog source of the shard of `profiler_source`, or None"""
+        return self.shards.get(profiler_source, self.default_shard)
+
+    def add_source(self, oplog_source, docs):
+        self.indexes[oplog_source].set_reader(docs)
+
+    def add(self, oplog_source, doc):
+        index = self.indexes[oplog_source]
+        index.add(doc, utils.ts_to_datetime(doc["ts"]))
+        if len(index.order) > self.max_docs:
+            self.dropped += index.expire(None, self.max_docs)
+
+    def match(self, shard, profiler_doc):
+        """Take the oplog doc of the insert `profiler_doc` out of the index
+        of `shard`.
+        @return: the oplog doc, or None if it was not found."""
+        index = self.indexes.get(shard)
+        if index is None:
+            return None
+        ts = utils.ts_to_datetime(profiler_doc["ts"])
+        if index.reader is not None:
+            index.read_until(ts + self.window)
+        self.dropped += index.expire(ts - self.window, self.max_docs)
+        key = _insert_key(profiler_doc, "query")
+        if key is None:
+            return index.claim_oldest(profiler_doc["ns"])
+        return index.claim(key)
+
+    def expire(self, before):
+        """Drop the docs of every shard older than `before` minus the
+        window"""
+        for index in self.indexes.itervalues():
+            self.dropped += index.expire(before - self.window, self.max_docs)
+
+    def count(self, read_all=False):
+        """The oplog docs added or pulled so far.
+        @param read_all: pull the rest of the sources, only to count them."""
+        if read_all:
+            for index in self.indexes.itervalues():
+                if index.reader is not None:
+                    index.read_all()
+        return sum(index.count for index in self.indexes.itervalues())
+
+    def pending(self):
+        """The oplog docs waiting in the indexes, safe to call from another
+        thread than the merging one"""
+        return sum(len(index) for index in self.indexes.values())
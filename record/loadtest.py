@@ -0,0 +1,288 @@
+#!/usr/bin/python
+r"""Load test the recorder against a `fakecluster.FakeCluster`.
+
+Drives `MongoQueryRecorder.record()` against an in-process fake sharded
+cluster, at a rising op rate, and reports the highest rate it recorded
+without dropping a single op:
+
+    python loadtest.py --shards 4 --databases 8 --start_rate 1000
+
+Each rate is a full recording of `--seconds`, followed by its merge. An op
+is dropped if it is overwritten in its capped collection before the
+recorder gets to it, or if it is missing from the final output. Any
+recorder setting can be overridden with `--set key=value`, e.g.
+`--set tailer_threads=2`; with `--set oplog_only=True`, only the writes
+count, as only they are in the oplog. With `--step_down_every`, the primaries of the
+shards step down in turn while the load runs, to check that elections cost
+no ops. The ops the recorder found lost in the capped collections (see
+`captureloss`) are reported next to those actually lost, with
+`--kill_lost_cursors` the cursors that fall behind are killed as by a real
+server. The lag is how far behind its profiler a tailer was at worst when
+polled: the highest over all the profilers, and their mean. With
+`--hot_share`, one database takes most of the ops, to see how the tailers
+share their threads (`--set tailer_threads=1`) between a hot source and
+idle ones.
+
+The fake cluster and its load generator run in the recorder's process and
+share its interpreter, so the rates found are a lower bound of what the
+recorder keeps up with against a real cluster. The achieved rate is
+reported next to the target one: when the generator cannot keep up with
+the target, the search stops there.
+"""
+import ast
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+import fakecluster
+import metadata
+import segments
+import record
+import utils
+
+# below this fraction of the target rate, the generator is the bottleneck
+MIN_ACHIEVED_RATIO = 0.9
+
+
+class FakeClusterRecorder(record.MongoQueryRecorder):
+
+    """A recorder whose clients all connect to a `FakeCluster`"""
+
+    def __init__(self, cluster, db_config):
+        self.cluster = cluster
+        super(FakeClusterRecorder, self).__init__(db_config)
+
+    def connect_mongo(self, server_config):
+        return self.cluster.client(server_config["mongodb_uri"])
+
+
+def step_downs(cluster, every_secs, election_secs, stopped):
+    """Step the primaries of the shards down in turn, every `every_secs`,
+    until `stopped` is set.
+    @return: the thread doing it."""
+    def run():
+        shards = itertools.cycle(cluster.shards)
+        while not stopped.wait(every_secs):
+            cluster.step_down(next(shards), election_secs)
+    thread = threading.Thread(target=run, name="step-downs")
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+
+def run_once(rate, shards=2, databases=1, seconds=10, burst_factor=1.0,
+             burst_secs=0, burst_every=10, insert_ratio=0.2,
+             profile_capacity=10000, step_down_every=0, election_secs=1,
+             kill_lost_cursors=False, hot_share=None, recorder_config=None):
+    """Record a fake cluster under a load of `rate` ops/sec.
+    @param step_down_every: if not 0, step a primary down that often.
+    @param kill_lost_cursors: see `fakecluster.FakeCluster`.
+    @param hot_share: see `fakecluster.LoadGenerator`.
+    @return: a dict of the ops generated, recorded, lost in the capped
+        collections, found lost by the recorder and dropped in total."""
+    cluster = fakecluster.FakeCluster(
+        shards, ["db%d" % index for index in xrange(databases)],
+        profile_capacity=profile_capacity,
+        kill_lost_cursors=kill_lost_cursors)
+    directory = tempfile.mkdtemp(prefix="flashback-loadtest-")
+    cwd = os.getcwd()
+    # the profiler intermediate files are written to the current directory
+    os.chdir(directory)
+    try:
+        config = cluster.recorder_config()
+        config.update({
+            "duration_secs": seconds,
+            "output_file": os.path.join(directory, "output"),
+            "oplog_output_file": os.path.join(directory, "oplog"),
+        })
+        config.update(recorder_config or {})
+        config["output_compression"] = None
+        recorder = FakeClusterRecorder(cluster, config)
+
+        # the ops must be through the tailers before the recording ends
+        load_secs = max(1, seconds - 2)
+        oplog_only = config.get("oplog_only", False)
+        generator = fakecluster.LoadGenerator(
+            cluster, rate, burst_factor, burst_secs, burst_every,
+            insert_ratio, log_writes=oplog_only, hot_share=hot_share)
+        generator.start(load_secs)
+        stopped = threading.Event()
+        stepper = None
+        if step_down_every:
+            stepper = step_downs(cluster, step_down_every, election_secs,
+                                 stopped)
+        start = time.time()
+        try:
+            recorder.record()
+        finally:
+            stopped.set()
+            # a step down must not run into the teardown of the cluster
+            if stepper:
+                stepper.join()
+        generator.stop()
+        generator.join()
+        record_secs = time.time() - start
+
+        recorded = sum(1 for name in
+                       segments.segment_files(config["output_file"])
+                       for _ in open(name))
+        # what is to be recorded
+        expected = generator.writes if oplog_only else generator.generated
+        capture_loss = metadata.load(config["output_file"])["capture_loss"]
+        # how far behind its source each profiler tailer fell at worst,
+        # the ts of the oplog only has whole seconds
+        max_lags = [tailer_state.max_lag_secs for name, tailer_state
+                    in recorder.state.tailer_states.iteritems()
+                    if name.split("_")[0] in cluster.databases]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+    return {
+        "rate": rate,
+        # ops failing for lack of a primary count, they were due
+        "achieved_rate": generator.attempted / float(load_secs),
+        "generated": generator.generated,
+        "recorded": recorded,
+        "lost": cluster.lost,
+        "detected_lost": sum(loss["estimated_lost_ops"] for loss
+                             in capture_loss["sources"].values()),
+        "dropped": expected - recorded,
+        "record_secs": record_secs,
+        "max_lag_secs": max(max_lags),
+        "mean_max_lag_secs": sum(max_lags) / len(max_lags),
+    }
+
+
+def search(start_rate, step, max_rate, **kwargs):
+    """Run `run_once` at `start_rate`, then at `step` times the rate, until
+    ops are dropped, the generator falls behind or `max_rate` is passed.
+    @return: the highest rate without drops, or None, and all the runs."""
+    best = None
+    runs = []
+    rate = start_rate
+    while rate <= max_rate:
+        result = run_once(rate, **kwargs)
+        runs.append(result)
+        print "%10d op/s target %10.0f op/s achieved %10d generated " \
+            "%10d recorded %8d lost (~%d detected) %8d dropped " \
+            "lag %.2fs max %.2fs mean" % (
+                rate, result["achieved_rate"], result["generated"],
+                result["recorded"], result["lost"], result["detected_lost"],
+                result["dropped"], result["max_lag_secs"],
+                result["mean_max_lag_secs"])
+        sys.stdout.flush()
+        if result["dropped"] or result["lost"]:
+            break
+        best = rate
+        if result["achieved_rate"] < MIN_ACHIEVED_RATIO * rate:
+            print "The load generator cannot keep up with %d op/s, " \
+                "stopping" % rate
+            break
+        rate = int(rate * step)
+    return best, runs
+
+
+def parse_settings(settings):
+    """Parse ["key=value", ...] into a dict, the values as python literals
+    when they are, as strings otherwise"""
+    config = {}
+    for setting in settings or []:
+        key, value = setting.split("=", 1)
+        try:
+            config[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            config[key] = value
+    return config
+
+
+def get_args():
+    parser = ArgumentParser(
+        description='Find the highest op rate the recorder keeps up with, '
+        'against an in-process fake sharded cluster')
+    parser.add_argument('--shards', dest='shards', type=int, default=2,
+                        help='Shards of the fake cluster - default 2')
+    parser.add_argument('--databases', dest='databases', type=int, default=1,
+                        help='Databases recorded on every shard - default 1')
+    parser.add_argument('--seconds', dest='seconds', type=int, default=10,
+                        help='Duration of each recording - default 10')
+    parser.add_argument('--start_rate', dest='start_rate', type=int,
+                        default=1000,
+                        help='First op rate, in ops/sec - default 1000')
+    parser.add_argument('--step', dest='step', type=float, default=2.0,
+                        help='Factor between successive rates - default 2')
+    parser.add_argument('--max_rate', dest='max_rate', type=int,
+                        default=1000000,
+                        help='Highest op rate tried - default 1000000')
+    parser.add_argument('--burst_factor', dest='burst_factor', type=float,
+                        default=1.0,
+                        help='Rate multiplier during bursts - default 1, '
+                        'no bursts')
+    parser.add_argument('--burst_secs', dest='burst_secs', type=float,
+                        default=0, help='Length of a burst - default 0')
+    parser.add_argument('--burst_every', dest='burst_every', type=float,
+                        default=10,
+                        help='Seconds between burst starts - default 10')
+    parser.add_argument('--insert_ratio', dest='insert_ratio', type=float,
+                        default=0.2, help='Fraction of inserts - default 0.2')
+    parser.add_argument('--profile_capacity', dest='profile_capacity',
+                        type=int, default=10000,
+                        help='Docs every system.profile holds - '
+                        'default 10000')
+    parser.add_argument('--step_down_every', dest='step_down_every',
+                        type=float, default=0,
+                        help='Step a primary down every that many seconds '
+                        '- default 0, never')
+    parser.add_argument('--election_secs', dest='election_secs',
+                        type=float, default=1,
+                        help='Seconds a shard has no primary after a step '
+                        'down - default 1')
+    parser.add_argument('--kill_lost_cursors', dest='kill_lost_cursors',
+                        action='store_true', default=False,
+                        help='Kill the cursors that fall behind their capped '
+                        'collection, as a real server does')
+    parser.add_argument('--hot_share', dest='hot_share', type=float,
+                        help='Send this share of the ops to the first '
+                        'database - default an even spread')
+    parser.add_argument('--set', dest='settings', action='append',
+                        metavar='KEY=VALUE',
+                        help='Override a recorder setting, can be repeated')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Save the results to this json file')
+    parser.add_argument('-v', '--verbose', dest='verbose',
+                        action='store_true', help='Keep the recorder logs')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if not args.verbose:
+        utils.LOG.setLevel(logging.WARNING)
+    params = dict((key, getattr(args, key)) for key in
+                  ("shards", "databases", "seconds", "burst_factor",
+                   "burst_secs", "burst_every", "insert_ratio",
+                   "profile_capacity", "step_down_every", "election_secs",
+                   "kill_lost_cursors", "hot_share"))
+    best, runs = search(args.start_rate, args.step, args.max_rate,
+                        recorder_config=parse_settings(args.settings),
+                        **params)
+    if best is None:
+        print "Ops were dropped at every rate tried"
+    else:
+        print "Highest rate without drops: %d op/s" % best
+
+    if args.output:
+        f = open(args.output, "w")
+        json.dump({"params": params, "settings": args.settings or [],
+                   "best_rate": best, "runs": runs}, f, indent=2,
+                  sort_keys=True)
+        f.close()
+
+if __name__ == '__main__':
+    main()
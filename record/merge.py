@@ -1,32 +1,69 @@
 """This script allows us to manually merge the results from oplog and profiling
 results."""
 import utils
-import config
+import spool
+import blockfile
+import timeindex
+import segments
+import sampling
+import metadata
+import timing
+import extjson
+import insertmatch
 import calendar
+import heapq
 import sys
-from bson.json_util import dumps
+from argparse import ArgumentParser
+from collections import deque
+from datetime import timedelta
+
+# the field holding the shard of the inserts merged ahead of time, see
+# `parallelmerge`
+SHARD_FIELD = "_flashback_shard"
+
+
+def select_fields(op):
+    """Return the fields of `op` that make it to the output"""
+    if isinstance(op, spool.SpoolDoc):
+        op = op.doc
+    copier = utils.DictionaryCopier(op)
+    copier.copy_fields("ts", "ns", "op")
+    op_type = op["op"]
+
+    # handpick some essential fields to execute.
+    if op_type == "query":
+        copier.copy_fields("query", "ntoskip", "ntoreturn")
+    elif op_type == "insert":
+        copier.copy_fields("o")
+    elif op_type == "update":
+        copier.copy_fields("updateobj", "query")
+    elif op_type == "remove":
+        copier.copy_fields("query")
+    elif op_type == "command":
+        copier.copy_fields("command")
+    return copier.dest
 
 
 def dump_op(output, op):
     try:
-        copier = utils.DictionaryCopier(op)
-        copier.copy_fields("ts", "ns", "op")
-        op_type = op["op"]
-
-        # handpick some essential fields to execute.
-        if op_type == "query":
-            copier.copy_fields("query", "ntoskip", "ntoreturn")
-        elif op_type == "insert":
-            copier.copy_fields("o")
-        elif op_type == "update":
-            copier.copy_fields("updateobj", "query")
-        elif op_type == "remove":
-            copier.copy_fields("query")
-        elif op_type == "command":
-            copier.copy_fields("command")
-
-        output.write(dumps(copier.dest))
+        fields = select_fields(op)
+
+        encode_timer = timing.stage("merge.encode")
+        if encode_timer:
+            start = timing.clock()
+        data = extjson.dumps(fields)
+        if encode_timer:
+            encode_timer.add(timing.clock() - start)
+        write_timer = timing.stage("merge.write")
+        if write_timer:
+            start = timing.clock()
+        if hasattr(output, "mark"):
+            # a plain file has no time index
+            output.mark(fields["ts"])
+        output.write(data)
         output.write("\n")
+        if write_timer:
+            write_timer.add(timing.clock() - start)
     except Exception, e:
         errfile = open('/tmp/merge_errors', "a")
         err_msg = "Skipping one record %s \n" % str(e)
@@ -34,7 +71,187 @@ def dump_op(output, op):
         errfile.close()
         print "SKIPPING dump_op, appending to /tmp/merge_errors: %s" % str(e)
 
-def merge_to_final_output(oplog_output_file, profiler_output_files, output_file):
+def make_merge_stats():
+    """Return the merge statistics "struct" """
+    s = utils.EmptyClass()
+    s.inserts = 0
+    s.noninserts = 0
+    s.severe_inconsistencies = 0
+    s.mild_inconsistencies = 0
+    # profiler inserts left out for lack of their oplog doc
+    s.unmatched_inserts = 0
+    # oplog docs no profiler insert claimed
+    s.unmatched_oplog = 0
+    # ops left out of a sampled output
+    s.sampled_out = 0
+    return s
+
+
+def write_op(output, op, stats, sampler=None):
+    """`dump_op`, unless `sampler` leaves the op out of the sample"""
+    if sampler is not None and not sampler.keep(op):
+        stats.sampled_out += 1
+        return
+    dump_op(output, op)
+
+
+def fill_insert(profiler_doc, oplog_doc, stats):
+    """Replace the the profiler's insert operation doc with oplog's, but
+    keeping the canonical form of "ts". Returns the doc to be dumped."""
+    logger = utils.LOG
+    profiler_ts = calendar.timegm(profiler_doc["ts"].timetuple())
+    oplog_ts = oplog_doc["ts"].time
+    # only care about the second-level precision.
+    # This is a lame enforcement of consistency
+    delta = abs(profiler_ts - oplog_ts)
+    if delta > 3:
+        # TODO strictly speaking, this ain't good since the files are
+        # not propertly closed.
+        logger.error(
+            "oplog and profiler results are inconsistent `ts`\n"
+            "  oplog:    %d\n"
+            "  profiler: %d", oplog_ts, profiler_ts)
+        stats.severe_inconsistencies += 1
+    elif delta != 0:
+        logger.warn("Slightly inconsistent timestamp\n"
+                    "  oplog:   %d\n"
+                    "  profiler %d", oplog_ts, profiler_ts)
+        stats.mild_inconsistencies += 1
+
+    oplog_doc["ts"] = profiler_doc["ts"]
+    # make sure "op" is "insert" instead of "i".
+    oplog_doc["op"] = profiler_doc["op"]
+    stats.inserts += 1
+    return oplog_doc
+
+
+def report_merge_stats(stats):
+    utils.LOG.info("Finished completing the insert options, %d inserts and"
+                   " %d noninserts\n"
+                   "  severe ts incosistencies: %d\n"
+                   "  mild ts incosistencies: %d\n", stats.inserts,
+                   stats.noninserts, stats.severe_inconsistencies,
+                   stats.mild_inconsistencies)
+    if stats.unmatched_inserts:
+        utils.LOG.error("%d inserts were left out, their oplog entry was "
+                        "not found", stats.unmatched_inserts)
+    if stats.unmatched_oplog:
+        utils.LOG.warn("%d oplog entries matched no profiled insert",
+                       stats.unmatched_oplog)
+    if stats.sampled_out:
+        utils.LOG.info("%d ops were left out of the sample",
+                       stats.sampled_out)
+
+
+def merge_sources(sources):
+    """k-way merge of several `ts`-ordered doc sequences into one.
+
+    @param sources: a list of (name, docs) pairs, the names must be distinct.
+    @return: a generator of (name, doc) pairs ordered by (ts, name). Ties on
+        `ts` are broken by source name, so the output is deterministic.
+
+    A heap holds the head of each source, so picking the next doc costs
+    O(log K) instead of scanning all K sources.
+    """
+    heap = []
+    for name, docs in sources:
+        docs = iter(docs)
+        doc = next(docs, None)
+        if doc:
+            heap.append((doc["ts"], name, doc, docs))
+    heapq.heapify(heap)
+
+    while heap:
+        ts, name, doc, docs = heap[0]
+        next_doc = next(docs, None)
+        if next_doc:
+            heapq.heapreplace(heap, (next_doc["ts"], name, next_doc, docs))
+        else:
+            heapq.heappop(heap)
+        yield name, doc
+
+
+def merge_ops(oplog_sources, profiler_sources, output, stats=None,
+              sampler=None, shards=None, count_oplog=True):
+    """Merge the profiler docs from all sources in `ts` order and fill the
+    insert ops with the details from the oplog docs of their shard.
+
+    @param oplog_sources: (name, docs) pairs, the oplog insert docs of each
+        shard in `ts` order.
+    @param profiler_sources: (name, docs) pairs, see `merge_sources`.
+    @param output: file object receiving the merged ops.
+    @param sampler: if not None, a `sampling.Sampler` picking the merged ops
+        that are written.
+    @param shards: maps the profiler source names to the oplog source of
+        their shard, see `insertmatch.InsertMatcher`.
+    @param count_oplog: read the oplog sources to the end to count the
+        oplog docs no insert claimed.
+    @return: the merge statistics.
+    """
+    if stats is None:
+        stats = make_merge_stats()
+    matcher = insertmatch.InsertMatcher([name for name, _ in oplog_sources],
+                                        shards)
+    for name, docs in oplog_sources:
+        matcher.add_source(name, docs)
+
+    for name, profiler_doc in merge_sources(profiler_sources):
+        if (stats.noninserts + stats.inserts) % 2500 == 0:
+            utils.LOG.info("processed %d items",
+                           stats.noninserts + stats.inserts)
+
+        if profiler_doc["op"] != "insert":
+            write_op(output, profiler_doc, stats, sampler)
+            stats.noninserts += 1
+            continue
+        # the inserts merged ahead of time by `parallelmerge` carry the
+        # shard of their source
+        shard = profiler_doc.get(SHARD_FIELD) or matcher.shard_of(name)
+        oplog_doc = matcher.match(shard, profiler_doc)
+        if oplog_doc is None:
+            stats.unmatched_inserts += 1
+        else:
+            write_op(output, fill_insert(profiler_doc, oplog_doc, stats),
+                     stats, sampler)
+
+    if count_oplog:
+        stats.unmatched_oplog = matcher.count(read_all=True) - stats.inserts
+    return stats
+
+
+def open_output(output_file, compression=None, rotation=None, manifest=None,
+                index_every_ops=None):
+    """Open the final output file, block compressed with the `compression`
+    codec if there is one (see `blockfile`), along with its time index (see
+    `timeindex`)
+    @param rotation: a `segments.Rotation`, to write the output as segments
+        listed in `manifest`, a `segments.Manifest`.
+    @param index_every_ops: see `timeindex.IndexedWriter`.
+    """
+    if rotation is not None and rotation.enabled:
+        return segments.SegmentedOutput(
+            output_file,
+            lambda name: open_output(name, compression,
+                                     index_every_ops=index_every_ops),
+            rotation, manifest)
+    output = open(output_file, "wb")
+    if compression:
+        output = blockfile.BlockWriter(output, compression)
+    return timeindex.IndexedWriter(
+        output, open(timeindex.index_filename(output_file), "w"),
+        index_every_ops)
+
+
+def oplog_file_list(oplog_output_file):
+    """The oplog file, or the list of them, as a list"""
+    if isinstance(oplog_output_file, basestring):
+        return [oplog_output_file]
+    return list(oplog_output_file)
+
+
+def merge_to_final_output(oplog_output_file, profiler_output_files, output_file,
+                          compression=None, sample_rate=None, shards=None,
+                          rotation=None, manifest=None, index_every_ops=None):
     """
     * Why merge files:
         we need to merge the docs from two sources into one.
@@ -43,120 +260,263 @@ def merge_to_final_output(oplog_output_file, profiler_output_files, output_file)
         these documents from mongodb. However we designed this script to be able
         to pull the docs from differnt servers, as a result it's hard to do the
         on-time merge since you cannot determine if some "old" entries will come
-        later."""
-    oplog = open(oplog_output_file, "rb")
-    
-    # create a map of profiler file names to files
-    profiler_files = {}
-    for profiler_file in profiler_output_files:
-        profiler_files[profiler_file] = open(profiler_file, "rb")
-        
-    output = open(output_file, "wb")
-    logger = utils.LOG
+        later. See `StreamingMerger` for the on-time merge that solves this
+        with per-source watermarks; this function remains the fallback.
+    @param oplog_output_file: the oplog file, or a list of them, one per
+        shard.
+    @param sample_rate: only write this fraction of the ops, see `sampling`.
+    @param shards: maps the profiler files to the oplog file of their shard.
+        Not needed with a single oplog file.
+    @param rotation, manifest, index_every_ops: see `open_output`.
+    """
+    output = open_output(output_file, compression, rotation, manifest,
+                         index_every_ops)
 
-    logger.info("Starts completing the insert options")
-    oplog_doc = utils.unpickle(oplog)
-    # create a map of (profiler file names, doc ts) to doc
-    profiler_docs = {}
-    for file_name in profiler_files:
-        doc = utils.unpickle(profiler_files[file_name])
-        # associate doc with a tuple representing the ts and source filename
-        # this makes it easy to fetch the earliest doc in the group on each
-        # iteration
-        if doc:
-            profiler_docs[(doc["ts"], file_name)] = doc
-    inserts = 0
-    noninserts = 0
-    severe_inconsistencies = 0
-    mild_inconsistencies = 0
-
-    # read docs until either we exhaust the oplog or all ops in the profile logs
-    while oplog_doc and len(profiler_docs) > 0:
-        if (noninserts + inserts) % 2500 == 0:
-            logger.info("processed %d items", noninserts + inserts)
-            
-        # get the earliest profile doc out of all profiler_docs
-        key = min(profiler_docs.keys())
-        profiler_doc = profiler_docs[key]
-        # remove the doc and fetch a new one
-        del(profiler_docs[key])
-        # the first field in the key is the file name
-        doc = utils.unpickle(profiler_files[key[1]])
-        if doc:
-            profiler_docs[(doc["ts"], key[1])] = doc
+    utils.LOG.info("Starts completing the insert options")
+    stats = merge_ops(
+        [(name, timing.timed_iter(spool.iter_docs(name), "merge.read"))
+         for name in oplog_file_list(oplog_output_file)],
+        [(name, timing.timed_iter(spool.iter_docs(name), "merge.read"))
+         for name in profiler_output_files],
+        output, sampler=sampling.make_sampler(sample_rate), shards=shards)
+    report_merge_stats(stats)
+    output.close()
 
-        if profiler_doc["op"] != "insert":
-            dump_op(output, profiler_doc)
-            noninserts += 1
+    return True
+
+
+class StreamingMerger(object):
+
+    """Merge the docs on the fly while the recording is still in progress.
+
+    Every source (each profiler tailer plus the oplog of each shard) keeps a
+    low watermark: the newest `ts` it has delivered, or the time it last
+    found its cursor drained. Since each source delivers its docs in `ts`
+    order, any profiler doc older than the lowest watermark across all
+    sources can no longer be preceded by a late arrival, so it is merged and
+    written out right away.
+    """
+
+    def __init__(self, output, profiler_sources, oplog_sources=("oplog",),
+                 lag_secs=5, sampler=None, shards=None):
+        """
+        @param output: file object receiving the merged ops.
+        @param oplog_sources: one per shard, none when no inserts are
+            recorded.
+        @param lag_secs: how far behind an idle source's last poll we place
+            its watermark, to tolerate profiler entries that land late.
+        @param sampler: see `merge_ops`.
+        @param shards: see `insertmatch.InsertMatcher`.
+        """
+        self.output = output
+        self.sampler = sampler
+        self.oplog_sources = set(oplog_sources)
+        self.matcher = insertmatch.InsertMatcher(list(oplog_sources), shards)
+        self.lag = timedelta(seconds=lag_secs)
+        self.pending = dict((name, deque()) for name in profiler_sources)
+        # (ts, name) of the first pending doc of every non-empty source
+        self.heads = []
+        self.watermarks = dict((name, None) for name in profiler_sources)
+        for name in oplog_sources:
+            self.watermarks[name] = None
+        self.stats = make_merge_stats()
+
+    def add(self, source, doc):
+        """Take a doc freshly retrieved from `source`"""
+        ts = utils.ts_to_datetime(doc["ts"])
+        if source in self.oplog_sources:
+            self.matcher.add(source, doc)
         else:
-            # Replace the the profiler's insert operation doc with oplog's,
-            # but keeping the canonical form of "ts".
-            profiler_ts = calendar.timegm(profiler_doc["ts"].timetuple())
-            oplog_ts = oplog_doc["ts"].time
-            # only care about the second-level precision.
-            # This is a lame enforcement of consistency
-            delta = abs(profiler_ts - oplog_ts)
-            if delta > 3:
-                # TODO strictly speaking, this ain't good since the files are
-                # not propertly closed.
-                logger.error(
-                    "oplog and profiler results are inconsistent `ts`\n"
-                    "  oplog:    %d\n"
-                    "  profiler: %d", oplog_ts, profiler_ts)
-                severe_inconsistencies += 1
-            elif delta != 0:
-                logger.warn("Slightly inconsistent timestamp\n"
-                            "  oplog:   %d\n"
-                            "  profiler %d", oplog_ts, profiler_ts)
-                mild_inconsistencies += 1
-
-            oplog_doc["ts"] = profiler_doc["ts"]
-            # make sure "op" is "insert" instead of "i".
-            oplog_doc["op"] = profiler_doc["op"]
-            dump_op(output, oplog_doc)
-            inserts += 1
-            oplog_doc = utils.unpickle(oplog)
-
-    # finish up any remaining non-insert ops
-    while len(profiler_docs) > 0:
-        # get the earliest profile doc out of all profiler_docs
-        key = min(profiler_docs.keys())
-        profiler_doc = profiler_docs[key]
-        # remove the doc and fetch a new one
-        del(profiler_docs[key])
-        doc = utils.unpickle(profiler_files[key[1]])
-        if doc:
-            profiler_docs[(doc["ts"], key[1])] = doc
-            
-        if profiler_doc["op"] == "insert":
-            break
-        dump_op(output, profiler_doc)
-        noninserts += 1
-
-    logger.info("Finished completing the insert options, %d inserts and"
-                " %d noninserts\n"
-                "  severe ts incosistencies: %d\n"
-                "  mild ts incosistencies: %d\n", inserts, noninserts,
-                severe_inconsistencies, mild_inconsistencies)
-    for f in [oplog, output]:
-        f.close()
-    for f in profiler_files.values():
-        f.close()
+            pending = self.pending[source]
+            if not pending:
+                heapq.heappush(self.heads, (ts, source))
+            pending.append(doc)
+        self._advance(source, ts)
 
-    return True
+    def heartbeat(self, source, polled_at):
+        """`source` found nothing new when polled at `polled_at` (utc)"""
+        self._advance(source, polled_at - self.lag)
+
+    def _advance(self, source, ts):
+        current = self.watermarks[source]
+        if current is None or ts > current:
+            self.watermarks[source] = ts
+
+    def low_watermark(self):
+        """The time before which every source has delivered all its docs, or
+        None if some source has not reported yet."""
+        watermarks = self.watermarks.values()
+        if None in watermarks:
+            return None
+        return min(watermarks)
+
+    def flush(self):
+        """Write out every profiler doc below the current low watermark"""
+        watermark = self.low_watermark()
+        if watermark is not None:
+            self._emit(lambda ts: ts < watermark)
+            self.matcher.expire(watermark)
+
+    def finish(self):
+        """All sources are done: write out whatever is left"""
+        self._emit(lambda ts: True, finishing=True)
+        if self.oplog_sources:
+            self.stats.unmatched_oplog = \
+                self.matcher.count() - self.stats.inserts
+        report_merge_stats(self.stats)
+
+    def _oplog_caught_up(self, shard, ts):
+        """Whether the oplog of `shard` is past the time an insert at `ts`
+        may have its oplog doc"""
+        watermark = self.watermarks.get(shard)
+        return shard is None or watermark is not None and \
+            watermark >= ts + self.matcher.window
+
+    def _emit(self, is_ready, finishing=False):
+        stats = self.stats
+        heads = self.heads
+        # get the earliest pending doc out of all profiler sources
+        while heads and is_ready(heads[0][0]):
+            ts, name = heads[0]
+            pending = self.pending[name]
+            profiler_doc = pending[0]
+            if profiler_doc["op"] != "insert":
+                write_op(self.output, profiler_doc, stats, self.sampler)
+                stats.noninserts += 1
+            elif not self.oplog_sources:
+                # no oplog to complete it with, e.g. it came from the oplog
+                write_op(self.output, profiler_doc, stats, self.sampler)
+                stats.inserts += 1
+            else:
+                shard = self.matcher.shard_of(name)
+                oplog_doc = self.matcher.match(shard, profiler_doc)
+                if oplog_doc is not None:
+                    # the recorder may still be writing the doc as it came
+                    # from the oplog, `fill_insert` must not touch it
+                    write_op(self.output,
+                             fill_insert(profiler_doc, dict(oplog_doc),
+                                         stats),
+                             stats, self.sampler)
+                elif finishing or self._oplog_caught_up(shard, ts):
+                    stats.unmatched_inserts += 1
+                else:
+                    # wait for the oplog to catch up with this insert
+                    return
+            pending.popleft()
+            if pending:
+                heapq.heapreplace(
+                    heads, (utils.ts_to_datetime(pending[0]["ts"]), name))
+            else:
+                heapq.heappop(heads)
+
+
+def get_args():
+    parser = ArgumentParser(
+        description='Merge the recorded oplog and profiler files into the '
+        'final output. With the output file only, the files its recording '
+        'listed in OUTPUT_FILE.meta.json are merged again. Without '
+        'arguments, the files named in config.py are used.')
+    parser.add_argument('files', nargs='*',
+                        metavar='[OPLOG_FILE PROFILER_FILE...] OUTPUT_FILE',
+                        help='The recorded oplog file, the recorded profiler '
+                        'files and the file to write the merged ops to')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Merge time partitions in this many worker '
+                        'processes - default 1, 0 for one per cpu',
+                        metavar='JOBS')
+    parser.add_argument('-m', '--max_open_files', dest='max_open_files',
+                        type=int, default=64,
+                        help='The most files a worker process keeps open at '
+                        'a time when merging in parallel - default 64',
+                        metavar='MAX_OPEN_FILES')
+    parser.add_argument('-z', '--compression', dest='compression',
+                        choices=sorted(blockfile.CODECS),
+                        help='Compress the output in independent blocks with '
+                        'this codec, see blockfile.py')
+    parser.add_argument('-t', '--timing', dest='timing',
+                        action='store_true', default=False,
+                        help='Time the stages of the merge and log a '
+                        'summary, see timing.py')
+    parser.add_argument('-r', '--sample_rate', dest='sample_rate',
+                        type=float,
+                        help='Only keep this fraction of the ops, see '
+                        'sampling.py', metavar='SAMPLE_RATE')
+    parser.add_argument('--index_every_ops', dest='index_every_ops',
+                        type=int,
+                        help='Also index the output after this many ops '
+                        'within the same second, see timeindex.py',
+                        metavar='OPS')
+    parser.add_argument('--segment_secs', dest='segment_secs', type=int,
+                        help='Write the output as segments of this many '
+                        'seconds, see segments.py', metavar='SECS')
+    parser.add_argument('--segment_bytes', dest='segment_bytes', type=int,
+                        help='Start a new segment of the output once it '
+                        'holds this many bytes, see segments.py',
+                        metavar='BYTES')
+
+    args = parser.parse_args()
+    if len(args.files) == 2:
+        parser.error("expected OPLOG_FILE PROFILER_FILE... OUTPUT_FILE")
+    return args
 
 
 def main():
-    # TODO: this command is not user-friendly and doesn't do any sanity check
-    # for the parameters.
-    if len(sys.argv) != 1:
-        params = sys.argv[1:]
-        merge_to_final_output(params[0], params[1], params[2])
+    args = get_args()
+    if args.timing:
+        timing.enable()
+    shards = None
+    oplog_only = None
+    if len(args.files) == 1:
+        recorded = metadata.load(args.files[0]).get("recorded_files")
+        if not recorded:
+            sys.exit("%s lists no recorded files" %
+                     metadata.metadata_filename(args.files[0]))
+        files = (recorded["oplog"], recorded["profilers"], args.files[0])
+        shards = recorded["shards"]
+        # the namespaces of a recording of the oplog only
+        oplog_only = recorded.get("oplog_only")
+    elif args.files:
+        files = (args.files[0], args.files[1:-1], args.files[-1])
     else:
+        import config
         db_config = config.DB_CONFIG
-        merge_to_final_output(db_config["oplog_output_file"],
-                              db_config["profiler_output_file"],
-                              db_config["output_file"])
+        files = (db_config["oplog_output_file"],
+                 db_config["profiler_output_file"],
+                 db_config["output_file"])
+
+    rotation = segments.Rotation(args.segment_secs, args.segment_bytes)
+    manifest = segments.Manifest(files[2], rotation) \
+        if rotation.enabled else None
+    if oplog_only:
+        # nothing to merge, the oplog entries are converted
+        import oplogreplay
+        oplogreplay.convert_to_final_output(
+            files[0], files[2],
+            oplogreplay.OplogConverter(oplog_only["target_databases"],
+                                       oplog_only["target_collections"]),
+            compression=args.compression, sample_rate=args.sample_rate,
+            rotation=rotation, manifest=manifest,
+            index_every_ops=args.index_every_ops)
+    elif args.jobs == 1:
+        merge_to_final_output(*files, compression=args.compression,
+                              sample_rate=args.sample_rate, shards=shards,
+                              rotation=rotation, manifest=manifest,
+                              index_every_ops=args.index_every_ops)
+    else:
+        import parallelmerge
+        parallelmerge.parallel_merge_to_final_output(
+            *files, workers=args.jobs, max_open_files=args.max_open_files,
+            compression=args.compression, sample_rate=args.sample_rate,
+            shards=shards, rotation=rotation, manifest=manifest,
+            index_every_ops=args.index_every_ops)
+    if manifest is not None:
+        manifest.save(complete=True)
+    if args.sample_rate:
+        # the recorder may have sampled already. The samples are nested, so
+        # the lowest rate wins.
+        recorded = metadata.load(files[2]).get("sample_rate", 1.0)
+        metadata.update(files[2], sample_rate=min(recorded, args.sample_rate))
+    timing.report()
 
 if __name__ == '__main__':
     main()
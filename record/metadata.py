@@ -0,0 +1,34 @@
+"""Metadata sidecar of the recorded output files.
+
+Next to `OUTPUT`, the recorder writes `OUTPUT.meta.json`, a json object
+describing how the recording was made, e.g. the `sample_rate` of a sampled
+recording: replaying it with `--speedup` set to 1 / sample_rate brings the
+load back to about the recorded one.
+"""
+import json
+import os
+
+SUFFIX = ".meta.json"
+
+
+def metadata_filename(output_file):
+    return output_file + SUFFIX
+
+
+def load(output_file):
+    """Return the metadata of `output_file`, empty if it has none"""
+    filename = metadata_filename(output_file)
+    if not os.path.exists(filename):
+        return {}
+    return json.load(open(filename))
+
+
+def update(output_file, **fields):
+    """Set `fields` in the metadata of `output_file`, keeping the others"""
+    metadata = load(output_file)
+    metadata.update(fields)
+    tmp_filename = metadata_filename(output_file) + ".tmp"
+    f = open(tmp_filename, "w")
+    json.dump(metadata, f, indent=2, sort_keys=True)
+    f.close()
+    os.rename(tmp_filename, metadata_filename(output_file))
@@ -0,0 +1,184 @@
+"""Serve the state of a running recording as Prometheus metrics.
+
+    curl http://127.0.0.1:PORT/metrics
+
+Only the standard library http server is used. The metrics are read from
+the `RecordingState` when scraped, without any locking: each value is
+current, though the values may not all be from the exact same instant.
+"""
+import BaseHTTPServer
+import SocketServer
+import calendar
+import threading
+import time
+import utils
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _epoch_secs(ts):
+    dt = utils.ts_to_datetime(ts)
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+class _Metrics(object):
+
+    """Accumulates metrics in the Prometheus text format"""
+
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, kind, help_text, samples):
+        """
+        @param samples: (labels dict, value) pairs, samples with a None
+            value are left out.
+        """
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ",".join('%s="%s"' % item
+                                  for item in sorted(labels.items()))
+            if label_text:
+                label_text = "{%s}" % label_text
+            self.lines.append("%s%s %r" % (name, label_text, float(value)))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def render(state):
+    """Return the metrics of a `MongoQueryRecorder.RecordingState`"""
+    now = time.time()
+    metrics = _Metrics()
+    tailers = sorted(state.tailer_states.items())
+
+    def per_tailer(name, kind, help_text, value):
+        metrics.add(name, kind, help_text,
+                    [({"source": source}, value(tailer_state))
+                     for source, tailer_state in tailers])
+
+    per_tailer("flashback_tailer_entries_received_total", "counter",
+               "Entries received from the source.",
+               lambda s: s.entries_received)
+    per_tailer("flashback_tailer_entries_written_total", "counter",
+               "Entries of the source handled by the writer.",
+               lambda s: s.entries_written)
+    per_tailer("flashback_tailer_entries_sampled_out_total", "counter",
+               "Entries of the source left out of the sample.",
+               lambda s: s.entries_sampled_out)
+    per_tailer("flashback_tailer_last_received_timestamp_seconds", "gauge",
+               "ts of the newest entry received from the source.",
+               lambda s: None if s.last_received_ts is None
+               else _epoch_secs(s.last_received_ts))
+    per_tailer("flashback_tailer_lag_seconds", "gauge",
+               "Seconds between the last poll and the ts of the newest entry.",
+               lambda s: s.lag_secs)
+    per_tailer("flashback_tailer_idle_seconds", "gauge",
+               "Seconds since the source last returned anything.",
+               lambda s: None if s.last_received_at is None
+               else now - s.last_received_at)
+    per_tailer("flashback_tailer_stall_seconds_total", "counter",
+               "Seconds the tailer waited for room in the full queue.",
+               lambda s: s.stall_secs)
+    per_tailer("flashback_tailer_alive", "gauge",
+               "Whether the tailer is still running.",
+               lambda s: s.alive)
+    per_tailer("flashback_tailer_reconnects_total", "counter",
+               "Times the source's cursor was reopened after it died.",
+               lambda s: s.reconnects)
+    per_tailer("flashback_tailer_lost_entries_total", "counter",
+               "Entries of the source estimated lost, overwritten in its "
+               "capped collection before they were read.",
+               lambda s: None if s.loss is None else s.loss.lost_ops)
+    per_tailer("flashback_tailer_lost_seconds_total", "counter",
+               "Seconds of the source's entries overwritten before they were "
+               "read.",
+               lambda s: None if s.loss is None else s.loss.lost_secs)
+
+    doc_queue = state.doc_queue
+    if doc_queue is not None:
+        metrics.add("flashback_queue_docs", "gauge",
+                    "Docs waiting for the writer.", [({}, doc_queue.qsize())])
+        metrics.add("flashback_queue_bytes", "gauge",
+                    "Estimated bytes of the docs waiting for the writer.",
+                    [({}, doc_queue.bytes)])
+        metrics.add("flashback_queue_stalls_total", "counter",
+                    "Times a tailer found the queue full.",
+                    [({}, doc_queue.stalls)])
+
+    metrics.add("flashback_writer_bytes_total", "counter",
+                "Bytes written to the intermediate files.",
+                [({}, state.bytes_written)])
+    metrics.add("flashback_writer_bytes_per_second", "gauge",
+                "Write throughput over the writer's last second of work.",
+                [({}, state.writer_bytes_per_sec)])
+
+    merger = state.merger
+    if merger is not None:
+        stats = merger.stats
+        metrics.add("flashback_merge_ops_total", "counter",
+                    "Ops merged into the output, left out of the sample, "
+                    "and inserts left out for lack of their oplog entry.",
+                    [({"kind": "insert"}, stats.inserts),
+                     ({"kind": "noninsert"}, stats.noninserts),
+                     ({"kind": "sampled_out"}, stats.sampled_out),
+                     ({"kind": "unmatched_insert"}, stats.unmatched_inserts)])
+        metrics.add("flashback_merge_pending_docs", "gauge",
+                    "Docs waiting for the low watermark to be merged.",
+                    [({}, sum(len(docs) for docs in merger.pending.values())
+                      + merger.matcher.pending())])
+        watermark = merger.low_watermark()
+        metrics.add("flashback_merge_low_watermark_timestamp_seconds",
+                    "gauge", "The ops before this time are merged.",
+                    [({}, None if watermark is None
+                      else _epoch_secs(watermark))])
+        converter = getattr(merger, "converter", None)
+        if converter is not None:
+            metrics.add("flashback_oplog_entries_skipped_total", "counter",
+                        "Oplog entries that cannot be replayed, by reason.",
+                        [({"reason": reason}, count) for reason, count
+                         in sorted(converter.skipped.items())])
+    return metrics.text()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render(self.server.state)
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        utils.LOG.debug("metrics: " + fmt, *args)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+
+    """Serves the metrics of a recording from a background thread"""
+
+    def __init__(self, state, port, host="127.0.0.1"):
+        self.server = _Server((host, port), _Handler)
+        self.server.state = state
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="metrics-server")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        utils.LOG.info("Serving the recording metrics on http://%s:%d/metrics",
+                       host, self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
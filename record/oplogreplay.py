@@ -0,0 +1,164 @@
+"""Turn the oplog entries into the ops of the final output, for the
+recordings that only tail the oplog (see "oplog_only" in config.py.example).
+
+The oplog has every write that reached the shards: inserts, updates and
+deletes, and the applyOps commands that bundle such writes (transactions,
+some tools). It has no reads, and the writes come as they were applied: an
+update by `_id` with the values it set, rather than the query and the update
+the client sent. What cannot be replayed is counted and reported, never
+dropped silently.
+"""
+import heapq
+import re
+import string
+
+import constants
+import merge
+import sampling
+import spool
+import timing
+import utils
+
+
+def ns_filter(databases, collections):
+    """Return a predicate for the namespaces `utils.make_ns_selector`
+    selects, for the ops nested in an applyOps"""
+    system_collections = \
+        set([constants.PROFILER_COLLECTION, constants.INDEX_COLLECTION])
+    databases = set(databases)
+    collections = set(collections or []) - system_collections
+    if collections:
+        return lambda ns: ns.partition(".")[0] in databases and \
+            ns.partition(".")[2] in collections
+    pattern = re.compile(r"^({})\.".format(string.join(databases, '|')))
+    return lambda ns: pattern.match(ns) is not None and \
+        ns.partition(".")[2] not in system_collections
+
+
+class OplogConverter(object):
+
+    """Converts oplog entries to the ops of the final output, and counts the
+    entries it cannot convert"""
+
+    def __init__(self, databases, collections):
+        self.selects = ns_filter(databases, collections)
+        # {reason: entries}
+        self.skipped = {}
+
+    def convert(self, entry):
+        """@return: the list of the ops `entry` stands for, empty if it
+            cannot be replayed."""
+        ops = []
+        self._convert(entry, utils.ts_to_datetime(entry["ts"]), ops)
+        return ops
+
+    def _convert(self, entry, ts, ops):
+        op_type = entry.get("op")
+        ns = entry.get("ns", "")
+        if op_type == "c":
+            command = entry.get("o") or {}
+            nested = command.get("applyOps")
+            if not isinstance(nested, list):
+                name = next(iter(command), "?")
+                self._skip("command %s" % name)
+                return
+            # the nested ops were applied at once, at the applyOps' ts
+            for nested_entry in nested:
+                if nested_entry.get("op") == "c" or \
+                        self.selects(nested_entry.get("ns", "")):
+                    self._convert(nested_entry, ts, ops)
+            return
+
+        op = {"ts": ts, "ns": ns}
+        if op_type == "i":
+            op["op"] = "insert"
+            op["o"] = entry["o"]
+        elif op_type == "u":
+            update = entry["o"]
+            if "$v" in update:
+                if update["$v"] != 1:
+                    # the "diff" format of 5.0, no client sends that
+                    self._skip("update $v %s" % update["$v"])
+                    return
+                update = dict((key, value) for key, value
+                              in update.iteritems() if key != "$v")
+            op["op"] = "update"
+            op["query"] = entry["o2"]
+            op["updateobj"] = update
+        elif op_type == "d":
+            op["op"] = "remove"
+            op["query"] = entry["o"]
+        else:
+            self._skip("op %s" % op_type)
+            return
+        ops.append(op)
+
+    def _skip(self, reason):
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    def report(self):
+        for reason, count in sorted(self.skipped.iteritems()):
+            utils.LOG.warning("Skipped %d oplog entries that cannot be "
+                              "replayed: %s", count, reason)
+
+
+class OplogMerger(merge.StreamingMerger):
+
+    """A `merge.StreamingMerger` of the converted oplog entries of every
+    shard: the oplog sources take the place of the profiler ones."""
+
+    def __init__(self, output, oplog_sources, converter, lag_secs=5,
+                 sampler=None):
+        super(OplogMerger, self).__init__(output, oplog_sources,
+                                          oplog_sources=(),
+                                          lag_secs=lag_secs, sampler=sampler)
+        self.converter = converter
+
+    def add(self, source, doc):
+        for op in self.converter.convert(doc):
+            super(OplogMerger, self).add(source, op)
+        # even if nothing came of it
+        self._advance(source, utils.ts_to_datetime(doc["ts"]))
+
+    def finish(self):
+        super(OplogMerger, self).finish()
+        self.converter.report()
+
+
+def _keyed(index, docs):
+    """Key the docs of a file to merge them in `ts` order, then file by file
+    and in file order"""
+    for ordinal, doc in enumerate(docs):
+        yield utils.ts_to_datetime(doc["ts"]), index, ordinal, doc
+
+
+def convert_to_final_output(oplog_files, output_file, converter,
+                            compression=None, sample_rate=None,
+                            rotation=None, manifest=None,
+                            index_every_ops=None):
+    """Convert the recorded oplog files into the final output, in `ts`
+    order: the post-hoc counterpart of `OplogMerger`.
+    @param compression: see `merge.open_output`.
+    @param sample_rate: see `merge.merge_to_final_output`.
+    @param rotation, manifest, index_every_ops: see `merge.open_output`.
+    """
+    output = merge.open_output(output_file, compression, rotation, manifest,
+                               index_every_ops)
+    stats = merge.make_merge_stats()
+    sampler = sampling.make_sampler(sample_rate)
+    utils.LOG.info("Converting the oplog entries of %d files",
+                   len(oplog_files))
+    streams = [_keyed(index, timing.timed_iter(spool.iter_docs(name),
+                                               "merge.read"))
+               for index, name in enumerate(oplog_files)]
+    for _, _, _, entry in heapq.merge(*streams):
+        for op in converter.convert(entry):
+            merge.write_op(output, op, stats, sampler)
+            if op["op"] == "insert":
+                stats.inserts += 1
+            else:
+                stats.noninserts += 1
+    merge.report_merge_stats(stats)
+    converter.report()
+    output.close()
+    return True
@@ -0,0 +1,235 @@
+"""Merge the recorded files in time partitions, by a pool of worker processes.
+
+The profiler files are sampled to cut the recording into partitions that
+hold about the same number of ops, each merged into its own file by a
+worker, then the partition files are appended in order to the output. See
+`parallel_merge_to_final_output`.
+"""
+import utils
+import spool
+import segments
+import sampling
+import timeindex
+import timing
+import insertmatch
+import merge
+import multiprocessing
+import os
+import tempfile
+from datetime import timedelta
+
+
+def sample_file(filename, every=1000):
+    """Scan a recorded file and take a sample every `every` docs.
+
+    @return: the list of the (ts, offset) of the sampled docs, their `ts` as
+        a datetime and where they start in the file, and the number of docs
+        in the file.
+    """
+    samples = []
+    ordinal = 0
+    reader = spool.open_reader(filename)
+    while True:
+        offset = reader.tell()
+        doc = reader.read()
+        if not doc:
+            break
+        if ordinal % every == 0:
+            samples.append((utils.ts_to_datetime(doc["ts"]), offset))
+        ordinal += 1
+    reader.close()
+    return samples, ordinal
+
+
+def _read_partition(filename, samples, lo, hi):
+    """Yield the docs of a recorded file that belong to partition [lo, hi).
+
+    A doc belongs to the partition when it comes at or after the first doc
+    with ts >= `lo` and before the first doc with ts >= `hi`. Cutting the file
+    at positions rather than filtering each doc means every doc lands in
+    exactly one partition even if the file is not perfectly ordered.
+
+    `hi` must be None for an oplog file, its `ts` are Timestamps.
+    """
+    if not samples:
+        return
+    # start from the sample right before the first one at or past `lo`
+    start = samples[0]
+    for sample in samples:
+        if lo is None or sample[0] >= lo:
+            break
+        start = sample
+    reader = spool.open_reader(filename)
+    reader.seek(start[1])
+    try:
+        doc = reader.read()
+        while doc and lo is not None and \
+                utils.ts_to_datetime(doc["ts"]) < lo:
+            doc = reader.read()
+        while doc and (hi is None or doc["ts"] < hi):
+            yield doc
+            doc = reader.read()
+    finally:
+        reader.close()
+
+
+def _reduce_fan_in(sources, max_open_files, tmp_dir, shard_of):
+    """Merge groups of sources into temporary files until no more than
+    `max_open_files` of them are left.
+
+    Groups are contiguous runs of the sources sorted by name and are named in
+    the same order, so ties on `ts` break exactly as in a flat merge. The
+    inserts keep the shard of their source, `shard_of` tells which it is.
+    """
+    sources = sorted(sources)
+    tmp_files = []
+    first_level = True
+    while len(sources) > max_open_files:
+        merged = []
+        for start in xrange(0, len(sources), max_open_files):
+            group = sources[start:start + max_open_files]
+            fd, tmp_name = tempfile.mkstemp(dir=tmp_dir, suffix=".merging")
+            tmp = spool.SpoolWriter(os.fdopen(fd, "wb"))
+            for name, doc in merge.merge_sources(group):
+                if first_level and doc["op"] == "insert":
+                    if isinstance(doc, spool.SpoolDoc):
+                        doc = doc.doc
+                    doc[merge.SHARD_FIELD] = shard_of(name)
+                tmp.write(doc)
+            tmp.close()
+            tmp_files.append(tmp_name)
+            merged.append(("%08d" % start, spool.iter_docs(tmp_name)))
+        sources = merged
+        first_level = False
+    return sources, tmp_files
+
+
+def _merge_partition(task):
+    """Merge one time partition into its own output file. Runs in a worker
+    process."""
+    # only report what this task timed
+    timing.reset()
+    lo, hi = task["range"]
+    # The oplog docs of an insert of the partition may come a little before
+    # it.
+    oplog_lo = None if lo is None \
+        else lo - timedelta(seconds=insertmatch.INSERT_MATCH_WINDOW_SECS)
+    oplog_sources = [(name, timing.timed_iter(
+                      _read_partition(name, samples, oplog_lo, None),
+                      "merge.read"))
+                     for name, samples in task["oplog_samples"]]
+    sources = [(name, timing.timed_iter(
+                _read_partition(name, samples, lo, hi), "merge.read"))
+               for name, samples in task["profiler_samples"]]
+    # one file per profiler source is open at the same time, plus the
+    # oplogs and the output.
+    matcher = insertmatch.InsertMatcher([name for name, _ in oplog_sources],
+                                        task["shards"])
+    sources, tmp_files = _reduce_fan_in(
+        sources, task["max_open_files"] - len(oplog_sources) - 1,
+        os.path.dirname(task["output_file"]), matcher.shard_of)
+
+    output = timeindex.IndexedWriter(open(task["output_file"], "wb"),
+                                     every_ops=task["index_every_ops"])
+    # the oplog docs read by several partitions are counted once, by
+    # `parallel_merge_to_final_output`
+    stats = merge.merge_ops(oplog_sources, sources, output,
+                            sampler=sampling.make_sampler(task["sample_rate"]),
+                            shards=task["shards"], count_oplog=False)
+    output.close()
+    for tmp_name in tmp_files:
+        os.remove(tmp_name)
+    return stats, output.entries, timing.snapshot()
+
+
+def parallel_merge_to_final_output(oplog_output_file, profiler_output_files,
+                                   output_file, workers=None,
+                                   max_open_files=64, partitions=None,
+                                   compression=None, sample_rate=None,
+                                   shards=None, rotation=None, manifest=None,
+                                   index_every_ops=None):
+    """Same as `merge.merge_to_final_output`, but the work is split into time
+    partitions that are merged by a pool of worker processes.
+
+    @param workers: number of worker processes, defaults to the cpu count.
+    @param max_open_files: cap on the files a worker keeps open at a time.
+        Beyond that, the profiler files are merged hierarchically.
+    @param partitions: number of time partitions, defaults to 4 per worker
+        so a slow partition does not hold up the whole pool.
+    """
+    oplog_files = merge.oplog_file_list(oplog_output_file)
+    if (rotation is not None and rotation.enabled) or \
+            any(len(segments.segment_files(name)) > 1
+                for name in oplog_files + list(profiler_output_files)):
+        # the partitions are cut at offsets within single files, and
+        # appended to a single output
+        utils.LOG.info("Segmented files, merging in a single process")
+        return merge.merge_to_final_output(
+            oplog_output_file, profiler_output_files, output_file,
+            compression=compression, sample_rate=sample_rate, shards=shards,
+            rotation=rotation, manifest=manifest,
+            index_every_ops=index_every_ops)
+    workers = workers or multiprocessing.cpu_count()
+    partitions = partitions or 4 * workers
+    if max_open_files < len(oplog_files) + 3:
+        raise ValueError("max_open_files must be at least 3 plus the number "
+                         "of oplog files")
+    logger = utils.LOG
+    pool = multiprocessing.Pool(workers)
+    try:
+        logger.info("Sampling %d files",
+                    len(oplog_files) + len(profiler_output_files))
+        all_samples = pool.map(sample_file,
+                               oplog_files + profiler_output_files)
+        oplog_samples = [(name, samples) for name, (samples, _)
+                         in zip(oplog_files, all_samples)]
+        oplog_docs = sum(count for _, count in all_samples[:len(oplog_files)])
+        profiler_samples = [(name, samples) for name, (samples, _)
+                            in zip(profiler_output_files,
+                                   all_samples[len(oplog_files):])
+                            if samples]
+
+        # pick the partition boundaries so that they hold about the same
+        # number of docs.
+        sample_ts = sorted(sample[0] for _, samples in profiler_samples
+                           for sample in samples)
+        boundaries = sorted(set(
+            sample_ts[len(sample_ts) * k / partitions]
+            for k in xrange(1, partitions))) if sample_ts else []
+        ranges = zip([None] + boundaries, boundaries + [None])
+
+        tasks = [{
+            "range": ts_range,
+            "profiler_samples": profiler_samples,
+            "oplog_samples": oplog_samples,
+            "shards": shards,
+            "max_open_files": max_open_files,
+            "sample_rate": sample_rate,
+            "index_every_ops": index_every_ops,
+            "output_file": "%s.part%05d" % (output_file, index),
+        } for index, ts_range in enumerate(ranges)]
+        logger.info("Merging %d partitions with %d workers",
+                    len(tasks), workers)
+        results = pool.map(_merge_partition, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # concatenate the partitions in order
+    stats = merge.make_merge_stats()
+    output = merge.open_output(output_file, compression,
+                               index_every_ops=index_every_ops)
+    for task, (partition_stats, entries, timings) in zip(tasks, results):
+        timing.merge_snapshot(timings)
+        output.append(task["output_file"], entries)
+        for field in ("inserts", "noninserts", "severe_inconsistencies",
+                      "mild_inconsistencies", "unmatched_inserts",
+                      "sampled_out"):
+            setattr(stats, field,
+                    getattr(stats, field) + getattr(partition_stats, field))
+        os.remove(task["output_file"])
+    output.close()
+    stats.unmatched_oplog = oplog_docs - stats.inserts
+    merge.report_merge_stats(stats)
+
+    return True
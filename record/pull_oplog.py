@@ -1,88 +1,65 @@
-"""TODO(kailiu): this script is not fully completed. Sometimes we only care
-about the results from oplog. This script will direct pull everything directly
-from oplog."""
-import sys
+#!/usr/bin/python
+r"""Record the writes from the oplog only, when the reads do not matter or
+the profiler cannot be turned on:
+
+    python pull_oplog.py DURATION_SECS OUTPUT_FILE
+
+This is the recorder with "oplog_only" on, see config.py.example: the oplog
+of every server in "oplog_servers", or of every shard with "auto_config", is
+tailed in parallel, the inserts, updates, deletes and applyOps are converted
+to the ops of the final output and streamed to it, see `oplogreplay`. The
+throughput and lag are reported, checkpoints saved and metrics served as
+when recording the profilers too.
+"""
+from argparse import ArgumentParser
+import importlib
+import os
+import signal
+
+import record
 import utils
-import config
-import time
-from datetime import datetime
-from pymongo import MongoClient
-from bson.json_util import dumps
 
 
-def sanitize_op(op):
-    new_op = {}
-    new_op["ts"] = op["ts"].as_datetime()
-    new_op["ns"] = op["ns"]
-    op_type = op["op"]
-
-    # handpick some essential fields to execute.
-    if op_type == "i":
-        new_op["op"] = "insert"
-        new_op["o"] = op["o"]
-    elif op_type == "u":
-        new_op["op"] = "update"
-        new_op["updateobj"] = op["o"]
-        new_op["query"] = op["o2"]
-    else:
-        assert "Cannot recognize the op type: " + op_type
-
-    return new_op
-
-
-def dump_op(op, output_file):
-    output_file.write(dumps(op))
-    output_file.write("\n")
-
-
-def write_to_file(tailer, duration_in_sec, output_file, check_duration_secs=1):
-    start_ts = None
-    start_ts_datetime = None
-    entries_received = 0
-    real_start = datetime.now()
-    while tailer.alive:
-        try:
-            op = tailer.next()
-            last_received_ts = op["ts"]
-            if start_ts is None:
-                utils.LOG.info("Start to pulling oplog, first entry ts: %s",
-                               str(last_received_ts.as_datetime()))
-                start_ts = last_received_ts
-                start_ts_datetime = last_received_ts.as_datetime()
-
-            if last_received_ts.time >= start_ts.time + duration_in_sec:
-                break
-
-            op = sanitize_op(op)
-            dump_op(op, output_file)
-            entries_received += 1
-            if entries_received % 10000 == 0:
-                utils.LOG.info(
-                    "entries received %d, time advanced in oplog %s, time "
-                    "advanced in real life %s",
-                    entries_received, str(op["ts"] - start_ts_datetime),
-                    str(datetime.now() - real_start))
-        except StopIteration:
-            time.sleep(check_duration_secs)
-
-    utils.LOG.info("collected %d entries", entries_received)
+def get_args():
+    parser = ArgumentParser(
+        description='Record the writes to a database from its oplog only.')
+    parser.add_argument('duration', type=int, nargs='?',
+                        help='The number of seconds to run the recording - '
+                        'default "duration_secs"', metavar='DURATION_SECS')
+    parser.add_argument('output', nargs='?',
+                        help='The file to write the ops to - default '
+                        '"output_file"', metavar='OUTPUT_FILE')
+    parser.add_argument('-f', '--config_file', dest='configfile',
+                        default='config.py', help='The configuration file '
+                        '- default config.py', metavar='CONFIGFILE')
+    parser.add_argument('-r', '--resume', dest='resume',
+                        help='Carry on with the recording that saved this '
+                        'checkpoint file (OUTPUT_FILE.checkpoint) before it '
+                        'died', metavar='CHECKPOINT_FILE')
+    return parser.parse_args()
 
 
 def main():
-    db_config = config.DB_CONFIG
-    duration_in_sec = int(sys.argv[1])
-    output = open(sys.argv[2], "w")
-
-    # Get the tailer for oplog
-    mongodb_uri = db_config["oplog_server"]["mongodb_uri"]
-    oplog_client = MongoClient(mongodb_uri)
-    tailer = utils.get_oplog_tailer(oplog_client,
-                                    ["i", "u"],
-                                    db_config["target_database"],
-                                    db_config["target_collections"])
-
-    # sanitize
-    write_to_file(tailer, duration_in_sec, output)
+    args = get_args()
+    config = importlib.import_module(os.path.splitext(args.configfile)[0])
+    db_config = dict(config.DB_CONFIG)
+    db_config["oplog_only"] = True
+    if args.duration is not None:
+        db_config["duration_secs"] = args.duration
+    if args.output is not None:
+        db_config["output_file"] = args.output
+    utils.LOG.info("Recording the oplog for %s seconds to %s",
+                   db_config["duration_secs"], db_config["output_file"])
+
+    recorder = record.MongoQueryRecorder(db_config)
+
+    def signal_handler(sig, dummy):
+        """Handle the Ctrl+C signal"""
+        print 'Trying to gracefully exiting program...'
+        recorder.force_quit_all()
+    signal.signal(signal.SIGINT, signal_handler)
+
+    recorder.record(resume_from=args.resume)
 
 
 if __name__ == '__main__':
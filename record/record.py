@@ -9,59 +9,190 @@ import os
 import pymongo
 from threading import Thread
 import importlib
-import cPickle
-import Queue
+import functools
 import time
 import utils
 import signal
 import merge
+import parallelmerge
+import docqueue
+import failover
+import captureloss
+import oplogreplay
+import spool
+import writerpool
+import scheduler
+import checkpoint
+import sampling
+import segments
+import metadata
+import metrics
+import timing
 import sys
 
+# the types of the docs sampled once merged rather than when received: the
+# inserts once paired with the oplog, the oplog entries once converted
+_SAMPLED_WHEN_MERGED = ("insert", "i", "u", "d", "c")
+# how long to wait for the status report and the periodic checks to stop,
+# e.g. a topology refresh waiting on an unreachable server
+INTERVAL_JOIN_SECS = 30
 
-def tail_to_queue(tailer, identifier, doc_queue, state, end_time,
-                  check_duration_secs=1):
-    """Accepts a tailing cursor and serialize the retrieved documents to a
-    fifo queue
-    @param identifier: when passing the retrieved document to the queue, we
-        will attach a unique identifier that allows the queue consumers to
-        process different sources of documents accordingly.
-    @param check_duration_secs: if we cannot retrieve the latest document,
-        it will sleep for a period of time and then try again.
+
+class Heartbeat(object):
+
+    """Queued by an idle tailer: whatever it receives later is newer than
+    `polled_at`. `datetime.max` once the tailer is done."""
+
+    __slots__ = ("polled_at",)
+
+    def __init__(self, polled_at):
+        self.polled_at = polled_at
+
+
+def poll_tailer(tailer, identifier, doc_queue, state, end_time,
+                max_docs=None):
+    """Move the documents a tailing cursor has retrieved to the fifo queue,
+    until it runs dry or `max_docs` of them were moved.
+    @return: how many documents were moved, or None if the source is done:
+        the recording ended, or its cursor died and is not to be reopened,
+        see `failover.ResumableTailer`.
     """
     tailer_state = state.tailer_states[identifier]
-    preformed_loops = 0
-    while tailer.alive and all(s.alive for s in state.tailer_states.values()):
+    received = _drain_tailer(tailer, identifier, doc_queue, state, end_time,
+                             max_docs)
+    if received:
+        tailer_state.last_received_at = time.time()
+    tailer_state.reconnects = tailer.reopens
+    # the lag is only refreshed once per poll, converting every doc's ts
+    # would cost more than the rest of the loop
+    if received:
+        lag = datetime.utcnow() - \
+            utils.ts_to_datetime(tailer_state.last_received_ts)
+        tailer_state.lag_secs = lag.total_seconds()
+        tailer_state.max_lag_secs = max(tailer_state.max_lag_secs,
+                                        tailer_state.lag_secs)
+    elif received == 0 and tailer_state.last_received_ts is not None:
+        # nothing new: the source is caught up, however old its last doc
+        tailer_state.lag_secs = 0.0
+    return received
+
+
+def _drain_tailer(tailer, identifier, doc_queue, state, end_time, max_docs):
+    """The loop of `poll_tailer`"""
+    tailer_state = state.tailer_states[identifier]
+    received = 0
+    fetch_timer = timing.stage("record.fetch")
+    put_timer = timing.stage("record.queue_put")
+    while max_docs is None or received < max_docs:
+        if not tailer.alive:
+            return None
         try:
+            if fetch_timer:
+                start = timing.clock()
             doc = tailer.next()
+            if fetch_timer:
+                fetch_timer.add(timing.clock() - start)
             tailer_state.last_received_ts = doc["ts"]
             if state.timeout and tailer_state.last_received_ts >= end_time:
-                break
-
-            if type(tailer_state.last_received_ts) is Timestamp:
-                tailer_state.last_received_ts.as_datetime()
+                return None
 
-            doc_queue.put_nowait((identifier, doc))
             tailer_state.entries_received += 1
+            received += 1
+            sampler = state.sampler
+            if sampler is not None and \
+                    doc["op"] not in _SAMPLED_WHEN_MERGED and \
+                    not sampler.keep(doc):
+                tailer_state.entries_sampled_out += 1
+                continue
+            if put_timer:
+                start = timing.clock()
+            tailer_state.stall_secs += doc_queue.put((identifier, doc))
+            if put_timer:
+                put_timer.add(timing.clock() - start)
         except StopIteration:
+            if fetch_timer:
+                # the cursor had nothing (more) to offer
+                timing.stage("record.fetch_empty").add(timing.clock() - start)
             if state.timeout:
-                break
+                return None
             tailer_state.last_get_none_ts = datetime.now()
-            time.sleep(check_duration_secs)
-        except pymongo.errors.OperationFailure, e:
-            if preformed_loops == 0:
+            tailer_state.stall_secs += doc_queue.put(
+                (identifier, Heartbeat(datetime.utcnow())))
+            return received
+        except docqueue.Stopped:
+            # nothing will write the doc
+            return None
+        except failover.SourceDown, e:
+            # no heartbeat: the docs the cursor missed while down are older
+            if tailer_state.polls == 0 and \
+                    isinstance(e.error, pymongo.errors.OperationFailure):
                 utils.LOG.error(
                     "BADRUN: source %s: We appear to not have the %s collection created or is non-capped! %s",
-                    identifier, tailer.collection, e)
+                    identifier, tailer.collection, e.error)
+            if state.timeout:
+                return None
+            return received
         except Exception, e:
             # TODO: understand why we get bad bson date error, probably only need to catch OverflowError
             utils.LOG.error("SKIPPING document in tail_to_queue: %s", e)
             utils.LOG.error("SKIPPED document in tail_to_queue: %s", doc)
-        preformed_loops += 1
+        finally:
+            tailer_state.polls += 1
+    return received
+
 
-    tailer_state.alive = False
+def tail_to_queue(tailer, identifier, doc_queue, state, end_time,
+                  pacer=None):
+    """Accepts a tailing cursor and serialize the retrieved documents to a
+    fifo queue
+    @param identifier: when passing the retrieved document to the queue, we
+        will attach a unique identifier that allows the queue consumers to
+        process different sources of documents accordingly.
+    @param pacer: a `scheduler.Pacer`, deciding how long to sleep when the
+        cursor runs dry, backing off while the source stays idle.
+    """
+    if pacer is None:
+        pacer = scheduler.Pacer()
+    while True:
+        received = poll_tailer(tailer, identifier, doc_queue, state, end_time,
+                               pacer.batch)
+        if received is None:
+            break
+        interval = pacer.update(received)
+        if interval:
+            time.sleep(interval)
+
+    _source_done(identifier, doc_queue, state)
+
+
+def scheduled_poll(tailer, identifier, doc_queue, state, end_time, max_docs):
+    """`poll_tailer` for the `TailerScheduler`"""
+    received = poll_tailer(tailer, identifier, doc_queue, state, end_time,
+                           max_docs)
+    if received is None:
+        _source_done(identifier, doc_queue, state)
+    return received
+
+
+def _source_done(identifier, doc_queue, state):
+    """Mark a source done. The other sources carry on, and the streaming
+    merge stops waiting for this one."""
+    try:
+        doc_queue.put((identifier, Heartbeat(datetime.max)))
+    except docqueue.Stopped:
+        pass
+    state.tailer_states[identifier].alive = False
     utils.LOG.info("source %s: Tailing to queue completed!", identifier)
 
 
+def check_capture_loss(state):
+    """Check the sources still recording for docs overwritten before they
+    were read, see `captureloss`"""
+    for name, tailer in state.tailers.items():
+        if state.tailer_states[name].alive and not state.timeout:
+            tailer.loss.check(tailer)
+
+
 class MongoQueryRecorder(object):
 
     """Record MongoDB database's activities by polling the oplog and profiler
@@ -77,13 +208,37 @@ class MongoQueryRecorder(object):
             s = utils.EmptyClass()
             s.entries_received = 0
             s.entries_written = 0
+            s.entries_sampled_out = 0
             s.alive = True
             s.last_received_ts = None
             s.last_get_none_ts = None
+            # wall clock time of the last poll that received anything
+            s.last_received_at = None
+            # how many times the cursor was asked for a document
+            s.polls = 0
+            # time spent waiting for room in a full queue
+            s.stall_secs = 0.0
+            # seconds between the last poll and the newest doc received
+            s.lag_secs = None
+            s.max_lag_secs = 0.0
+            # how many times the cursor was reopened
+            s.reconnects = 0
+            # the docs it lost, see `captureloss.LossTracker`
+            s.loss = None
             return s
 
         def __init__(self, tailer_names):
             self.timeout = False
+            self.doc_queue = None
+            # see `sampling`, None records every op
+            self.sampler = None
+            self.merger = None
+            # what the writer thread wrote to the intermediate files, and
+            # how fast over its last second of work
+            self.bytes_written = 0
+            self.writer_bytes_per_sec = 0.0
+            # the `failover.ResumableTailer` of every source
+            self.tailers = {}
             self.tailer_states = {}
             for name in tailer_names:
                 self.tailer_states[name] = self.make_tailer_state()
@@ -91,6 +246,14 @@ class MongoQueryRecorder(object):
     def __init__(self, db_config):
         self.config = db_config
         self.force_quit = False
+        # the `RecordingState` of the recording in progress, or of the last
+        # one
+        self.state = None
+        # with auto config, the primaries the tailers follow
+        self.live_topology = None
+        self.mongos_client = None
+        # the ops are all taken from the oplog, see `oplogreplay`
+        self.oplog_only = self.config.get("oplog_only", False)
         # sanitize the options
         if self.config["target_collections"] is not None:
             self.config["target_collections"] = set(
@@ -114,21 +277,32 @@ class MongoQueryRecorder(object):
 
             self.get_topology(self.config['auto_config_options'])
             oplog_servers = self.build_oplog_servers(self.config['auto_config_options'])
-            profiler_servers = self.build_profiler_servers(self.config['auto_config_options'])
+            profiler_servers = [] if self.oplog_only else \
+                self.build_profiler_servers(self.config['auto_config_options'])
+            self.live_topology = failover.Topology(
+                functools.partial(self.discover_topology,
+                                  self.config['auto_config_options']),
+                self.topology)
         else:
             oplog_servers = self.config["oplog_servers"]
-            profiler_servers = self.config["profiler_servers"]
+            profiler_servers = [] if self.oplog_only else \
+                self.config["profiler_servers"]
 
-        if len(oplog_servers) < 1 or len(profiler_servers) < 1:
+        if len(oplog_servers) < 1 or \
+                (len(profiler_servers) < 1 and not self.oplog_only):
             utils.log.error("Detected either no profile or oplog servers, bailing")
             sys.exit(1)
 
+        # the shard of every client, to pair the profiled inserts with the
+        # oplog they went to
+        self.shards = {}
         self.oplog_clients = {}
         for index, server in enumerate(oplog_servers):
             mongodb_uri = server['mongodb_uri']
             nodelist = uri_parser.parse_uri(mongodb_uri)["nodelist"]
             server_string = "%s:%s" % (nodelist[0][0], nodelist[0][1])
 
+            self.shards[server_string] = self.shard_name(server, server_string)
             self.oplog_clients[server_string] = self.connect_mongo(server)
             utils.LOG.info("oplog server %d: %s", index, self.sanatize_server(server))
 
@@ -139,9 +313,17 @@ class MongoQueryRecorder(object):
             nodelist = uri_parser.parse_uri(mongodb_uri)["nodelist"]
             server_string = "%s:%s" % (nodelist[0][0], nodelist[0][1])
 
+            self.shards[server_string] = self.shard_name(server, server_string)
             self.profiler_clients[server_string] = self.connect_mongo(server)
             utils.LOG.info("profiling server %d: %s", index, self.sanatize_server(server))
 
+    @staticmethod
+    def shard_name(server_config, server_string):
+        """The shard of a server: its "shard" or "replSet" setting, or the
+        server itself"""
+        return server_config.get('shard') or \
+            server_config.get('replSet') or server_string
+
     def sanatize_server(self, server_config):
         if 'user' in server_config:
             server_config['user'] = "Redacted"
@@ -151,19 +333,86 @@ class MongoQueryRecorder(object):
         return server_config
 
     @staticmethod
-    def _process_doc_queue(doc_queue, files, state):
-        """Writes the incoming docs to the corresponding files"""
+    def _process_doc_queue(doc_queue, files, state, merger=None,
+                           batch_size=1000, checkpointer=None):
+        """Writes the incoming docs to the corresponding files, and feeds
+        them to the streaming `merger` if there is one.
+
+        Docs are taken off the queue in batches, and each batch ends up in
+        a single write per file. The files are checkpointed in between
+        batches by the `checkpointer`, if any."""
+        try:
+            MongoQueryRecorder._write_docs(doc_queue, files, state, merger,
+                                           batch_size, checkpointer)
+        finally:
+            # the tailers waiting for room must not wait for a dead writer
+            doc_queue.close()
+
+    @staticmethod
+    def _write_docs(doc_queue, files, state, merger, batch_size,
+                    checkpointer):
+        """The loop of `_process_doc_queue`"""
+        rate_window = {"start": time.time(), "bytes": 0}
+        merge_timer = timing.stage("record.merge")
+
+        def handle(batch):
+            if merge_timer:
+                merge_secs = 0.0
+            chunks = {}
+            for name, doc in batch:
+                if isinstance(doc, Heartbeat):
+                    if merger:
+                        merger.heartbeat(name, doc.polled_at)
+                    continue
+                state.tailer_states[name].entries_written += 1
+                if name in files:
+                    chunks.setdefault(name, []).append(doc)
+                if merger:
+                    if merge_timer:
+                        start = timing.clock()
+                    merger.add(name, doc)
+                    if merge_timer:
+                        merge_secs += timing.clock() - start
+            items, nbytes = files.write_batch(chunks)
+            doc_queue.record_written(items, nbytes)
+            state.bytes_written += nbytes
+            now = time.time()
+            if now - rate_window["start"] >= 1:
+                state.writer_bytes_per_sec = \
+                    (state.bytes_written - rate_window["bytes"]) / \
+                    (now - rate_window["start"])
+                rate_window["start"] = now
+                rate_window["bytes"] = state.bytes_written
+            if merger:
+                if merge_timer:
+                    start = timing.clock()
+                merger.flush()
+                if merge_timer:
+                    merge_timer.add(merge_secs + timing.clock() - start)
+            if checkpointer:
+                checkpointer.maybe_save(files)
+
+        wait_timer = timing.stage("record.queue_wait")
         # Keep waiting if any of the tailer thread is still at work.
         while any(s.alive for s in state.tailer_states.values()):
-            try:
-                name, doc = doc_queue.get(block=True, timeout=1)
-                state.tailer_states[name].entries_written += 1
-                cPickle.dump(doc, files[name])
-            except Queue.Empty:
-                # gets nothing after timeout
-                continue
-        for f in files.values():
-            f.flush()
+            if wait_timer:
+                start = timing.clock()
+            batch = doc_queue.get_batch(batch_size, timeout=1)
+            if wait_timer:
+                wait_timer.add(timing.clock() - start)
+            # on timeout, still give the merger a chance to catch up
+            handle(batch)
+        # the tailers are gone, pick up what they left behind
+        while True:
+            batch = doc_queue.get_batch(batch_size, timeout=0)
+            if not batch:
+                break
+            handle(batch)
+        files.flush()
+        if checkpointer:
+            checkpointer.save(files)
+        if merger:
+            merger.finish()
         utils.LOG.info("All received docs are processed!")
 
     @staticmethod
@@ -172,70 +421,92 @@ class MongoQueryRecorder(object):
         msgs = []
         for key in state.tailer_states.keys():
             tailer_state = state.tailer_states[key]
+            lag = "n/a" if tailer_state.lag_secs is None \
+                else "{:.1f}s (max {:.1f}s)".format(tailer_state.lag_secs,
+                                                    tailer_state.max_lag_secs)
+            loss = tailer_state.loss
+            lost = "n/a" if loss is None \
+                else "~{} entries ({:.1f}s)".format(loss.lost_ops,
+                                                    loss.lost_secs)
             msg = "\n\t{}: received {} entries, {} of them were written, "\
-                  "last received entry ts: {}, last get-none ts: {}" .format(
+                  "{} sampled out, "\
+                  "last received entry ts: {}, last get-none ts: {}, "\
+                  "lag: {}, stalled on full queue: {:.1f}s, "\
+                  "reconnected {} times, lost {}" .format(
                       key,
                       tailer_state.entries_received,
                       tailer_state.entries_written,
+                      tailer_state.entries_sampled_out,
                       str(tailer_state.last_received_ts),
-                      str(tailer_state.last_get_none_ts))
+                      str(tailer_state.last_get_none_ts),
+                      lag,
+                      tailer_state.stall_secs,
+                      tailer_state.reconnects,
+                      lost)
             msgs.append(msg)
+        doc_queue = state.doc_queue
+        if doc_queue is not None:
+            msgs.append(
+                "\n\tqueue: {} docs, ~{} bytes, stalled {} times for "
+                "{:.1f}s in total".format(
+                    doc_queue.qsize(), doc_queue.bytes, doc_queue.stalls,
+                    doc_queue.stall_secs))
 
         utils.LOG.info("".join(msgs))
 
+    def discover_topology(self, config_options):
+        """Ask the mongos for the members of every shard.
+        @return: {shard: {"primary": host, "secondaries": [host, ...]}}, or
+            None if the mongos knows no replica set."""
+        if self.mongos_client is None:
+            self.mongos_client = self.connect_mongo(config_options)
+        return utils.get_cluster_topology(self.mongos_client)
+
     def get_topology(self, config_options):
-        topology = {}
-        mongos_conn = self.connect_mongo(config_options)
-        temp_topology = mongos_conn.admin.command("connPoolStats")
-        if 'replicaSets' in temp_topology:
-            for shard in temp_topology['replicaSets']:
-                topology[shard] = {'primary': None, 'secondaries': []}
-                for host in temp_topology['replicaSets'][shard]['hosts']:
-                    if host['ismaster'] is True:
-                        topology[shard]['primary'] = host['addr']
-                    elif host['secondary'] is True:
-                        topology[shard]['secondaries'].append(host['addr'])
-        else:
+        topology = self.discover_topology(config_options)
+        if topology is None:
             return False
 
         self.topology = topology
         return True
 
+    @staticmethod
+    def shard_server(shard, host, config_options, replica_set=True):
+        """The server config of `host`, a member of `shard`, connected to
+        as a member of the replica set, or on its own"""
+        server = {
+            'mongodb_uri': "mongodb://%s" % host,
+            'auth_db':  config_options['auth_db'],
+            'user':     config_options['user'],
+            'password': config_options['password']
+        }
+        server['replSet' if replica_set else 'shard'] = shard
+        return server
+
+    def _uses_secondaries(self):
+        return self.config.get('auto_config') is True and \
+            self.config['auto_config_options'].get('use_secondaries') is True
+
     def build_oplog_servers(self, config_options):
         oplog_servers = []
         for shard in self.topology:
-            temp_server = {
-                'mongodb_uri': "mongodb://%s" % self.topology[shard]['primary'],
-                'replSet':  shard,
-                'auth_db':  config_options['auth_db'],
-                'user':     config_options['user'],
-                'password': config_options['password']
-            }
-            oplog_servers.append(temp_server)
+            oplog_servers.append(self.shard_server(
+                shard, self.topology[shard]['primary'], config_options))
         return oplog_servers
 
     def build_profiler_servers(self, config_options):
         profiler_servers = []
+        use_secondaries = self._uses_secondaries()
         for shard in self.topology:
-            temp_server = {
-                'mongodb_uri': "mongodb://%s" % self.topology[shard]['primary'],
-                'replSet':  shard,
-                'auth_db':  config_options['auth_db'],
-                'user':     config_options['user'],
-                'password': config_options['password']
-            }
-            profiler_servers.append(temp_server)
-            if self.config['auto_config'] is True:
-                if 'use_secondaries' in self.config['auto_config_options']:
-                    if self.config['auto_config_options']['use_secondaries'] is True:
-                        for node in self.topology[shard]['secondaries']:
-                            temp_server = {
-                                'mongodb_uri': "mongodb://%s" % node,
-                                'auth_db':  config_options['auth_db'],
-                                'user':     config_options['user'],
-                                'password': config_options['password']
-                            }
-                            profiler_servers.append(temp_server)
+            # With the secondaries, every member is profiled on its own: a
+            # primary that steps down is still recorded, as a secondary.
+            profiler_servers.append(self.shard_server(
+                shard, self.topology[shard]['primary'], config_options,
+                replica_set=not use_secondaries))
+            if use_secondaries:
+                for node in self.topology[shard]['secondaries']:
+                    profiler_servers.append(self.shard_server(
+                        shard, node, config_options, replica_set=False))
         return profiler_servers
 
     def connect_mongo(self, server_config):
@@ -256,16 +527,86 @@ class MongoQueryRecorder(object):
                     sys.exit(1)
         return client
 
+    def _oplog_streams(self):
+        """The name of the source and of the file of the oplog of every
+        oplog client: "oplog" and the oplog output file for a single
+        replica set, or one of each per shard.
+        @return: {client name: (source name, file name)}"""
+        oplog_file = self.config["oplog_output_file"]
+        if len(self.oplog_clients) == 1:
+            return dict.fromkeys(self.oplog_clients, ("oplog", oplog_file))
+        streams = {}
+        for client_name in self.oplog_clients:
+            shard = self.shards.get(client_name, client_name)
+            streams[client_name] = ("oplog_%s" % shard,
+                                    "%s_%s" % (oplog_file, shard))
+        return streams
+
+    def _profiler_shards(self, oplog_streams):
+        """Pair every profiler source with the oplog source of its shard.
+        With a single oplog, every profiler source goes with it.
+        @return: {profiler source name: oplog source name}"""
+        by_shard = dict((self.shards.get(client_name, client_name), source)
+                        for client_name, (source, _)
+                        in oplog_streams.iteritems())
+        only_source = by_shard.values()[0] if len(by_shard) == 1 else None
+        shards = {}
+        for client_name in self.profiler_clients:
+            source = by_shard.get(self.shards.get(client_name, client_name),
+                                  only_source)
+            for db in self.config["target_databases"]:
+                shards["%s_%s" % (db, client_name)] = source
+        return shards
+
+    def _route(self, client_name, client, open_cursor, follow_primary,
+               catch_up=False):
+        """Where the cursors of a source reading from `client_name` are
+        reopened: with the same client, or with auto config, on the current
+        primary of its shard if `follow_primary`.
+        @param catch_up: see `failover.PrimaryRoute`."""
+        if self.live_topology is None or not follow_primary:
+            return failover.FixedRoute(client, client_name, open_cursor)
+        shard = self.shards[client_name]
+        options = self.config['auto_config_options']
+
+        def connect(host, direct):
+            return self.connect_mongo(self.shard_server(
+                shard, host, options, replica_set=not direct))
+        return failover.PrimaryRoute(self.live_topology, shard, client,
+                                     client_name, connect, open_cursor,
+                                     catch_up)
+
+    def _oplog_converter(self):
+        """The `oplogreplay.OplogConverter` of the recorded namespaces"""
+        return oplogreplay.OplogConverter(self.config["target_databases"],
+                                          self.config["target_collections"])
+
+    def _records_inserts(self):
+        """Whether inserts are among the recorded op types"""
+        if self.oplog_only:
+            return True
+        op_types = self.config.get("profiler_op_types")
+        return not op_types or "insert" in op_types
+
     def force_quit_all(self):
         """Gracefully quite all recording activities"""
         self.force_quit = True
 
-    def _generate_workers(self, files, state, start_utc_secs, end_utc_secs):
+    def _generate_workers(self, files, state, start_utc_secs, end_utc_secs,
+                          merger=None, checkpointer=None, resume_ts=None):
         """Generate the threads that tails the data sources and put the fetched
-        entries to the files"""
+        entries to the files (and the streaming merger, if any)
+        @param resume_ts: maps the names of the sources to the ts to resume
+            them after and the docs they wrote at that ts, see
+            `checkpoint.recover_files`."""
+        resume_ts = resume_ts or {}
         # Create working threads to handle to track/dump mongodb activities
         workers_info = []
-        doc_queue = Queue.Queue()
+        doc_queue = docqueue.DocQueue(
+            max_items=self.config.get("queue_max_docs", 100000),
+            max_bytes=self.config.get("queue_max_bytes", 256 << 20),
+            stop=lambda: state.timeout)
+        state.doc_queue = doc_queue
 
         # Writer thread, we only have one writer since we assume all files will
         # be written to the same device (disk or SSD), as a result it yields
@@ -274,47 +615,123 @@ class MongoQueryRecorder(object):
             "name": "write-all-docs-to-file",
             "thread": Thread(
                 target=MongoQueryRecorder._process_doc_queue,
-                args=(doc_queue, files, state))
+                args=(doc_queue, files, state, merger,
+                      self.config.get("writer_batch_size", 1000),
+                      checkpointer))
         })
-        for profiler_name, client in self.oplog_clients.items():
-            # create a profile collection tailer for each db
-            tailer = utils.get_oplog_tailer(client, ["i"],
-                                            self.config["target_databases"],
-                                            self.config["target_collections"],
-                                            Timestamp(start_utc_secs, 0))
-            oplog_cursor_id = tailer.cursor_id
-            workers_info.append({
+        # With a scheduler, a few threads poll all the cursors, which must
+        # then not block waiting for data.
+        tailer_threads = self.config.get("tailer_threads", 0)
+        await_data = not tailer_threads
+        # Only fetch the fields that make it to the output
+        project_fields = self.config.get("project_fields", True)
+        start_datetime = datetime.utcfromtimestamp(start_utc_secs)
+        end_datetime = datetime.utcfromtimestamp(end_utc_secs)
+
+        # every write, or only the inserts to complete the profiled ones
+        oplog_types = ["i", "u", "d", "c"] if self.oplog_only else ["i"]
+
+        def open_oplog(client, resume_after):
+            return utils.get_oplog_tailer(client, oplog_types,
+                                          self.config["target_databases"],
+                                          self.config["target_collections"],
+                                          Timestamp(start_utc_secs, 0),
+                                          await_data=await_data,
+                                          project_fields=project_fields,
+                                          resume_after=resume_after)
+
+        def open_profiler(db, client, resume_after):
+            return utils.get_profiler_tailer(client,
+                                             db,
+                                             self.config["target_collections"],
+                                             start_datetime,
+                                             await_data=await_data,
+                                             op_types=self.config.get("profiler_op_types"),
+                                             project_fields=project_fields,
+                                             resume_after=resume_after)
+
+        # Dead cursors are reopened where they left off
+        reconnect = self.config.get("tailer_reconnect", True)
+        max_retry_secs = self.config.get("tailer_reconnect_max_secs", 30)
+        lag_secs = self.config.get("merge_lag_secs", 5)
+
+        def track_loss(name, tailer):
+            state.tailers[name] = tailer
+            state.tailer_states[name].loss = tailer.loss
+
+        sources = []
+        oplog_clients = self.oplog_clients.items() \
+            if self._records_inserts() else []
+        oplog_streams = self._oplog_streams()
+        for profiler_name, client in oplog_clients:
+            # one oplog source per shard
+            oplog_source = oplog_streams[profiler_name][0]
+            resume_after, resume_docs = resume_ts.get(oplog_source, (None, 0))
+            tailer = failover.ResumableTailer(
+                oplog_source,
+                self._route(profiler_name, client, open_oplog, True),
+                resume_after, reconnect,
+                max_retry_secs=max_retry_secs,
+                loss=captureloss.LossTracker(oplog_source, start_datetime,
+                                             lag_secs),
+                resume_docs=resume_docs)
+            track_loss(oplog_source, tailer)
+            sources.append({
                 "name": "tailing-oplogs on %s" % (profiler_name),
-                "on_close":
-                lambda: self.oplog_client.kill_cursors([oplog_cursor_id]),
-                "thread": Thread(
-                    target=tail_to_queue,
-                    args=(tailer, "oplog", doc_queue, state,
-                          Timestamp(end_utc_secs, 0)))
+                "on_close": tailer.close,
+                "args": (tailer, oplog_source, doc_queue, state,
+                         Timestamp(end_utc_secs, 0))
             })
 
-        start_datetime = datetime.utcfromtimestamp(start_utc_secs)
-        end_datetime = datetime.utcfromtimestamp(end_utc_secs)
+        # With the secondaries, every member has its own profiler tailer
+        follow_primary = not self._uses_secondaries()
         for profiler_name, client in self.profiler_clients.items():
             # create a profile collection tailer for each db
             for db in self.config["target_databases"]:
-                tailer = utils.get_profiler_tailer(client,
-                                                   db,
-                                                   self.config["target_collections"],
-                                                   start_datetime
-                                                   )
                 tailer_id = "%s_%s" % (db, profiler_name)
-                profiler_cursor_id = tailer.cursor_id
-                workers_info.append({
+                resume_after, resume_docs = resume_ts.get(tailer_id, (None, 0))
+                tailer = failover.ResumableTailer(
+                    tailer_id,
+                    self._route(profiler_name, client,
+                                functools.partial(open_profiler, db),
+                                follow_primary, catch_up=True),
+                    resume_after, reconnect,
+                    max_retry_secs=max_retry_secs,
+                    loss=captureloss.LossTracker(tailer_id, start_datetime,
+                                                 lag_secs),
+                    resume_docs=resume_docs)
+                track_loss(tailer_id, tailer)
+                sources.append({
                     "name": "tailing-profiler for %s on %s" % (db, profiler_name),
-                    "on_close":
-                    lambda: self.profiler_client.kill_cursors([profiler_cursor_id]),
+                    "on_close": tailer.close,
+                    "args": (tailer, tailer_id, doc_queue, state,
+                             end_datetime)
+                })
+
+        pacer_args = (self.config.get("tailer_min_docs_per_poll", 1000),
+                      self.config.get("tailer_max_docs_per_poll", 16000),
+                      self.config.get("tailer_min_idle_secs", 0.05),
+                      self.config.get("tailer_max_idle_secs", 1))
+        if not tailer_threads:
+            # one thread per source
+            for source in sources:
+                workers_info.append({
+                    "name": source["name"],
+                    "on_close": source["on_close"],
                     "thread": Thread(
                         target=tail_to_queue,
-                        args=(tailer, tailer_id, doc_queue, state,
-                              end_datetime))
+                        args=source["args"] + (scheduler.Pacer(*pacer_args),))
+                })
+        else:
+            tailer_scheduler = scheduler.TailerScheduler(*pacer_args)
+            for source in sources:
+                tailer_scheduler.add(
+                    functools.partial(scheduled_poll, *source["args"]))
+            for index in xrange(tailer_threads):
+                workers_info.append({
+                    "name": "tailing-scheduler-%d" % index,
+                    "thread": Thread(target=tailer_scheduler.run_worker)
                 })
-                
 
         for worker_info in workers_info:
             utils.LOG.info("Starting thread: %s", worker_info["name"])
@@ -350,34 +767,167 @@ class MongoQueryRecorder(object):
     def _periodically_report_status(self, state):
         return MongoQueryRecorder._report_status(state)
 
-    def record(self):
-        """record the activities in the multithreading way"""
-        start_utc_secs = utils.now_in_utc_secs()
-        end_utc_secs = utils.now_in_utc_secs() + self.config["duration_secs"]
-        # We'll dump the recorded activities to `files`.
-        files = {
-            "oplog": open(self.config["oplog_output_file"], "wb")
-        }
+    def record(self, resume_from=None):
+        """record the activities in the multithreading way
+        @param resume_from: the checkpoint file of a recording that died, to
+            carry on with it instead of starting a new one.
+        """
+        # e.g. when set_mongo_profiling.py had profiling on everywhere
+        start_utc_secs = self.config.get("start_utc_secs") or \
+            utils.now_in_utc_secs()
+        end_utc_secs = start_utc_secs + self.config["duration_secs"]
+        if self.config.get("timing"):
+            timing.enable()
+        streaming_merge = self.config.get("streaming_merge", True)
+        resumed = None
+        if resume_from:
+            resumed = checkpoint.load(resume_from)
+            start_utc_secs = resumed["start_utc_secs"]
+            end_utc_secs = resumed["end_utc_secs"]
+            self.config["output_file"] = resumed["output_file"]
+            self.config["oplog_output_file"] = resumed.get(
+                "oplog_output_file", resumed["filenames"].get("oplog"))
+            self.config["intermediate_format"] = resumed["file_format"]
+            self.config["sample_rate"] = resumed.get("sample_rate")
+            self.config["segment_secs"] = resumed.get("segment_secs")
+            self.config["segment_bytes"] = resumed.get("segment_bytes")
+            # what was merged on the fly before the crash is lost, merge the
+            # files once they are complete instead
+            streaming_merge = False
+        # Without the streaming merge, the intermediate files are the only
+        # way to get to the final output.
+        keep_intermediate_files = \
+            self.config.get("keep_intermediate_files", True) \
+            or not streaming_merge
+        sample_rate = self.config.get("sample_rate")
         tailer_names = []
         profiler_output_files = []
-        # open a file for each profiler client, append client name as suffix
         for client_name in self.profiler_clients:
-            # create a file for each (client,db)
             for db in self.config["target_databases"]:
                 tailer_name = "%s_%s" % (db, client_name)
                 tailer_names.append(tailer_name)
                 profiler_output_files.append(tailer_name)
-                files[tailer_name] = open(tailer_name, "wb")
-        tailer_names.append("oplog")
+        # The oplog is only tailed to complete the inserts. Its files are
+        # still written, maybe empty, for the post-hoc merge.
+        oplog_files = dict(self._oplog_streams().values())
+        if self._records_inserts():
+            tailer_names.extend(sorted(oplog_files))
+        profiler_shards = self._profiler_shards(self._oplog_streams())
+
+        # We'll dump the recorded activities to `files`: one for the oplog
+        # of each shard and one for each (db, profiler client), named after
+        # the tailer.
+        filenames = {}
+        if keep_intermediate_files:
+            filenames.update(oplog_files)
+            for tailer_name in profiler_output_files:
+                filenames[tailer_name] = tailer_name
+        file_format = self.config.get("intermediate_format", "bson")
+
+        resume_ts = None
+        checkpointer = None
+        mode = "wb"
+        if resumed:
+            if set(filenames) != set(resumed["filenames"]):
+                raise ValueError(
+                    "Cannot resume from %s, it was recording %s, not %s" %
+                    (resume_from, sorted(resumed["filenames"]),
+                     sorted(filenames)))
+            resume_ts = checkpoint.recover_files(resumed)
+            mode = "ab"
+        checkpoint_interval = self.config.get("checkpoint_interval_secs", 10)
+        if filenames and checkpoint_interval:
+            checkpointer = checkpoint.Checkpointer(
+                resume_from or checkpoint.checkpoint_filename(
+                    self.config["output_file"]),
+                {"start_utc_secs": start_utc_secs,
+                 "end_utc_secs": end_utc_secs,
+                 "output_file": self.config["output_file"],
+                 "oplog_output_file": self.config["oplog_output_file"],
+                 "filenames": filenames,
+                 "file_format": file_format,
+                 "sample_rate": self.config.get("sample_rate"),
+                 "segment_secs": self.config.get("segment_secs"),
+                 "segment_bytes": self.config.get("segment_bytes")},
+                checkpoint_interval)
+            utils.LOG.info("Checkpointing to %s, pass it to --resume to carry "
+                           "on if the recording dies", checkpointer.filename)
+
+        rotation = segments.Rotation(self.config.get("segment_secs"),
+                                     self.config.get("segment_bytes"))
+        manifest = None
+        if rotation.enabled:
+            manifest = segments.Manifest(self.config["output_file"], rotation)
+            utils.LOG.info("Writing the files as segments, listed in %s",
+                           manifest.filename)
+        writer_processes = self.config.get("writer_processes", 0)
+        if writer_processes and filenames:
+            # Started before any tailer thread, so that forking is safe.
+            files = writerpool.WriterPool(filenames, file_format,
+                                          writer_processes, mode=mode,
+                                          rotation=rotation)
+        else:
+            files = spool.WriterGroup(
+                filenames, file_format, mode, rotation,
+                on_rotate=manifest.save if manifest else None)
+        if manifest is not None:
+            manifest.intermediate = files.segment_summaries
+
+        merger = None
+        if streaming_merge:
+            output = merge.open_output(
+                self.config["output_file"],
+                self.config.get("output_compression"), rotation, manifest,
+                self.config.get("index_every_ops"))
+            files_to_close = [output]
+            if self.oplog_only:
+                merger = oplogreplay.OplogMerger(
+                    output, sorted(oplog_files), self._oplog_converter(),
+                    lag_secs=self.config.get("merge_lag_secs", 5),
+                    sampler=sampling.make_sampler(sample_rate))
+            else:
+                merger = merge.StreamingMerger(
+                    output, profiler_output_files,
+                    oplog_sources=sorted(oplog_files)
+                    if self._records_inserts() else [],
+                    shards=profiler_shards,
+                    lag_secs=self.config.get("merge_lag_secs", 5),
+                    sampler=sampling.make_sampler(sample_rate))
+        else:
+            files_to_close = []
+
         state = MongoQueryRecorder. RecordingState(tailer_names)
+        state.sampler = sampling.make_sampler(sample_rate)
+        state.merger = merger
+        self.state = state
+        metrics_server = None
+        if self.config.get("metrics_port"):
+            metrics_server = metrics.MetricsServer(
+                state, self.config["metrics_port"],
+                self.config.get("metrics_host", "127.0.0.1"))
         # Create a series working threads to handle to track/dump mongodb
         # activities. On return, these threads have already started.
         workers_info = self._generate_workers(files, state, start_utc_secs,
-                                              end_utc_secs)
+                                              end_utc_secs, merger,
+                                              checkpointer, resume_ts)
         timer_control = self._periodically_report_status(state)
+        topology_control = None
+        topology_check_secs = self.config.get("topology_check_secs", 10)
+        if self.live_topology is not None and topology_check_secs:
+            # a primary that steps down may keep the cursors open
+            topology_control = utils.set_interval(
+                topology_check_secs, start_immediately=False,
+                exec_on_exit=False)(self.live_topology.refresh)(True)
+        loss_control = None
+        loss_check_secs = self.config.get("capture_loss_check_secs", 10)
+        if loss_check_secs:
+            loss_control = utils.set_interval(
+                loss_check_secs, start_immediately=False,
+                exec_on_exit=False)(check_capture_loss)(state)
 
-        # Waiting till due time arrives
-        while all(s.alive for s in state.tailer_states.values()) \
+        # Waiting till due time arrives, a source that is done does not stop
+        # the others
+        while any(s.alive for s in state.tailer_states.values()) \
                 and (utils.now_in_utc_secs() < end_utc_secs) \
                 and not self.force_quit:
             time.sleep(1)
@@ -385,17 +935,122 @@ class MongoQueryRecorder(object):
         state.timeout = True
 
         self._join_workers(state, workers_info)
-        timer_control.set()  # stop status report
+        # stop the status report and the checks, and wait for them not to
+        # run on while the recording is torn down
+        controls = [control for control in
+                    (timer_control, topology_control, loss_control)
+                    if control is not None]
+        for control in controls:
+            control.set()
+        for control in controls:
+            control.thread.join(INTERVAL_JOIN_SECS)
+            if control.thread.is_alive():
+                utils.LOG.error("Thread %s didn't exit after %d seconds",
+                                control.thread.name, INTERVAL_JOIN_SECS)
+        if metrics_server:
+            metrics_server.stop()
         utils.LOG.info("Preliminary recording completed!")
 
-        for f in files.values():
+        if manifest is not None:
+            # the writer processes report their segments at checkpoints
+            try:
+                files.checkpoint()
+            except writerpool.WriterDied, e:
+                utils.LOG.error("The manifest misses segments: %s", e)
+        files.close()
+        for f in files_to_close:
             f.close()
 
-        # Fill the missing insert op details from oplog
-        merge.merge_to_final_output(
-            oplog_output_file=self.config["oplog_output_file"],
-            profiler_output_files=profiler_output_files,
-            output_file=self.config["output_file"])
+        # the files to merge, with which oplog file goes with which
+        # profiler file, all by the same absolute names: the same for
+        # merge.py as for the post-hoc merge below
+        recorded_files = {
+            "oplog": sorted(os.path.abspath(name)
+                            for name in oplog_files.values()),
+            "profilers": [os.path.abspath(name)
+                          for name in profiler_output_files],
+            "shards": dict(
+                (os.path.abspath(name), os.path.abspath(oplog_files[source]))
+                for name, source in profiler_shards.iteritems()
+                if source is not None)}
+        if filenames:
+            if self.oplog_only:
+                # for merge.py to convert the oplog files the same way
+                recorded_files["oplog_only"] = {
+                    "target_databases": self.config["target_databases"],
+                    "target_collections":
+                        sorted(self.config["target_collections"] or [])}
+            metadata.update(self.config["output_file"],
+                            recorded_files=recorded_files)
+        metadata.update(self.config["output_file"],
+                        sample_rate=sample_rate or 1.0,
+                        capture_loss=self._capture_loss(state))
+        if streaming_merge:
+            utils.LOG.info("Ops were merged while recording, output file "
+                           "is ready: %s", self.config["output_file"])
+        else:
+            self._merge(recorded_files["oplog"], recorded_files["profilers"],
+                        recorded_files["shards"], sample_rate, rotation,
+                        manifest)
+        if manifest is not None:
+            manifest.save(complete=True)
+        if checkpointer:
+            checkpointer.remove()
+        if timing.ENABLED:
+            metadata.update(self.config["output_file"],
+                            timing=timing.report())
+
+    @staticmethod
+    def _capture_loss(state):
+        """What every source lost, for the metadata: the recording is
+        complete if none lost anything"""
+        sources = dict((name, tailer_state.loss.summary())
+                       for name, tailer_state in state.tailer_states.items()
+                       if tailer_state.loss is not None)
+        lossy = sorted(name for name, loss in sources.iteritems()
+                       if loss["wraps"] or loss["invalidated_cursors"])
+        if lossy:
+            utils.LOG.error("The recording misses ops that were overwritten "
+                            "before they were read, from: %s",
+                            ", ".join(lossy))
+        return {"complete": not lossy, "sources": sources}
+
+    def _merge(self, oplog_files, profiler_output_files, shards,
+               sample_rate, rotation=None, manifest=None):
+        """Fill the missing insert op details from oplog
+        @param shards: maps the profiler files to the oplog file of their
+            shard.
+        @param rotation, manifest: see `merge.open_output`."""
+        merge_workers = self.config.get("merge_workers", 1)
+        index_every_ops = self.config.get("index_every_ops")
+        if self.oplog_only:
+            # a single pass, the oplog files are already in `ts` order
+            oplogreplay.convert_to_final_output(
+                oplog_files, self.config["output_file"],
+                self._oplog_converter(),
+                compression=self.config.get("output_compression"),
+                sample_rate=sample_rate, rotation=rotation,
+                manifest=manifest, index_every_ops=index_every_ops)
+        elif merge_workers == 1:
+            merge.merge_to_final_output(
+                oplog_output_file=oplog_files,
+                profiler_output_files=profiler_output_files,
+                output_file=self.config["output_file"],
+                compression=self.config.get("output_compression"),
+                sample_rate=sample_rate,
+                shards=shards, rotation=rotation, manifest=manifest,
+                index_every_ops=index_every_ops)
+        else:
+            parallelmerge.parallel_merge_to_final_output(
+                oplog_output_file=oplog_files,
+                profiler_output_files=profiler_output_files,
+                output_file=self.config["output_file"],
+                workers=merge_workers or None,
+                max_open_files=self.config.get("merge_max_open_files", 64),
+                compression=self.config.get("output_compression"),
+                sample_rate=sample_rate,
+                shards=shards, rotation=rotation, manifest=manifest,
+                index_every_ops=index_every_ops)
 
 
 def get_args():
@@ -424,6 +1079,9 @@ def get_args():
                                     metavar='RECORDING_NAME')
     parser.add_argument('-z', '--noop', dest='noop', action='store_true', required=False, default=False,
                                         help='Just output the merged configuration, do not actually start the recording')
+    parser.add_argument('-r', '--resume', dest='resume', required=False,
+                        help='Carry on with the recording that saved this checkpoint file (OUTPUT_FILE.checkpoint) before it died',
+                        metavar='CHECKPOINT_FILE')
 
     args = parser.parse_args()
 
@@ -504,7 +1162,7 @@ def main():
         recorder.force_quit_all()
     signal.signal(signal.SIGINT, signal_handler)
 
-    recorder.record()
+    recorder.record(resume_from=args.resume)
 
 if __name__ == '__main__':
     main()
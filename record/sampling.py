@@ -0,0 +1,76 @@
+"""Record a deterministic fraction of the ops.
+
+Whether an op is kept only depends on a hash of its namespace and either
+the `_id` it targets or, failing that, the shape of its query. So the same
+op is kept no matter when or where it is looked at, and sampling twice with
+the same rate keeps the same ops. The recorder drops the non-insert ops as
+they come off the profiler; inserts are only sampled once paired with their
+oplog entry, which is where their `_id` is known for sure.
+"""
+import zlib
+
+# see `Sampler.keep`
+_HASH_RANGE = 1 << 32
+
+
+def query_shape(value):
+    """The structure of a query, without its values, as a string: two
+    queries differing only by the values they look for have the same
+    shape"""
+    if isinstance(value, dict):
+        return "{%s}" % ",".join(
+            "%s:%s" % (key, query_shape(value[key])) for key in sorted(value))
+    if isinstance(value, (list, tuple)):
+        # {"$in": [1, 2]} and {"$in": [1, 2, 3]} have the same shape
+        return "[%s]" % ",".join(sorted(set(query_shape(v) for v in value)))
+    return "?"
+
+
+def _unwrap_query(query):
+    """The actual query of a find that also has modifiers, e.g. a sort"""
+    for key in ("$query", "query"):
+        if isinstance(query.get(key), dict):
+            return query[key]
+    return query
+
+
+def sample_key(doc):
+    """The string an op is sampled by"""
+    ns = doc.get("ns")
+    op = doc.get("op")
+    if op == "insert" or op == "i":
+        inserted = doc.get("o") or doc.get("query") or {}
+        return "%s|%r" % (ns, inserted.get("_id"))
+    if op == "command":
+        return "%s|command|%s" % (ns, query_shape(doc.get("command")))
+    query = _unwrap_query(doc.get("query") or {})
+    _id = query.get("_id")
+    if _id is not None and not (isinstance(_id, dict) and
+                                any(k.startswith("$") for k in _id)):
+        return "%s|%r" % (ns, _id)
+    return "%s|%s|%s" % (ns, op, query_shape(query))
+
+
+class Sampler(object):
+
+    """Keeps about `rate` of the ops, see the module doc"""
+
+    def __init__(self, rate):
+        if not 0 < rate <= 1:
+            raise ValueError("The sample rate must be in (0, 1], not %s" %
+                             rate)
+        self.rate = rate
+        self.threshold = int(rate * _HASH_RANGE)
+
+    def keep(self, doc):
+        key = sample_key(doc)
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return zlib.crc32(key) % _HASH_RANGE < self.threshold
+
+
+def make_sampler(rate):
+    """Return a `Sampler`, or None if every op is kept anyway"""
+    if rate is None or rate >= 1:
+        return None
+    return Sampler(rate)
@@ -0,0 +1,131 @@
+"""Multiplex many tailing cursors over a small, fixed pool of threads"""
+import heapq
+import itertools
+import threading
+import time
+
+
+class Pacer(object):
+
+    """Decides how soon and how much to poll a source next, from what its
+    last polls returned.
+
+    A source that fills its whole batch is hot: it is polled again right
+    away, and allowed a twice larger batch, up to `max_batch`. A source that
+    runs dry gets smaller batches again, and one that returns nothing is
+    polled less and less often, up to every `max_idle_interval` seconds.
+    """
+
+    def __init__(self, min_batch=1000, max_batch=16000,
+                 min_idle_interval=0.05, max_idle_interval=1.0):
+        self.min_batch = min_batch
+        self.max_batch = max(min_batch, max_batch)
+        self.min_idle_interval = min_idle_interval
+        self.max_idle_interval = max_idle_interval
+        self.batch = min_batch
+        self.interval = 0.0
+
+    def update(self, received):
+        """Account for a poll that returned `received` docs.
+        @return: the seconds to wait before the next poll."""
+        if received >= self.batch:
+            self.interval = 0.0
+            self.batch = min(2 * self.batch, self.max_batch)
+        elif received > 0:
+            self.interval = self.min_idle_interval
+            self.batch = max(self.batch // 2, self.min_batch)
+        else:
+            self.interval = min(max(2 * self.interval, self.min_idle_interval),
+                                self.max_idle_interval)
+            self.batch = self.min_batch
+        return self.interval
+
+
+class TailerScheduler(object):
+
+    """Polls many sources from a fixed number of worker threads.
+
+    A source is a callable that moves up to the given number of docs its
+    cursor has to offer to the doc queue, without blocking for new data, and
+    returns how many docs it moved, or None once the source is done. Each
+    source is paced by a `Pacer`: hot sources are polled again right away,
+    and idle ones less and less often. The sources are polled in rounds:
+    the ones due when a round starts are polled busiest first, and those
+    that come due meanwhile wait for the next round, so that a hot source
+    polled again and again cannot starve the others. Each source is polled
+    by one worker at a time, so its docs stay in order.
+    """
+
+    def __init__(self, min_docs_per_poll=1000, max_docs_per_poll=16000,
+                 min_idle_interval=0.05, max_idle_interval=1.0):
+        """
+        @param max_docs_per_poll: the most docs a hot source may move in a
+            single poll before the other sources get their turn.
+        """
+        self.pacer_args = (min_docs_per_poll, max_docs_per_poll,
+                           min_idle_interval, max_idle_interval)
+        # the sources waiting to be due: (due time, sequence, source)
+        self.waiting = []
+        # the round of due sources: (-docs per poll, sequence, source)
+        self.due = []
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.sources = 0
+
+    def add(self, poll):
+        """Add a source, see the class doc"""
+        source = {"poll": poll, "pacer": Pacer(*self.pacer_args),
+                  "rate": 0.0}
+        with self.cond:
+            self.sources += 1
+            heapq.heappush(self.waiting,
+                           (time.time(), next(self.sequence), source))
+            self.cond.notify()
+
+    def _next_due(self):
+        """Wait for the next source that is due, or return None once all the
+        sources are done"""
+        with self.cond:
+            while True:
+                if self.sources == 0:
+                    return None
+                now = time.time()
+                if not self.due:
+                    # a new round, of every source due by now
+                    while self.waiting and self.waiting[0][0] <= now:
+                        _, sequence, source = heapq.heappop(self.waiting)
+                        heapq.heappush(self.due,
+                                       (-source["rate"], sequence, source))
+                if self.due:
+                    return heapq.heappop(self.due)[2]
+                if not self.waiting:
+                    # every remaining source is being polled right now
+                    self.cond.wait()
+                    continue
+                self.cond.wait(self.waiting[0][0] - now)
+
+    def _reschedule(self, source, received):
+        with self.cond:
+            if received is None:
+                self.sources -= 1
+                self.cond.notify_all()
+                return
+            interval = source["pacer"].update(received)
+            # smoothed docs per poll, to service the busiest sources first
+            source["rate"] = (source["rate"] + received) / 2.0
+            heapq.heappush(self.waiting,
+                           (time.time() + interval, next(self.sequence),
+                            source))
+            self.cond.notify()
+
+    def run_worker(self):
+        """Body of a worker thread, returns once all the sources are done"""
+        while True:
+            source = self._next_due()
+            if source is None:
+                return
+            received = None
+            try:
+                received = source["poll"](source["pacer"].batch)
+            finally:
+                self._reschedule(source, received)
@@ -0,0 +1,234 @@
+"""Rotate the recorded files into segments, listed in a manifest.
+
+A long recording makes files too big to handle, that cannot be used before
+it ends. With "segment_secs" and/or "segment_bytes", every file is written
+as a series of segments instead: OUTPUT holds the first one, then come
+OUTPUT.00001, OUTPUT.00002... A new segment starts when the ops reach the
+next multiple of `segment_secs` (in UTC seconds since the epoch, e.g. every
+minute on the minute), or when the current one holds `segment_bytes`. The
+merged ops come in `ts` order, so the time segments of the final output
+split it cleanly; each has its own time index (see `timeindex`).
+
+OUTPUT.manifest.json lists the segments of the final output and of every
+intermediate file: their time range, number of ops and bytes, and whether
+they are complete. A complete segment of the final output can be shipped,
+compressed or replayed while the recording goes on. The intermediate files
+are read back as a whole by `spool.iter_docs`.
+"""
+import calendar
+import json
+import os
+import utils
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def manifest_filename(output_file):
+    return output_file + MANIFEST_SUFFIX
+
+
+def segment_filename(filename, index):
+    """The file of the segment `index` of `filename`: the first one keeps
+    the name"""
+    if index == 0:
+        return filename
+    return "%s.%05d" % (filename, index)
+
+
+def segment_files(filename):
+    """The segments of `filename` on disk, in order"""
+    files = []
+    while os.path.exists(segment_filename(filename, len(files))):
+        files.append(segment_filename(filename, len(files)))
+    return files
+
+
+def remove_segments(filename, suffixes=("",)):
+    """Remove the segments of a previous recording to `filename` but the
+    first one, which is overwritten anyway, and their `suffixes` files"""
+    for segment in segment_files(filename)[1:]:
+        for suffix in suffixes:
+            if os.path.exists(segment + suffix):
+                os.remove(segment + suffix)
+
+
+def epoch_secs(ts):
+    """A profiler `datetime` or an oplog `Timestamp` in seconds since the
+    epoch"""
+    ts = utils.ts_to_datetime(ts)
+    return calendar.timegm(ts.timetuple()) + ts.microsecond / 1e6
+
+
+def load(output_file):
+    """The manifest of `output_file`, empty if there is none"""
+    filename = manifest_filename(output_file)
+    if not os.path.exists(filename):
+        return {}
+    return json.load(open(filename))
+
+
+class Rotation(object):
+
+    """When a new segment starts"""
+
+    def __init__(self, segment_secs=None, segment_bytes=None):
+        self.segment_secs = segment_secs
+        self.segment_bytes = segment_bytes
+
+    @property
+    def enabled(self):
+        return bool(self.segment_secs or self.segment_bytes)
+
+    def ends_at(self, secs):
+        """When the segment whose first op is at `secs` ends, None if
+        segments are not cut by time"""
+        if not self.segment_secs:
+            return None
+        return (int(secs) // self.segment_secs + 1) * self.segment_secs
+
+    def is_full(self, segment):
+        return bool(self.segment_bytes) and segment.ops and \
+            segment.bytes >= self.segment_bytes
+
+    def is_past(self, segment, secs):
+        """Whether an op at `secs` belongs to a later segment"""
+        return segment.ends_at is not None and secs >= segment.ends_at
+
+
+class Segment(object):
+
+    """A segment of a file, and what it holds"""
+
+    def __init__(self, filename, index, rotation):
+        self.filename = segment_filename(filename, index)
+        self.index = index
+        self.rotation = rotation
+        self.first_secs = None
+        self.last_secs = None
+        self.ends_at = None
+        self.ops = 0
+        # uncompressed
+        self.bytes = 0
+        self.complete = False
+
+    def add(self, first_secs, last_secs, ops=1, nbytes=0):
+        """`ops` more ops, from `first_secs` to `last_secs`"""
+        if self.first_secs is None:
+            self.first_secs = first_secs
+            self.last_secs = last_secs
+            self.ends_at = self.rotation.ends_at(first_secs)
+        else:
+            self.first_secs = min(self.first_secs, first_secs)
+            self.last_secs = max(self.last_secs, last_secs)
+        self.ops += ops
+        self.bytes += nbytes
+
+    def summary(self, complete=False):
+        """The segment, for the manifest"""
+        return {"file": os.path.abspath(self.filename),
+                "index": self.index,
+                "first_ts": self.first_secs,
+                "last_ts": self.last_secs,
+                "ops": self.ops,
+                "bytes": os.path.getsize(self.filename)
+                if os.path.exists(self.filename) else 0,
+                "complete": self.complete or complete}
+
+
+class SegmentedOutput(object):
+
+    """Same interface as `timeindex.IndexedWriter`: the final output,
+    written segment by segment. A segment ends right before the op `mark`ed
+    past it."""
+
+    def __init__(self, output_file, open_segment, rotation, manifest=None):
+        """
+        @param open_segment: opens the `timeindex.IndexedWriter` of a
+            segment, given its file name.
+        @param manifest: a `Manifest`, saved whenever a segment starts.
+        """
+        self.output_file = output_file
+        self.open_segment = open_segment
+        self.rotation = rotation
+        self.manifest = manifest
+        self.segments = []
+        self.writer = None
+        if manifest is not None:
+            manifest.output = self.segments
+        remove_segments(output_file, ("", ".idx"))
+        self._rotate()
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.segments[-1].complete = True
+        segment = Segment(self.output_file, len(self.segments), self.rotation)
+        self.writer = self.open_segment(segment.filename)
+        self.segments.append(segment)
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def mark(self, ts):
+        secs = epoch_secs(ts)
+        segment = self.segments[-1]
+        if self.rotation.is_full(segment) or \
+                self.rotation.is_past(segment, secs):
+            self._rotate()
+            segment = self.segments[-1]
+        segment.add(secs, secs)
+        self.writer.mark(ts)
+
+    def write(self, data):
+        self.writer.write(data)
+        self.segments[-1].bytes += len(data)
+
+    def tell(self):
+        return sum(segment.bytes for segment in self.segments)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        self.segments[-1].complete = True
+        if self.manifest is not None:
+            self.manifest.save()
+
+
+class Manifest(object):
+
+    """OUTPUT.manifest.json, rewritten whenever a segment starts"""
+
+    def __init__(self, output_file, rotation):
+        self.filename = manifest_filename(output_file)
+        self.rotation = rotation
+        # the `Segment`s of the final output
+        self.output = []
+        # returns the segment summaries of every intermediate file, by
+        # source name. Those of an earlier manifest are kept when the
+        # output is merged again from the same files.
+        previous = load(output_file).get("intermediate", {})
+        self.intermediate = lambda: previous
+        self.complete = False
+
+    def save(self, complete=None):
+        """Write the manifest, the recording is done if `complete`"""
+        if complete is not None:
+            self.complete = complete
+        manifest = {
+            "segment_secs": self.rotation.segment_secs,
+            "segment_bytes": self.rotation.segment_bytes,
+            "complete": self.complete,
+            "output": [segment.summary(self.complete)
+                       for segment in self.output],
+            "intermediate": self.intermediate()}
+        if self.complete:
+            for segments in manifest["intermediate"].values():
+                for segment in segments:
+                    segment["complete"] = True
+        # never leave a half written manifest behind
+        tmp_filename = self.filename + ".tmp"
+        f = open(tmp_filename, "w")
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(tmp_filename, self.filename)
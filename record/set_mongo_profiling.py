@@ -1,13 +1,43 @@
 #!/usr/bin/python
+r"""Enable or disable the profiling of every database of a host, or of every
+member of every shard of a cluster:
+
+    python set_mongo_profiling.py -a enable -n HOSTNAME -p PORT
+    python set_mongo_profiling.py -a enable -m mongodb://MONGOS:27017
+
+With a mongos, the members of the shards are found the way the recorder's
+"auto_config" finds them, and all the (member, database) pairs are set at
+once by a pool of `--workers` threads. On a primary, enabling drops
+`system.profile` and creates it again with `--size` bytes, disabling drops
+it. Secondaries only get their profiling level set.
+
+With `--probe_secs`, each `system.profile` is sized after the traffic of
+its database rather than to a fixed `--size`: profiling is turned on for
+that long on the primaries, the rate of the ops profiled and their average
+size are measured, and each collection is made big enough to hold
+`--headroom_secs` of them, at least `--size` bytes and at most
+`--max_size`. The plan is printed before it is applied, `--plan_only` stops
+there and sets the profiling levels back.
+
+The time each member took is reported, then the time by which every member
+was done: set it as "start_utc_secs" in the recorder's config to record from
+there on, when profiling is on everywhere.
+"""
+import math
 import pymongo
 import string
 import sys
+import time
+from bson import BSON
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from argparse import ArgumentParser
+import utils
 
 def get_args():
     parser = ArgumentParser(description='Run health checks of mongo and mtools systems')
-    
+
     parser.add_argument('-a', '--action', dest='action', required=True,
                       help='action to take (enable|disable)',
                       metavar='(enable|disable)')
@@ -15,6 +45,9 @@ def get_args():
                       help='target host - default localhost', metavar='HOSTNAME')
     parser.add_argument('-p', '--port', dest='port', type=int, default=27017,
                       help='target port - default 27017', metavar='PORT')
+    parser.add_argument('-m', '--mongos', dest='mongos',
+                        help='mongodb uri of a mongos: set every member of '
+                        'every shard instead of HOSTNAME', metavar='MONGOS_URI')
     parser.add_argument('-s', '--size', dest='size', default=16777216, type=int,
                         metavar='SIZE_BYTES',
                         help='desired byte size of the system.profile collection'
@@ -23,41 +56,303 @@ def get_args():
                         help='comma separated list of databases to exclude - '
                         'default local,test', metavar='EXCLUDE_LIST',
                         default='local,test')
-    
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=16,
+                        help='databases set at the same time - default 16')
+    parser.add_argument('-u', '--user', dest='user',
+                        help='user to authenticate as on every host')
+    parser.add_argument('--password', dest='password',
+                        help='password of USER')
+    parser.add_argument('--auth_db', dest='auth_db', default='admin',
+                        help='database USER is defined in - default admin')
+
+    parser.add_argument('--probe_secs', dest='probe_secs', type=float,
+                        default=0,
+                        help='profile the primaries for that many seconds '
+                        'first, and size each system.profile after the ops '
+                        'profiled - default 0, SIZE_BYTES everywhere')
+    parser.add_argument('--headroom_secs', dest='headroom_secs', type=float,
+                        default=60,
+                        help='seconds of ops each system.profile holds, at '
+                        'the probed rate - default 60')
+    parser.add_argument('--max_size', dest='max_size', type=int,
+                        metavar='MAX_SIZE_BYTES',
+                        help='largest system.profile collection - default '
+                        'no limit')
+    parser.add_argument('--plan_only', dest='plan_only', action='store_true',
+                        default=False,
+                        help='print the sizes probed and leave the profiling '
+                        'as it was')
+
     args = parser.parse_args()
-   
+
     if args.action not in ['enable', 'disable']:
         print("Unknown action %s" % args.action)
         sys.exit(1)
 
     return args
 
-if __name__ == '__main__':
-    args = get_args()
-    
-    try: 
-        client = pymongo.MongoClient(args.hostname, args.port)
-        
-        db_names = client.database_names()
+
+def connect(uri, args):
+    """A client of `uri`, a host or a mongodb uri, authenticated as USER if
+    there is one"""
+    client = pymongo.MongoClient(uri, slaveOk=True)
+    if args.user is not None and args.password is not None:
+        client[args.auth_db].authenticate(args.user, args.password)
+    return client
+
+
+def find_hosts(args):
+    """The hosts to set: every member of every shard the mongos knows of,
+    or the single host given.
+    @return: a list of (shard, host), the shard is None for a single
+        host."""
+    if not args.mongos:
+        return [(None, "%s:%d" % (args.hostname, args.port))]
+    mongos = connect(args.mongos, args)
+    topology = utils.get_cluster_topology(mongos)
+    mongos.close()
+    if topology is None:
+        raise ValueError("%s knows no shard" % args.mongos)
+    hosts = []
+    for shard in sorted(topology):
+        members = topology[shard]
+        if members['primary'] is None:
+            print("WARN: shard %s has no primary, its system.profile "
+                  "collections are left as they are" % shard)
+        else:
+            hosts.append((shard, members['primary']))
+        hosts.extend((shard, host) for host in members['secondaries'])
+    if not hosts:
+        raise ValueError("%s knows no host to set" % args.mongos)
+    return hosts
+
+
+# the most profile docs read to estimate their average size
+PROBE_SAMPLE_DOCS = 1000
+
+
+def start_probe(node, db_name):
+    """Profile all the ops of a database, from now on.
+    @return: the probe "struct", `error` is set if that failed."""
+    probe = utils.EmptyClass()
+    probe.node = node
+    probe.db_name = db_name
+    probe.error = None
+    probe.ops = 0
+    probe.rate = 0.0
+    probe.avg_doc_size = 0
+    try:
+        db = node.client[db_name]
+        probe.was = db.command('profile', -1)['was']
+        # the server's clock, the one of the profile docs' ts
+        probe.started_at = node.client.admin.command('isMaster')['localTime']
+        db.command('profile', 2)
+    except pymongo.errors.PyMongoError as e:
+        probe.error = e
+    return probe
+
+
+def finish_probe(probe):
+    """Measure the rate and the average size of the ops profiled since
+    `start_probe`, and set the profiling level back"""
+    if probe.error is not None:
+        return probe
+    node = probe.node
+    try:
+        ended_at = node.client.admin.command('isMaster')['localTime']
+        profile = node.client[probe.db_name]['system.profile']
+        window = {"ts": {"$gte": probe.started_at, "$lte": ended_at}}
+        probe.ops = profile.find(window).count()
+        # a small collection may have wrapped since, the rate is over the
+        # time its docs cover
+        oldest = list(profile.find({}, {"ts": 1}).sort("$natural", 1)
+                      .limit(1))
+        started_at = probe.started_at
+        if oldest and oldest[0]["ts"] > started_at:
+            started_at = oldest[0]["ts"]
+        secs = (ended_at - started_at).total_seconds()
+        if probe.ops and secs > 0:
+            probe.rate = probe.ops / secs
+            sizes = [len(BSON.encode(doc)) for doc in
+                     profile.find(window).limit(PROBE_SAMPLE_DOCS)]
+            probe.avg_doc_size = sum(sizes) / max(1, len(sizes))
+        node.client[probe.db_name].command('profile', probe.was)
+    except pymongo.errors.PyMongoError as e:
+        probe.error = e
+    return probe
+
+
+def plan_size(probe, args):
+    """The size of the system.profile of a probed database: `--headroom_secs`
+    of its ops, between `--size` and `--max_size`"""
+    size = max(args.size,
+               int(math.ceil(probe.rate * probe.avg_doc_size *
+                             args.headroom_secs)))
+    if args.max_size:
+        size = min(size, args.max_size)
+    return size
+
+
+def probe_sizes(pool, nodes, args):
+    """Probe every database of the primaries at once, for `--probe_secs`.
+    @return: the probes, their `size` set unless they failed."""
+    tasks = [(node, db_name) for node in nodes
+             if node.error is None and node.is_primary
+             for db_name in node.db_names]
+    probes = pool.map(lambda task: start_probe(*task), tasks)
+    time.sleep(args.probe_secs)
+    probes = pool.map(finish_probe, probes)
+    for probe in probes:
+        probe.size = None if probe.error is not None \
+            else plan_size(probe, args)
+    return probes
+
+
+def report_plan(probes, args):
+    print("%-12s %-24s %-16s %9s %9s %12s %9s" % (
+        "shard", "host", "database", "ops/s", "doc size", "size", "holds"))
+    for probe in probes:
+        if probe.error is not None:
+            print("%-12s %-24s %-16s ERROR: %s" % (
+                probe.node.shard or "-", probe.node.host, probe.db_name,
+                probe.error))
+            continue
+        bytes_per_sec = probe.rate * probe.avg_doc_size
+        print("%-12s %-24s %-16s %9.1f %9d %12d %9s" % (
+            probe.node.shard or "-", probe.node.host, probe.db_name,
+            probe.rate, probe.avg_doc_size, probe.size,
+            "%.0fs" % (probe.size / bytes_per_sec) if bytes_per_sec
+            else "-"))
+    planned = [probe.size for probe in probes if probe.error is None]
+    print("%d system.profile collections, %d bytes in total, to hold %gs "
+          "of ops" % (len(planned), sum(planned), args.headroom_secs))
+
+
+def set_profiling(client, db_name, action, size, is_primary):
+    """Enable or disable the profiling of a database"""
+    db = client[db_name]
+
+    if action == 'enable':
+        # can only drop/create the system.profile collection on the primary
+        if is_primary:
+            db.drop_collection('system.profile')
+            db.create_collection('system.profile', capped=True, size=size)
+        db.command('profile', 2)
+    else:
+        db.command('profile', 0)
+        if is_primary:
+            db.drop_collection('system.profile')
+
+
+def open_node(shard, host, args):
+    """Connect to a host and list its databases.
+    @return: the node "struct", `error` is set if that failed."""
+    node = utils.EmptyClass()
+    node.shard = shard
+    node.host = host
+    node.client = None
+    node.is_primary = False
+    node.db_names = []
+    # the system.profile size of the databases probed
+    node.sizes = {}
+    node.error = None
+    node.started_at = time.time()
+    node.done_at = node.started_at
+    try:
+        node.client = connect(host, args)
+        node.is_primary = node.client.is_primary
         exclude_list = string.split(args.exclude_list, ',')
-        
-        for db_name in db_names:
-            if db_name not in exclude_list:
-                db = client[db_name]
-                
-                if args.action == 'enable':
-                    # can only drop/create the system.profile collection on the primary
-                    if client.is_primary:
-                        db.drop_collection('system.profile')
-                        db.create_collection('system.profile', capped=True, size=args.size)
-                    db.command('profile', 2)
-                else:
-                    db.command('profile', 0)
-                    if client.is_primary:
-                        db.drop_collection('system.profile')
-        
-        client.close()        
+        node.db_names = [db_name for db_name in node.client.database_names()
+                         if db_name not in exclude_list]
+    except pymongo.errors.PyMongoError as e:
+        node.error = e
+    node.done_at = time.time()
+    return node
+
+
+def set_node_database(node, db_name, args):
+    """`set_profiling` of one database of a node.
+    @return: the error, if any, and when it was done."""
+    try:
+        set_profiling(node.client, db_name, args.action,
+                      node.sizes.get(db_name, args.size), node.is_primary)
+        error = None
     except pymongo.errors.PyMongoError as e:
+        error = e
+    return error, time.time()
+
+
+def run(args):
+    """Set the profiling of every database of every host, `args.workers` of
+    them at a time, sized after a probe with `--probe_secs`.
+    @return: the nodes, and the time they were all done or None if some
+        failed or `--plan_only`."""
+    hosts = find_hosts(args)
+    pool = ThreadPool(max(1, args.workers))
+    try:
+        nodes = pool.map(lambda host: open_node(host[0], host[1], args),
+                         hosts)
+        if args.action == 'enable' and args.probe_secs:
+            probes = probe_sizes(pool, nodes, args)
+            report_plan(probes, args)
+            for probe in probes:
+                if probe.error is None:
+                    probe.node.sizes[probe.db_name] = probe.size
+        tasks = [] if args.plan_only else \
+            [(node, db_name) for node in nodes if node.error is None
+             for db_name in node.db_names]
+        results = pool.map(
+            lambda task: set_node_database(task[0], task[1], args), tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # a database that could not be probed gets SIZE_BYTES
+    failed = any(node.error is not None for node in nodes)
+    for (node, db_name), (error, done_at) in zip(tasks, results):
+        node.done_at = max(node.done_at, done_at)
+        if error is not None:
+            print("ERROR: %s: %s: %s" % (node.host, db_name, error))
+            failed = True
+    for node in nodes:
+        if node.client is not None:
+            node.client.close()
+    if failed or args.plan_only:
+        return nodes, None
+    return nodes, max(node.done_at for node in nodes)
+
+
+def report(nodes):
+    print("%-12s %-24s %-9s %5s %8s" % ("shard", "host", "role", "dbs",
+                                        "secs"))
+    for node in nodes:
+        print("%-12s %-24s %-9s %5d %8.2f%s" % (
+            node.shard or "-", node.host,
+            "primary" if node.is_primary else "secondary",
+            len(node.db_names), node.done_at - node.started_at,
+            "" if node.error is None else "  ERROR: %s" % node.error))
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    try:
+        nodes, done_at = run(args)
+    except (pymongo.errors.PyMongoError, ValueError) as e:
         print(e)
         sys.exit(1)
-        
+
+    report(nodes)
+    if args.plan_only:
+        sys.exit(0)
+    if done_at is None:
+        print("Profiling could not be %sd everywhere, see the errors above" %
+              args.action)
+        sys.exit(1)
+    done = datetime.utcfromtimestamp(done_at)
+    print("All %sd at %s UTC" % (args.action, done))
+    if args.action == 'enable':
+        # whole seconds, after every member was done
+        print("Record from there on with \"start_utc_secs\": %d" %
+              int(math.ceil(done_at)))
@@ -0,0 +1,454 @@
+"""Formats of the intermediate files the recorder writes for each source.
+
+* "bson": a header followed by one record per document. A record is a small
+  BSON document holding the fields the merge works with (`ts`, `op`, `ns`)
+  followed by the whole document as raw BSON. Both are BSON, so both start
+  with their own int32 length and need no extra framing. When the driver
+  hands us raw documents they are written as they came off the wire,
+  otherwise they are encoded once by the C extension. The reader
+  memory-maps the file and decodes only the small document; the rest is
+  decoded on first access.
+* "pickle": the legacy format, one `cPickle` dump per document.
+
+`open_reader` tells the two apart by the header, so files from older
+recordings can still be merged.
+"""
+import cPickle
+import mmap
+import os
+import struct
+import segments
+import timing
+from bson import BSON
+
+try:
+    # pymongo >= 3.2 can return the documents undecoded
+    from bson.raw_bson import RawBSONDocument
+except ImportError:
+    RawBSONDocument = None
+
+MAGIC = "FLASHBACK-BSON-SPOOL-1\n"
+
+_INT32 = struct.Struct("<i")
+
+
+class SpoolDoc(object):
+
+    """A document read from a BSON spool. Behaves like the decoded dict, but
+    only decodes the whole document when a field other than the ones stored
+    next to it is needed"""
+
+    __slots__ = ("raw", "fields", "_doc")
+
+    def __init__(self, raw, fields):
+        self.raw = raw
+        self.fields = fields
+        self._doc = None
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = BSON(self.raw).decode()
+        return self._doc
+
+    def __getitem__(self, key):
+        if self._doc is None and key in self.fields:
+            return self.fields[key]
+        return self.doc[key]
+
+    def __setitem__(self, key, value):
+        self.doc[key] = value
+
+    def __contains__(self, key):
+        if self._doc is None and key in self.fields:
+            return True
+        return key in self.doc
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __nonzero__(self):
+        return True
+
+
+class SpoolWriter(object):
+
+    """Writes documents to a BSON spool"""
+
+    def __init__(self, f):
+        self.f = f
+        if f.tell() == 0:
+            f.write(MAGIC)
+
+    def encode(self, doc):
+        """Return the record for `doc`, see `write_raw`"""
+        if RawBSONDocument is not None and isinstance(doc, RawBSONDocument):
+            raw = doc.raw
+        elif isinstance(doc, SpoolDoc) and doc._doc is None:
+            raw = doc.raw
+        else:
+            raw = BSON.encode(doc)
+        fields = BSON.encode({"ts": doc["ts"], "op": doc.get("op"),
+                              "ns": doc.get("ns")})
+        return fields + raw
+
+    def write(self, doc):
+        self.f.write(self.encode(doc))
+
+    def write_raw(self, data):
+        """Write records, possibly many at once, made by `encode`"""
+        self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class SpoolReader(object):
+
+    """Reads the documents of a BSON spool from a memory map"""
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        self.f.seek(0, 2)
+        size = self.f.tell()
+        # mmap refuses empty files
+        self.buf = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ) \
+            if size else ""
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a BSON spool" % filename)
+        self.pos = len(MAGIC)
+
+    def read(self):
+        """Return the next document, or None at the end of the file"""
+        buf = self.buf
+        pos = self.pos
+        if pos + 4 > len(buf):
+            return None
+        start = pos + _INT32.unpack_from(buf, pos)[0]
+        if start + 4 > len(buf):
+            return None
+        end = start + _INT32.unpack_from(buf, start)[0]
+        if end > len(buf):
+            # the recorder died in the middle of this record
+            return None
+        self.pos = end
+        return SpoolDoc(buf[start:end], BSON(buf[pos:start]).decode())
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        self.pos = max(pos, len(MAGIC))
+
+    def close(self):
+        if self.buf:
+            self.buf.close()
+        self.f.close()
+
+
+class PickleWriter(object):
+
+    """Writes documents to a legacy pickle file"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def encode(self, doc):
+        """Return the pickled `doc`, see `write_raw`"""
+        return cPickle.dumps(doc)
+
+    def write(self, doc):
+        cPickle.dump(doc, self.f)
+
+    def write_raw(self, data):
+        """Write docs, possibly many at once, pickled by `encode`"""
+        self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class PickleReader(object):
+
+    """Reads the documents of a legacy pickle file"""
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+
+    def read(self):
+        """Return the next document, or None at the end of the file"""
+        try:
+            return cPickle.load(self.f)
+        except EOFError:
+            return None
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, pos):
+        self.f.seek(pos)
+
+    def close(self):
+        self.f.close()
+
+
+def open_writer(filename, file_format="bson", mode="wb", buffering=1 << 20):
+    """Open an intermediate file for writing in `file_format`"""
+    if file_format == "bson":
+        return SpoolWriter(open(filename, mode, buffering))
+    elif file_format == "pickle":
+        return PickleWriter(open(filename, mode, buffering))
+    raise ValueError("Unknown intermediate file format: %s" % file_format)
+
+
+class WriterGroup(object):
+
+    """The intermediate files of a recording, by source name"""
+
+    def __init__(self, filenames, file_format="bson", mode="wb",
+                 rotation=None, on_rotate=None):
+        """
+        @param filenames: maps the source names to their file names.
+        @param mode: "ab" to carry on writing files from an earlier run.
+        @param rotation: a `segments.Rotation`, to write the files as
+            segments.
+        @param on_rotate: called whenever a segment starts.
+        """
+        self.filenames = filenames
+        self.file_format = file_format
+        self.rotation = rotation \
+            if rotation is not None and rotation.enabled else None
+        self.on_rotate = on_rotate
+        self.writers = {}
+        # the `segments.Segment`s of each file, when rotated
+        self.segments = {}
+        for name, filename in filenames.iteritems():
+            if self.rotation is None:
+                self.writers[name] = open_writer(filename, file_format, mode)
+                continue
+            existing = segments.segment_files(filename) if mode == "ab" \
+                else []
+            if not existing:
+                segments.remove_segments(filename)
+                existing = [filename]
+            # the earlier run's segments, the last one goes on
+            self.segments[name] = [
+                _scan_segment(filename, index, self.rotation)
+                for index in xrange(len(existing))]
+            for segment in self.segments[name][:-1]:
+                segment.complete = True
+            self.writers[name] = open_writer(existing[-1], file_format, mode)
+        # the ts of the last doc written to each file, and how many docs
+        # had it
+        self.last_ts = {}
+        self.last_ts_docs = {}
+
+    def __contains__(self, name):
+        return name in self.writers
+
+    def write_batch(self, chunks):
+        """Write each source's docs with a single write, or one per segment
+        they fall in.
+        @param chunks: maps source names to lists of docs.
+        @return: how many docs and bytes were written."""
+        items = 0
+        nbytes = 0
+        encode_timer = timing.stage("record.encode")
+        write_timer = timing.stage("record.write")
+        for name, docs in chunks.iteritems():
+            for part in self._parts(name, docs):
+                writer = self.writers[name]
+                if encode_timer:
+                    start = timing.clock()
+                data = "".join([writer.encode(doc) for doc in part])
+                if encode_timer:
+                    encode_timer.add(timing.clock() - start)
+                if write_timer:
+                    start = timing.clock()
+                writer.write_raw(data)
+                if write_timer:
+                    write_timer.add(timing.clock() - start)
+                if self.rotation is not None:
+                    self.segments[name][-1].add(
+                        segments.epoch_secs(part[0]["ts"]),
+                        segments.epoch_secs(part[-1]["ts"]),
+                        len(part), len(data))
+                nbytes += len(data)
+            self._count_last_ts(name, docs)
+            items += len(docs)
+        return items, nbytes
+
+    def _count_last_ts(self, name, docs):
+        last_ts = docs[-1]["ts"]
+        same = 1
+        while same < len(docs) and docs[-same - 1]["ts"] == last_ts:
+            same += 1
+        if same == len(docs) and self.last_ts.get(name) == last_ts:
+            same += self.last_ts_docs[name]
+        self.last_ts[name] = last_ts
+        self.last_ts_docs[name] = same
+
+    def _parts(self, name, docs):
+        """Split the docs of a source at the start of its segments, starting
+        them as needed"""
+        if self.rotation is None:
+            yield docs
+            return
+        start = 0
+        while start < len(docs):
+            segment = self.segments[name][-1]
+            if self.rotation.is_full(segment):
+                self._rotate(name)
+                continue
+            ends_at = segment.ends_at if segment.ops else \
+                self.rotation.ends_at(segments.epoch_secs(docs[start]["ts"]))
+            end = len(docs)
+            # the docs come in ts order: mostly, all of them fit
+            if ends_at is not None and \
+                    segments.epoch_secs(docs[-1]["ts"]) >= ends_at:
+                end = next(index for index in xrange(start, len(docs))
+                           if segments.epoch_secs(docs[index]["ts"]) >=
+                           ends_at)
+            if end == start:
+                self._rotate(name)
+                continue
+            yield docs[start:end]
+            start = end
+
+    def _rotate(self, name):
+        writer = self.writers[name]
+        writer.close()
+        done = self.segments[name][-1]
+        done.complete = True
+        segment = segments.Segment(self.filenames[name], done.index + 1,
+                                   self.rotation)
+        self.writers[name] = open_writer(segment.filename, self.file_format)
+        self.segments[name].append(segment)
+        if self.on_rotate is not None:
+            self.on_rotate()
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def checkpoint(self):
+        """Flush the files.
+        @return: maps the names of the sources written so far to the size
+            of their file, or of its last segment, the ts of their last
+            doc and how many docs had it."""
+        self.flush()
+        files = {}
+        for name, ts in self.last_ts.iteritems():
+            files[name] = {"offset": self.writers[name].tell(), "ts": ts,
+                           "ts_docs": self.last_ts_docs[name]}
+            if self.rotation is not None:
+                files[name]["segment"] = self.segments[name][-1].index
+                files[name]["segments"] = [
+                    segment.summary() for segment in self.segments[name]]
+        return files
+
+    def segment_summaries(self):
+        """@return: maps the source names to the summaries of the segments
+            of their file, see `segments.Segment.summary`."""
+        return dict((name, [segment.summary() for segment in file_segments])
+                    for name, file_segments in self.segments.iteritems())
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+def _scan_segment(filename, index, rotation):
+    """Read what a segment of an intermediate file already holds"""
+    segment = segments.Segment(filename, index, rotation)
+    if not os.path.exists(segment.filename):
+        return segment
+    for doc in _iter_file(segment.filename):
+        secs = segments.epoch_secs(doc["ts"])
+        segment.add(secs, secs)
+    segment.bytes = os.path.getsize(segment.filename)
+    return segment
+
+
+def open_reader(filename):
+    """Open an intermediate file of either format for reading"""
+    f = open(filename, "rb")
+    header = f.read(len(MAGIC))
+    f.close()
+    if header == MAGIC:
+        return SpoolReader(filename)
+    return PickleReader(filename)
+
+
+def recover(filename, offset=0, last_ts=None, last_ts_docs=0):
+    """Truncate an intermediate file left behind by a recorder that died to
+    its last complete record.
+    @param offset: where a complete record is known to end, the scan starts
+        from there. Ignored if past the end of the file.
+    @param last_ts, last_ts_docs: the ts of the last record before
+        `offset`, and how many records had it.
+    @return: the ts of the last complete record, None if there is none, and
+        how many records had it."""
+    if not os.path.exists(filename):
+        return last_ts, last_ts_docs
+    size = os.path.getsize(filename)
+    reader = open_reader(filename)
+    if 0 < offset <= size:
+        reader.seek(offset)
+    good = reader.tell()
+    try:
+        while True:
+            doc = reader.read()
+            if not doc:
+                break
+            if doc["ts"] == last_ts:
+                last_ts_docs += 1
+            else:
+                last_ts = doc["ts"]
+                last_ts_docs = 1
+            good = reader.tell()
+    except Exception:
+        # a pickle cut short can fail in many ways
+        pass
+    finally:
+        reader.close()
+    if good < size:
+        f = open(filename, "r+b")
+        f.truncate(good)
+        f.close()
+    return last_ts, last_ts_docs
+
+
+def iter_docs(filename):
+    """Return the documents of an intermediate file as a sequence, segment
+    after segment if it was rotated (see `segments`)"""
+    for segment in segments.segment_files(filename) or [filename]:
+        for doc in _iter_file(segment):
+            yield doc
+
+
+def _iter_file(filename):
+    reader = open_reader(filename)
+    try:
+        while True:
+            doc = reader.read()
+            if not doc:
+                return
+            yield doc
+    finally:
+        reader.close()
@@ -0,0 +1,113 @@
+"""Tests of `checkpoint` and of the recovery of the intermediate files (see
+`spool.recover`), see README.md for how to run them"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from bson import json_util
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import checkpoint
+import segments
+import spool
+
+
+def make_docs(start, count):
+    return [{"ts": datetime(2020, 1, 1, 0, 0, start + index), "op": "query",
+             "ns": "db.c", "query": {"_id": start + index}}
+            for index in xrange(count)]
+
+
+class RecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "db_0")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, docs_batches, file_format="bson", rotation=None):
+        """Write the batches of docs, checkpointing after the first one.
+        @return: the checkpoint."""
+        files = spool.WriterGroup({"db_0": self.filename}, file_format,
+                                  rotation=rotation)
+        sources = None
+        for docs in docs_batches:
+            files.write_batch({"db_0": docs})
+            if sources is None:
+                sources = files.checkpoint()
+        files.close()
+        # as saved and loaded by `checkpoint`
+        return json_util.loads(json_util.dumps(
+            {"filenames": {"db_0": self.filename}, "sources": sources}))
+
+    def tear(self, filename):
+        """A recorder died while writing a record"""
+        f = open(filename, "ab")
+        f.write("\x40\x00\x00\x00torn")
+        f.close()
+
+    def ids(self):
+        return [doc["query"]["_id"] for doc in spool.iter_docs(self.filename)]
+
+    def test_truncates_torn_record(self):
+        for file_format in ("bson", "pickle"):
+            saved = self.write([make_docs(0, 3), make_docs(3, 2)],
+                               file_format)
+            size = os.path.getsize(self.filename)
+            self.tear(self.filename)
+            resume_ts = checkpoint.recover_files(saved)
+            self.assertEqual(size, os.path.getsize(self.filename))
+            # the docs written after the checkpoint are kept
+            self.assertEqual({"db_0": (datetime(2020, 1, 1, 0, 0, 4), 1)},
+                             resume_ts)
+            self.assertEqual(range(5), self.ids())
+
+    def test_rescans_file_shorter_than_checkpointed(self):
+        saved = self.write([make_docs(0, 3)])
+        f = open(self.filename, "r+b")
+        f.truncate(os.path.getsize(self.filename) - 5)
+        f.close()
+        resume_ts = checkpoint.recover_files(saved)
+        self.assertEqual({"db_0": (datetime(2020, 1, 1, 0, 0, 1), 1)},
+                         resume_ts)
+        self.assertEqual([0, 1], self.ids())
+
+    def test_counts_the_docs_at_the_last_ts(self):
+        # the profiler ts are not unique, the count goes on across batches,
+        # the checkpoint and segments
+        same_ts = make_docs(2, 1) * 3
+        saved = self.write([make_docs(0, 3), same_ts, same_ts[:2]],
+                           rotation=segments.Rotation(segment_bytes=1))
+        self.assertEqual(1, saved["sources"]["db_0"]["ts_docs"])
+        self.assertEqual({"db_0": (datetime(2020, 1, 1, 0, 0, 2), 6)},
+                         checkpoint.recover_files(saved))
+
+    def test_nothing_written(self):
+        saved = {"filenames": {"db_0": self.filename}, "sources": {}}
+        self.assertEqual({}, checkpoint.recover_files(saved))
+
+    def test_segments_started_after_the_checkpoint(self):
+        saved = self.write([make_docs(0, 3), make_docs(3, 20)],
+                           rotation=segments.Rotation(segment_secs=10))
+        files = segments.segment_files(self.filename)
+        self.assertEqual(3, len(files))
+        self.tear(files[-1])
+        resume_ts = checkpoint.recover_files(saved)
+        self.assertEqual({"db_0": (datetime(2020, 1, 1, 0, 0, 22), 1)},
+                         resume_ts)
+        self.assertEqual(range(23), self.ids())
+        # the recording carries on in the last segment
+        files = spool.WriterGroup({"db_0": self.filename}, mode="ab",
+                                  rotation=segments.Rotation(10))
+        files.write_batch({"db_0": make_docs(23, 8)})
+        files.close()
+        self.assertEqual(4, len(segments.segment_files(self.filename)))
+        self.assertEqual(range(31), self.ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Tests of `extjson`, see README.md for how to run them"""
+import os
+import re
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from bson import json_util
+from bson.binary import Binary
+from bson.code import Code
+from bson.objectid import ObjectId
+from bson.son import SON
+from bson.timestamp import Timestamp
+from bson.tz_util import utc
+import extjson
+
+TS = datetime(2020, 2, 29, 23, 59, 59, 999999)
+
+
+class DumpsTest(unittest.TestCase):
+
+    def check(self, doc):
+        self.assertEqual(json_util.dumps(doc), extjson.dumps(doc))
+
+    def test_plain_ops(self):
+        self.check({"ts": TS, "ns": "db.c", "op": "query",
+                    "query": {"_id": ObjectId("5e5a2b3c4d5e6f7081920a1b"),
+                              "a": [1, 2.5, -3L, None, True, u"\xe9"],
+                              "b": {"$in": [{"c": "d"}, []]}},
+                    "ntoskip": 0, "ntoreturn": -1})
+        self.check({})
+        self.check({"nested": [[{"deep": [TS]}]]})
+
+    def test_datetimes(self):
+        for ts in (TS, datetime(1970, 1, 1), datetime(1969, 12, 31, 23, 59),
+                   datetime(1900, 1, 1, 0, 0, 0, 1500),
+                   datetime(2038, 1, 19, 3, 14, 8),
+                   TS.replace(tzinfo=utc),
+                   TS - timedelta(microseconds=1)):
+            self.check({"ts": ts})
+
+    def test_other_bson_types(self):
+        for value in (Binary("\x00\xff"), Code("return 1"),
+                      Timestamp(1582934399, 3), re.compile("^a", re.I),
+                      SON([("b", 1), ("a", 2)]), float("inf")):
+            self.check({"ts": TS, "o": {"value": value}})
+            self.check({"ts": TS, "o": [value]})
+        self.check(SON([("ts", TS), ("op", "insert")]))
+
+
+if __name__ == '__main__':
+    unittest.main()
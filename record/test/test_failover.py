@@ -0,0 +1,174 @@
+"""Tests of `failover`, see README.md for how to run them"""
+import os
+import sys
+import unittest
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import docqueue
+import failover
+import fakecluster
+import merge
+import record
+import utils
+from pymongo.errors import AutoReconnect
+
+
+class FakeCursor(object):
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+        self.alive = True
+
+    def next(self):
+        return next(self.docs)
+
+    def close(self):
+        self.alive = False
+
+
+class FlakyRoute(object):
+
+    """Fails to open the first `failures` cursors"""
+
+    host = "host"
+
+    def __init__(self, failures, docs):
+        self.failures = failures
+        self.docs = docs
+        self.opened = []
+
+    def open(self, resume_after, died):
+        self.opened.append(resume_after)
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect("connection refused")
+        return FakeCursor(self.docs)
+
+    def moved(self):
+        return False
+
+
+class ResumableTailerTest(unittest.TestCase):
+
+    def test_first_open_fails(self):
+        route = FlakyRoute(1, [{"ts": 1}])
+        tailer = failover.ResumableTailer("db_0", route, min_retry_secs=60)
+        self.assertIsNone(tailer.cursor)
+        self.assertTrue(tailer.alive)
+        # not before the back off
+        self.assertRaises(failover.SourceDown, tailer.next)
+        self.assertEqual(1, len(route.opened))
+        tailer.retry_at = 0
+        self.assertEqual({"ts": 1}, tailer.next())
+        self.assertEqual([None, None], route.opened)
+
+    def test_first_open_fails_without_reconnect(self):
+        tailer = failover.ResumableTailer("db_0", FlakyRoute(1, []),
+                                          reconnect=False)
+        self.assertFalse(tailer.alive)
+        self.assertRaises(failover.SourceDown, tailer.next)
+
+
+def open_tailer(name, collection):
+    def open_cursor(client, resume_after):
+        criteria = {} if resume_after is None \
+            else {"ts": {"$gt": resume_after}}
+        return utils.create_tailing_cursor(collection, criteria,
+                                           await_data=False)
+    return failover.ResumableTailer(
+        name, failover.FixedRoute(None, "host", open_cursor))
+
+
+class IdleSourceTest(unittest.TestCase):
+
+    """A tailable cursor whose query matches nothing dies at once"""
+
+    def setUp(self):
+        cluster = fakecluster.FakeCluster(1, ["busy", "idle"])
+        self.busy = cluster.collection("shard0-a:27017", "busy", "profile")
+        self.idle = cluster.collection("shard0-a:27017", "idle", "profile")
+        start = datetime.utcnow() - timedelta(minutes=1)
+        for index in xrange(10):
+            self.busy.insert({"ts": start + timedelta(seconds=index),
+                              "op": "query", "ns": "db.c"})
+
+    def test_drained_cursor_is_no_failure(self):
+        tailer = open_tailer("idle", self.idle)
+        for _ in xrange(5):
+            self.assertRaises(StopIteration, tailer.next)
+            self.assertIsNotNone(tailer.drained_at)
+        self.assertEqual(0, tailer.failures)
+        self.assertEqual(0, tailer.reopens)
+        self.assertTrue(tailer.alive)
+        # what comes next is read
+        doc = {"ts": datetime.utcnow(), "op": "query", "ns": "db.c"}
+        self.idle.insert(doc)
+        self.assertEqual(doc, tailer.next())
+
+    def test_idle_source_lets_the_merger_flush(self):
+        names = ["busy", "idle"]
+        tailers = {"busy": open_tailer("busy", self.busy),
+                   "idle": open_tailer("idle", self.idle)}
+        state = record.MongoQueryRecorder.RecordingState(names)
+        doc_queue = docqueue.DocQueue()
+        output = StringIO()
+        merger = merge.StreamingMerger(output, names, oplog_sources=())
+        for name in names:
+            self.assertIsNotNone(record.poll_tailer(
+                tailers[name], name, doc_queue, state, None, 100))
+        for name, doc in doc_queue.get_batch(100, timeout=0):
+            if isinstance(doc, record.Heartbeat):
+                merger.heartbeat(name, doc.polled_at)
+            else:
+                merger.add(name, doc)
+        merger.flush()
+        self.assertEqual(10, len(output.getvalue().splitlines()))
+
+
+class SameTsTest(unittest.TestCase):
+
+    """Several profiler docs have the same ts"""
+
+    def setUp(self):
+        cluster = fakecluster.FakeCluster(1, ["db"])
+        self.profile = cluster.collection("shard0-a:27017", "db", "profile")
+        self.ts = datetime(2020, 1, 1)
+
+    def open_cursor(self, client, resume_after):
+        criteria = {} if resume_after is None \
+            else {"ts": {"$gte": resume_after}}
+        return utils.create_tailing_cursor(self.profile, criteria,
+                                           await_data=False)
+
+    def insert(self, _id, secs=0):
+        doc = {"ts": self.ts + timedelta(seconds=secs), "op": "query",
+               "ns": "db.c", "query": {"_id": _id}}
+        self.profile.insert(doc)
+        return doc
+
+    def test_reopened_cursor_skips_the_docs_read(self):
+        tailer = failover.ResumableTailer(
+            "db_0", failover.FixedRoute(None, "host", self.open_cursor))
+        docs = [self.insert(_id) for _id in xrange(2)]
+        self.assertEqual(docs, [tailer.next(), tailer.next()])
+        tailer.cursor.close()
+        docs = [self.insert(2), self.insert(3, 1)]
+        self.assertEqual(docs, [tailer.next(), tailer.next()])
+        self.assertEqual(1, tailer.reopens)
+
+    def test_resume_skips_the_docs_written(self):
+        for _id in xrange(3):
+            self.insert(_id)
+        docs = [self.insert(3, 1)]
+        tailer = failover.ResumableTailer(
+            "db_0", failover.FixedRoute(None, "host", self.open_cursor),
+            self.ts, resume_docs=2)
+        self.assertEqual(2, tailer.next()["query"]["_id"])
+        self.assertEqual(docs, [tailer.next()])
+        self.assertRaises(StopIteration, tailer.next)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+"""Tests of `insertmatch`, see README.md for how to run them"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from bson.timestamp import Timestamp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import insertmatch
+import merge
+import parallelmerge
+import spool
+
+START = datetime(2020, 1, 1)
+
+
+def oplog_doc(_id, secs=0, ns="db.c"):
+    return {"ts": START + timedelta(seconds=secs), "op": "i", "ns": ns,
+            "o": {"_id": _id}}
+
+
+def profiler_insert(_id, secs=0, ns="db.c"):
+    return {"ts": START + timedelta(seconds=secs), "op": "insert", "ns": ns,
+            "query": {"_id": _id}}
+
+
+def oplog_entry(_id, shard):
+    """As in an oplog file: at a `Timestamp`, marked with its shard"""
+    return {"ts": Timestamp(START + timedelta(seconds=_id), 0), "op": "i",
+            "ns": "db.c", "o": {"_id": _id, "shard": shard}}
+
+
+class PendingTest(unittest.TestCase):
+
+    def test_counts_the_waiting_docs(self):
+        matcher = insertmatch.InsertMatcher(["oplog"], max_docs=3)
+        for _id in (1, 1, 2, 3):
+            matcher.add("oplog", oplog_doc(_id))
+        # the first doc is dropped, the index holds no more than 3
+        self.assertEqual(3, matcher.pending())
+        self.assertEqual(1, matcher.dropped)
+        self.assertEqual(1, matcher.match("oplog", profiler_insert(1))["o"]
+                         ["_id"])
+        self.assertEqual(2, matcher.pending())
+        self.assertIsNone(matcher.match("oplog", profiler_insert(1)))
+        # without an _id, the oldest doc of the ns
+        self.assertEqual(2, matcher.match(
+            "oplog", {"ts": START, "op": "insert", "ns": "db.c"})["o"]["_id"])
+        self.assertEqual(1, matcher.pending())
+        matcher.expire(START + timedelta(seconds=60))
+        self.assertEqual(0, matcher.pending())
+        self.assertEqual(2, matcher.dropped)
+        self.assertEqual(4, matcher.count())
+
+
+class ShardRoutingTest(unittest.TestCase):
+
+    def test_inserts_match_in_the_oplog_of_their_shard(self):
+        matcher = insertmatch.InsertMatcher(
+            ["oplog_a", "oplog_b"],
+            {"db_a": "oplog_a", "db_b": "oplog_b"})
+        self.assertEqual("oplog_b", matcher.shard_of("db_b"))
+        # with several oplogs, an unknown source has no shard
+        self.assertIsNone(matcher.shard_of("db_c"))
+        matcher.add("oplog_a", oplog_doc(1))
+        matcher.add("oplog_b", oplog_doc(2))
+        self.assertIsNone(matcher.match("oplog_b", profiler_insert(1)))
+        self.assertIsNone(matcher.match(None, profiler_insert(1)))
+        self.assertEqual(oplog_doc(1),
+                         matcher.match("oplog_a", profiler_insert(1)))
+        self.assertEqual(oplog_doc(2),
+                         matcher.match("oplog_b", profiler_insert(2)))
+
+    def test_single_oplog_takes_every_source(self):
+        matcher = insertmatch.InsertMatcher(["oplog"])
+        self.assertEqual("oplog", matcher.shard_of("db_a"))
+
+
+class MultiShardMergeTest(unittest.TestCase):
+
+    """The post-hoc merge of a recording of two shards, both with the same
+    `_id`s"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shards = {}
+        oplog_files = []
+        self.profiler_files = []
+        for shard in ("a", "b"):
+            oplog_file = os.path.join(self.directory, "oplog_" + shard)
+            profiler_file = os.path.join(self.directory, "db_" + shard)
+            self.write(oplog_file, [oplog_entry(_id, shard)
+                                    for _id in xrange(10)])
+            self.write(profiler_file,
+                       [profiler_insert(_id, _id) for _id in xrange(10)])
+            oplog_files.append(oplog_file)
+            self.profiler_files.append(profiler_file)
+            self.shards[profiler_file] = oplog_file
+        self.oplog_files = oplog_files
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def write(filename, docs):
+        writer = spool.SpoolWriter(open(filename, "wb"))
+        for doc in docs:
+            writer.write(doc)
+        writer.close()
+
+    def check(self, merge_function, **kwargs):
+        output_file = os.path.join(self.directory, "output")
+        merge_function(self.oplog_files, self.profiler_files, output_file,
+                       shards=self.shards, **kwargs)
+        ops = [line for line in open(output_file)]
+        self.assertEqual(20, len(ops))
+        # every insert got the doc from the oplog of its own shard
+        self.assertEqual(10, sum('"shard": "a"' in op for op in ops))
+        self.assertEqual(10, sum('"shard": "b"' in op for op in ops))
+
+    def test_sequential(self):
+        self.check(merge.merge_to_final_output)
+
+    def test_parallel(self):
+        self.check(parallelmerge.parallel_merge_to_final_output, workers=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
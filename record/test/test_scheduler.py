@@ -0,0 +1,70 @@
+"""Tests of `scheduler`, see README.md for how to run them"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import scheduler
+
+
+def make_source(name, docs_per_poll, polls, order):
+    """A source that moves `docs_per_poll` docs per poll, `polls` times"""
+    left = [polls]
+
+    def poll(max_docs):
+        order.append(name)
+        if not left[0]:
+            return None
+        left[0] -= 1
+        return min(docs_per_poll, max_docs)
+    return poll
+
+
+class TailerSchedulerTest(unittest.TestCase):
+
+    def run_sources(self, sources, threads=1):
+        """Poll the (name, docs per poll, polls) sources to the end.
+        @return: the names of the sources in the order they were polled."""
+        order = []
+        # no pause between polls: every source is due again right away
+        tailer_scheduler = scheduler.TailerScheduler(10, 10, 0, 0)
+        for name, docs_per_poll, polls in sources:
+            tailer_scheduler.add(make_source(name, docs_per_poll, polls,
+                                             order))
+        workers = [threading.Thread(target=tailer_scheduler.run_worker)
+                   for _ in xrange(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+        return order
+
+    def test_busiest_due_source_first(self):
+        order = self.run_sources([("idle", 0, 5), ("hot", 10, 5)])
+        # the first round knows no rate yet, then every round starts with
+        # the hot source, even though the idle one came due first
+        self.assertEqual(["idle", "hot"], order[:2])
+        for round_start in xrange(2, 10, 2):
+            self.assertEqual(["hot", "idle"],
+                             order[round_start:round_start + 2])
+
+    def test_hot_sources_do_not_starve_idle_ones(self):
+        order = self.run_sources(
+            [("hot1", 10, 20), ("hot2", 10, 20), ("idle", 0, 20)])
+        # every source is polled once per round
+        for round_start in xrange(0, 60, 3):
+            self.assertEqual(set(["hot1", "hot2", "idle"]),
+                             set(order[round_start:round_start + 3]))
+
+    def test_done_sources_leave(self):
+        order = self.run_sources([("short", 10, 1), ("long", 10, 4)],
+                                 threads=2)
+        # the last poll of each returns None
+        self.assertEqual(2, order.count("short"))
+        self.assertEqual(5, order.count("long"))
+
+
+if __name__ == '__main__':
+    unittest.main()
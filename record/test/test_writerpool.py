@@ -0,0 +1,67 @@
+"""Tests of `writerpool`, see README.md for how to run them"""
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import spool
+import writerpool
+
+
+class WriterPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filenames = dict((name, os.path.join(self.directory, name))
+                              for name in ("a", "b"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_checkpoint(self):
+        pool = writerpool.WriterPool(self.filenames, processes=2)
+        docs = [{"ts": datetime(2020, 1, 1, 0, 0, second), "op": "query",
+                 "ns": "db.c"} for second in xrange(3)]
+        pool.write_batch({"a": docs, "b": docs[:1]})
+        files = pool.checkpoint()
+        pool.close()
+        self.assertEqual(docs[-1]["ts"], files["a"]["ts"])
+        self.assertEqual(os.path.getsize(self.filenames["a"]),
+                         files["a"]["offset"])
+        self.assertEqual(3, len(list(spool.iter_docs(self.filenames["a"]))))
+
+    def test_checkpoint_fails_once_a_worker_died(self):
+        pool = writerpool.WriterPool(self.filenames, processes=2)
+        os.kill(pool.processes[0].pid, signal.SIGKILL)
+        pool.processes[0].join()
+        start = time.time()
+        self.assertRaises(writerpool.WriterDied, pool.checkpoint)
+        self.assertLess(time.time() - start, 10)
+        # and closing gives up on it too
+        pool.close()
+
+    def test_close_terminates_a_stuck_worker(self):
+        pool = writerpool.WriterPool(self.filenames, processes=2)
+        process = pool.processes[0]
+        os.kill(process.pid, signal.SIGSTOP)
+        timeout, writerpool.REPORT_TIMEOUT_SECS = \
+            writerpool.REPORT_TIMEOUT_SECS, 1
+        try:
+            start = time.time()
+            pool.close()
+            self.assertLess(time.time() - start, 10)
+        finally:
+            writerpool.REPORT_TIMEOUT_SECS = timeout
+            # the termination is delivered once it runs again
+            os.kill(process.pid, signal.SIGCONT)
+        process.join(10)
+        self.assertEqual(-signal.SIGTERM, process.exitcode)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+r"""Time index sidecar for the recorded output files.
+
+Next to `OUTPUT`, the merge writes `OUTPUT.idx`, a text file with one
+"second offset ordinal" line for the first op of every second (and,
+with "index_every_ops", every N ops within a second): the op's `ts` in
+seconds since the epoch, where its line starts in the uncompressed output,
+and how many ops precede it.
+With it, a time window is cut out of a recording by seeking straight to
+it instead of scanning the whole file, e.g. the 10 minutes starting 1 hour
+into a recording:
+
+    python timeindex.py OUTPUT --start +3600 --end +4200 > PEAK
+"""
+import bisect
+import calendar
+import sys
+from argparse import ArgumentParser
+import blockfile
+
+INDEX_SUFFIX = ".idx"
+HEADER = "# flashback time index: second offset ordinal\n"
+
+
+def index_filename(output_file):
+    return output_file + INDEX_SUFFIX
+
+
+class IndexedWriter(object):
+
+    """Wraps the output file and records where each second starts.
+
+    `mark` must be called with the op's `ts` right before its line is
+    written.
+    """
+
+    def __init__(self, output, index_file=None, every_ops=None):
+        """
+        @param index_file: file object receiving the index lines, as they
+            are produced. If None, they are only kept in `entries`.
+        @param every_ops: also add an entry after that many ops within the
+            same second.
+        """
+        self.output = output
+        self.index_file = index_file
+        self.every_ops = every_ops
+        self.entries = []
+        self.offset = 0
+        self.ordinal = 0
+        self.last_second = None
+        self.last_ordinal = 0
+        if index_file:
+            index_file.write(HEADER)
+
+    def mark(self, ts):
+        second = calendar.timegm(ts.timetuple())
+        # `locate` bisects the entries: an op older than the last entry,
+        # which can come in a merge, gets none
+        if self.last_second is None or second > self.last_second or \
+                (self.every_ops and second == self.last_second and
+                 self.ordinal - self.last_ordinal >= self.every_ops):
+            self._add((second, self.offset, self.ordinal))
+
+    def _add(self, entry):
+        self.last_second = entry[0]
+        self.last_ordinal = entry[2]
+        self.entries.append(entry)
+        if self.index_file:
+            self.index_file.write("%d %d %d\n" % entry)
+
+    def write(self, data):
+        self.output.write(data)
+        self.offset += len(data)
+        self.ordinal += data.count("\n")
+
+    def append(self, filename, entries):
+        """Copy over the content of another output file, given the index
+        `entries` that were recorded for it"""
+        for second, offset, ordinal in entries:
+            if second > self.last_second or \
+                    (self.every_ops and second == self.last_second):
+                self._add((second, self.offset + offset,
+                           self.ordinal + ordinal))
+        f = open(filename, "rb")
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            self.write(data)
+        f.close()
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.output.flush()
+        if self.index_file:
+            self.index_file.flush()
+
+    def close(self):
+        self.output.close()
+        if self.index_file:
+            self.index_file.close()
+
+
+def load_index(output_file):
+    """Return the (second, offset, ordinal) entries of `output_file`"""
+    entries = []
+    for line in open(index_filename(output_file)):
+        if not line.startswith("#"):
+            entries.append(tuple(int(field) for field in line.split()))
+    return entries
+
+
+def locate(entries, second):
+    """Return the uncompressed offset of the first op at or after `second`,
+    or None if there is none"""
+    position = bisect.bisect_left(entries, (second,))
+    if position == len(entries):
+        return None
+    return entries[position][1]
+
+
+def iter_window(output_file, start=None, end=None):
+    """Yield the output in chunks, from the first op at or after the `start`
+    second up to, not including, the first op at or after the `end` second.
+    Only the part of the file in the window is read."""
+    entries = load_index(output_file)
+    start_offset = 0 if start is None else locate(entries, start)
+    end_offset = None if end is None else locate(entries, end)
+    if start_offset is None or \
+            (end_offset is not None and end_offset <= start_offset):
+        return
+
+    if blockfile.is_block_file(output_file):
+        reader = blockfile.BlockReader(output_file)
+        first = reader.find_block(start_offset)
+        if first is None:
+            return
+        chunks = reader.iter_blocks(first)
+        chunk_offset = reader.blocks[first][2]
+    else:
+        f = open(output_file, "rb")
+        f.seek(start_offset)
+        chunks = iter(lambda: f.read(1 << 20), "")
+        chunk_offset = start_offset
+
+    for chunk in chunks:
+        low = max(start_offset - chunk_offset, 0)
+        high = len(chunk) if end_offset is None \
+            else min(end_offset - chunk_offset, len(chunk))
+        if low < high:
+            yield chunk[low:high]
+        chunk_offset += len(chunk)
+        if end_offset is not None and chunk_offset >= end_offset:
+            break
+
+
+def get_args():
+    parser = ArgumentParser(
+        description='Write the ops of a time window of a recording to '
+        'stdout, using its time index. Times are seconds since the epoch, or '
+        'seconds since the first op when prefixed with "+".')
+    parser.add_argument('output_file', help='The recorded output file',
+                        metavar='OUTPUT_FILE')
+    parser.add_argument('-s', '--start', dest='start',
+                        help='The first second to include', metavar='START')
+    parser.add_argument('-e', '--end', dest='end',
+                        help='The first second to leave out', metavar='END')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    entries = load_index(args.output_file)
+    first_second = entries[0][0] if entries else 0
+
+    def parse(value):
+        if value is None:
+            return None
+        if value.startswith("+"):
+            return first_second + int(value[1:])
+        return int(value)
+
+    for chunk in iter_window(args.output_file, parse(args.start),
+                             parse(args.end)):
+        sys.stdout.write(chunk)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Optional latency histograms of the stages of the recording and the merge.
+
+Off by default. Instrumented code asks for its `Stage` with `stage(name)`,
+which returns None while timing is off, so the hot paths only pay for a
+truth test:
+
+    fetch = timing.stage("record.fetch")
+    ...
+    if fetch:
+        start = timing.clock()
+    doc = tailer.next()
+    if fetch:
+        fetch.add(timing.clock() - start)
+
+Worker processes send their `snapshot()` back to the parent, which folds it
+in with `merge_snapshot`.
+"""
+import threading
+import time
+import utils
+
+clock = time.time
+
+ENABLED = False
+
+# bucket i counts the durations of less than 2 ** i microseconds
+_BUCKETS = 40
+
+_stages = {}
+_stages_lock = threading.Lock()
+
+
+class Stage(object):
+
+    """Count, total, max and log2 histogram of the durations of a stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * _BUCKETS
+        self.lock = threading.Lock()
+
+    def add(self, secs):
+        bucket = min(int(secs * 1e6).bit_length(), _BUCKETS - 1)
+        with self.lock:
+            self.count += 1
+            self.total += secs
+            if secs > self.max:
+                self.max = secs
+            self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the `fraction` percentile, in seconds"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def reset():
+    """Forget what was timed so far, e.g. in a freshly forked worker"""
+    with _stages_lock:
+        _stages.clear()
+
+
+def stage(name):
+    """Return the `Stage` called `name`, or None if timing is off"""
+    if not ENABLED:
+        return None
+    found = _stages.get(name)
+    if found is None:
+        with _stages_lock:
+            found = _stages.setdefault(name, Stage(name))
+    return found
+
+
+def timed_iter(iterable, name):
+    """Time how long each item of `iterable` takes to produce"""
+    timer = stage(name)
+    if not timer:
+        return iterable
+    return _timed_iter(iter(iterable), timer)
+
+
+def _timed_iter(iterator, timer):
+    while True:
+        start = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        timer.add(clock() - start)
+        yield item
+
+
+def snapshot():
+    """The stages as plain data, to send them to another process"""
+    with _stages_lock:
+        return dict((name, (s.count, s.total, s.max, list(s.buckets)))
+                    for name, s in _stages.iteritems())
+
+
+def merge_snapshot(data):
+    """Add a `snapshot()` of another process to the stages"""
+    for name, (count, total, max_secs, buckets) in data.iteritems():
+        timer = stage(name)
+        if not timer:
+            return
+        with timer.lock:
+            timer.count += count
+            timer.total += total
+            timer.max = max(timer.max, max_secs)
+            timer.buckets = [a + b for a, b in zip(timer.buckets, buckets)]
+
+
+def report():
+    """Log a summary of every stage.
+    @return: the summary, by stage name."""
+    summary = {}
+    lines = ["%-24s %10s %10s %10s %10s %10s %10s" %
+             ("stage", "count", "total s", "mean us", "p50 us", "p99 us",
+              "max us")]
+    for name in sorted(_stages):
+        timer = _stages[name]
+        if not timer.count:
+            continue
+        summary[name] = {
+            "count": timer.count,
+            "total_secs": timer.total,
+            "mean_secs": timer.total / timer.count,
+            "p50_secs": timer.percentile(0.5),
+            "p99_secs": timer.percentile(0.99),
+            "max_secs": timer.max,
+        }
+        lines.append("%-24s %10d %10.3f %10.1f %10.1f %10.1f %10.1f" % (
+            name, timer.count, timer.total,
+            1e6 * summary[name]["mean_secs"], 1e6 * summary[name]["p50_secs"],
+            1e6 * summary[name]["p99_secs"], 1e6 * timer.max))
+    if summary:
+        utils.LOG.info("Time spent per stage:\n  %s", "\n  ".join(lines))
+    return summary
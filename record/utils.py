@@ -2,6 +2,7 @@
 import logging
 import cPickle
 import time
+from bson.timestamp import Timestamp
 import pymongo
 import string
 import threading
@@ -57,11 +58,30 @@ def now_in_utc_secs():
     return int(time.time())
 
 
-def create_tailing_cursor(collection, criteria, oplog=False):
+def ts_to_datetime(ts):
+    """Normalize a profiler `datetime` or an oplog `Timestamp` to a naive UTC
+    datetime so that docs from both sources can be compared."""
+    if type(ts) is Timestamp:
+        ts = ts.as_datetime()
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None) - ts.utcoffset()
+    return ts
+
+
+def create_tailing_cursor(collection, criteria, oplog=False, await_data=True,
+                          fields=None):
     """Create a cursor that constantly tail the latest documents from the
-       database"""
+       database
+    @param await_data: whether the server should wait a while for new data
+        when the cursor is drained, rather than return immediately.
+    @param fields: if not None, the only fields the server returns.
+    """
+    if fields is not None:
+        fields = dict.fromkeys(fields, True)
+        fields["_id"] = False
     tailer = collection.find(
-        criteria, slave_okay=True, tailable=True, await_data=True)
+        criteria, fields=fields, slave_okay=True, tailable=True,
+        await_data=await_data)
     
     # Set oplog_replay on the cursor, which allows queries against the oplog to run much faster
     if oplog:
@@ -70,6 +90,24 @@ def create_tailing_cursor(collection, criteria, oplog=False):
     return tailer
 
 
+def get_cluster_topology(mongos_client):
+    """Ask a mongos for the members of every shard.
+    @return: {shard: {"primary": host, "secondaries": [host, ...]}}, or
+        None if the mongos knows no replica set."""
+    topology = {}
+    temp_topology = mongos_client.admin.command("connPoolStats")
+    if 'replicaSets' not in temp_topology:
+        return None
+    for shard in temp_topology['replicaSets']:
+        topology[shard] = {'primary': None, 'secondaries': []}
+        for host in temp_topology['replicaSets'][shard]['hosts']:
+            if host['ismaster'] is True:
+                topology[shard]['primary'] = host['addr']
+            elif host['secondary'] is True:
+                topology[shard]['secondaries'].append(host['addr'])
+    return topology
+
+
 def get_start_time(collection):
     """Get the latest element's timestamp from a collection with "ts" field"""
     result = collection.find().limit(1).sort([("ts", pymongo.DESCENDING)])
@@ -85,7 +123,9 @@ class EmptyClass(object):
 
 
 def set_interval(interval, start_immediately=True, exec_on_exit=True):
-    """An decorator that executes the event every n seconds"""
+    """An decorator that executes the event every n seconds. The decorated
+    function returns an event to set to stop, its `thread` can be joined
+    once it is set."""
     def decorator(function):
         def wrapper(*args, **kwargs):
             stopped = threading.Event()
@@ -101,6 +141,7 @@ def set_interval(interval, start_immediately=True, exec_on_exit=True):
             t = threading.Thread(target=loop)
             t.daemon = True  # stop if the program exits
             t.start()
+            stopped.thread = t
             return stopped
         return wrapper
     return decorator
@@ -128,34 +169,64 @@ def make_ns_selector(databases, target_collections):
 
 
 def get_oplog_tailer(oplog_client, types, target_dbs, target_colls,
-                     start_time=None):
+                     start_time=None, await_data=True, project_fields=False,
+                     resume_after=None):
     """Start recording the oplog entries starting from now.
     We only care about "insert" operations since all other queries will
     be captured by mongodb oplog collection.
 
     REQUIRED: the specific mongodb database has enabled profiling.
+    @param types: the oplog op types to record. Commands ("c") are selected
+        by the database they ran on rather than their collection, and
+        include the applyOps run on admin.
+    @param resume_after: if not None, start right after this ts instead of
+        at `start_time`, to carry on an interrupted recording. The oplog ts
+        are unique.
     """
     oplog_collection = \
         oplog_client[constants.LOCAL_DB][constants.OPLOG_COLLECTION]
     criteria = {
-        "op": {"$in": types},
+        "op": {"$in": [op for op in types if op != "c"]},
         "ns": make_ns_selector(target_dbs, target_colls)
     }
-
-    if start_time is not None:
+    if "c" in types:
+        criteria = {"$or": [criteria, {
+            "op": "c",
+            "ns": {"$in": ["admin.$cmd"] +
+                   ["%s.$cmd" % db for db in target_dbs]}
+        }]}
+
+    if resume_after is not None:
+        criteria["ts"] = {"$gt": resume_after}
+    elif start_time is not None:
         criteria["ts"] = {"$gte": start_time}
-    return create_tailing_cursor(oplog_collection, criteria, oplog=True)
-
-
-def get_profiler_tailer(client, target_db, target_colls, start_time):
-    """Start recording the profiler entries"""
+    fields = constants.OPLOG_FIELDS if project_fields else None
+    return create_tailing_cursor(oplog_collection, criteria, oplog=True,
+                                 await_data=await_data, fields=fields)
+
+
+def get_profiler_tailer(client, target_db, target_colls, start_time,
+                        await_data=True, op_types=None, project_fields=False,
+                        resume_after=None):
+    """Start recording the profiler entries
+    @param op_types: if not empty, only record these op types.
+    @param project_fields: only fetch the fields needed for replay.
+    @param resume_after: if not None, start at this ts instead of at
+        `start_time`. The profiler ts only have milliseconds, several docs
+        may have this one: the cursor returns those already read again,
+        for the caller to skip, see `failover.ResumableTailer`.
+    """
     profiler_collection = client[target_db][constants.PROFILER_COLLECTION]
     criteria = {
         "ns": make_ns_selector([target_db], target_colls),
-        "ts": {"$gte": start_time}
+        "ts": {"$gte": start_time if resume_after is None else resume_after}
     }
+    if op_types:
+        criteria["op"] = {"$in": list(op_types)}
 
-    return create_tailing_cursor(profiler_collection, criteria)
+    fields = constants.PROFILER_FIELDS if project_fields else None
+    return create_tailing_cursor(profiler_collection, criteria,
+                                 await_data=await_data, fields=fields)
 
 
 class DictionaryCopier(object):
@@ -0,0 +1,195 @@
+"""Encode and write the intermediate files in worker processes"""
+import multiprocessing
+import Queue
+import time
+import spool
+import timing
+import utils
+
+
+CHECKPOINT = "checkpoint"
+# the longest the workers get to report on their files, and to exit when
+# closing
+REPORT_TIMEOUT_SECS = 60
+# how often a wait on the workers checks that they are still alive
+ALIVE_CHECK_SECS = 1
+
+
+class WriterDied(Exception):
+
+    """A writer process exited before writing all it was handed"""
+
+
+def _write_docs(filenames, file_format, mode, rotation, batches, written,
+                reports):
+    """Worker process: write the batches it receives until it gets None. On
+    CHECKPOINT, report the state of its files to `reports`, and on None,
+    its timings if they are on."""
+    # the parent's timings were copied over by the fork
+    timing.reset()
+    writers = spool.WriterGroup(filenames, file_format, mode, rotation)
+    try:
+        while True:
+            chunks = batches.get()
+            if chunks is None:
+                if timing.ENABLED:
+                    reports.put(timing.snapshot())
+                break
+            if chunks == CHECKPOINT:
+                reports.put(writers.checkpoint())
+                continue
+            items, nbytes = writers.write_batch(chunks)
+            with written.get_lock():
+                written[0] += items
+                written[1] += nbytes
+    finally:
+        writers.close()
+
+
+class WriterPool(object):
+
+    """Same interface as `spool.WriterGroup`, but each source is owned by one
+    of several worker processes, which encode its docs and write its file.
+
+    The recorder's writer thread then only hands over batches through a
+    pipe. That is cheapest when the tailers return raw BSON documents, which
+    cross the pipe as plain bytes; decoded docs are pickled on the way,
+    which still costs the recorder process less than encoding them.
+    """
+
+    def __init__(self, filenames, file_format="bson", processes=2,
+                 max_pending_batches=64, mode="wb", rotation=None):
+        """
+        @param filenames: maps the source names to their file names.
+        @param mode, rotation: see `spool.WriterGroup`.
+        @param max_pending_batches: batches queued for a worker before the
+            writer thread has to wait for it.
+        """
+        processes = max(1, min(processes, len(filenames)))
+        names = sorted(filenames)
+        # spread the sources over the workers round robin
+        self.owners = dict((name, index % processes)
+                           for index, name in enumerate(names))
+        self.written = multiprocessing.Array("L", 2)
+        self.reported = (0, 0)
+        self.reports = multiprocessing.Queue()
+        # the segments of each file, as of the last checkpoint
+        self.segments = {}
+        self.queues = []
+        self.processes = []
+        for index in xrange(processes):
+            owned = dict((name, filenames[name]) for name in names
+                         if self.owners[name] == index)
+            batches = multiprocessing.Queue(max_pending_batches)
+            process = multiprocessing.Process(
+                target=_write_docs, name="writer-%d" % index,
+                args=(owned, file_format, mode, rotation, batches,
+                      self.written, self.reports))
+            process.daemon = True
+            process.start()
+            self.queues.append(batches)
+            self.processes.append(process)
+        utils.LOG.info("Started %d writer processes", processes)
+
+    def __contains__(self, name):
+        return name in self.owners
+
+    def write_batch(self, chunks):
+        """Hand the docs over to the workers owning their sources.
+        @return: how many docs and bytes the workers have written since the
+            last call."""
+        timer = timing.stage("record.handoff")
+        if timer:
+            start = timing.clock()
+        per_process = {}
+        for name, docs in chunks.iteritems():
+            per_process.setdefault(self.owners[name], {})[name] = docs
+        for index, process_chunks in per_process.iteritems():
+            self._put(index, process_chunks)
+        if timer:
+            timer.add(timing.clock() - start)
+
+        with self.written.get_lock():
+            written = (self.written[0], self.written[1])
+        delta = (written[0] - self.reported[0], written[1] - self.reported[1])
+        self.reported = written
+        return delta
+
+    def flush(self):
+        """Nothing to do, the workers flush when they are closed"""
+
+    def checkpoint(self):
+        """See `spool.WriterGroup.checkpoint`. Waits for the workers to
+        write everything they were handed so far.
+        @raise WriterDied: if a worker is dead or does not report in
+            `REPORT_TIMEOUT_SECS`."""
+        for index in xrange(len(self.queues)):
+            self._put(index, CHECKPOINT)
+        files = {}
+        deadline = time.time() + REPORT_TIMEOUT_SECS
+        for _ in self.queues:
+            files.update(self._report(deadline))
+        for name, source in files.iteritems():
+            if "segments" in source:
+                self.segments[name] = source["segments"]
+        return files
+
+    def segment_summaries(self):
+        """See `spool.WriterGroup.segment_summaries`, as of the last
+        checkpoint"""
+        return dict(self.segments)
+
+    def _put(self, index, item):
+        """Hand `item` over to the worker `index`, waiting for room as long
+        as it is alive"""
+        while True:
+            try:
+                self.queues[index].put(item, timeout=ALIVE_CHECK_SECS)
+                return
+            except Queue.Full:
+                self._check_alive(index)
+
+    def _report(self, deadline):
+        """The next report of a worker, received by `deadline`"""
+        while True:
+            try:
+                return self.reports.get(timeout=ALIVE_CHECK_SECS)
+            except Queue.Empty:
+                for process in self.processes:
+                    # one that exited cleanly may have reported already
+                    if process.exitcode not in (None, 0):
+                        raise WriterDied(
+                            "Writer process %s exited with code %s" %
+                            (process.name, process.exitcode))
+                if time.time() >= deadline:
+                    raise WriterDied("The writer processes did not report "
+                                     "in %ds" % REPORT_TIMEOUT_SECS)
+
+    def _check_alive(self, index):
+        process = self.processes[index]
+        if not process.is_alive():
+            raise WriterDied("Writer process %s exited with code %s" %
+                             (process.name, process.exitcode))
+
+    def close(self):
+        """Wait for the workers to write everything they were handed"""
+        deadline = time.time() + REPORT_TIMEOUT_SECS
+        try:
+            for index in xrange(len(self.queues)):
+                self._put(index, None)
+            if timing.ENABLED:
+                for _ in self.queues:
+                    timing.merge_snapshot(self._report(deadline))
+        except WriterDied, e:
+            utils.LOG.error("%s, its files miss the last docs", e)
+        for process in self.processes:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                utils.LOG.error("Writer process %s still running after %ds, "
+                                "terminating it, its files miss the last "
+                                "docs", process.name, REPORT_TIMEOUT_SECS)
+                process.terminate()
+                process.join(ALIVE_CHECK_SECS)
+            elif process.exitcode != 0:
+                utils.LOG.error("Writer process %s exited with code %s",
+                                process.name, process.exitcode)